@@ -0,0 +1,151 @@
+"""
+Async variants of the document actions, for an ASGI server, eg:
+
+    uvicorn doclib.asgi:application
+
+Django 4.0 has no async ORM: the queries and the file writes of each
+request run in a single hop to a thread, the rest runs on the event loop.
+The downloaded files are streamed by the ASGI handler of the project (see
+apps.utils.asgi), their chunks read in the threads: the event loop is not
+blocked, and a slow client holds no thread.
+"""
+
+import json
+from typing import Any, AnyStr, Callable, Dict
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseNotAllowed, JsonResponse
+from django.http.response import HttpResponseBase
+
+from rest_framework import status
+from rest_framework.exceptions import (
+    APIException,
+    NotAuthenticated,
+    ParseError,
+)
+
+from apps.store.models import User
+from apps.utils.authentication import CachedTokenAuthentication
+
+from . import operations
+from .serializers import DocumentSerializer, StringListSerializer
+
+
+def authenticate(request) -> User:
+    """The user of the token, as the DocumentViewSet authenticates."""
+    result = CachedTokenAuthentication().authenticate(request)
+    if result is None:
+        raise NotAuthenticated
+    return result[0]
+
+
+def get_data(request) -> Dict[AnyStr, Any]:
+    """The JSON body, else the form data (of the POST requests)."""
+    if request.content_type != "application/json":
+        return request.POST.dict()
+    try:
+        return json.loads(request.body or b"{}")
+    except ValueError as error:
+        raise ParseError(f"JSON parse error - {error}")
+
+
+def token_authenticated(view: Callable) -> Callable:
+    """
+    No CSRF check, as the DRF views: the token is no cookie. Set in place,
+    the csrf_exempt decorator of Django 4.0 would hide the coroutine.
+    """
+    view.csrf_exempt = True
+    return view
+
+
+async def run(request, action: Callable, *args) -> HttpResponseBase:
+    """
+    Authenticate and run the sync part of the action in a thread, the API
+    errors are returned as DocumentViewSet returns them.
+    """
+
+    def handle():
+        return action(request, authenticate(request), *args)
+
+    try:
+        return await sync_to_async(handle)()
+    except APIException as error:
+        detail = error.detail
+        if not isinstance(detail, (list, dict)):
+            detail = {"detail": detail}
+        return JsonResponse(detail, status=error.status_code, safe=False)
+
+
+def create_document(request, user: User) -> HttpResponseBase:
+    serializer = DocumentSerializer(
+        data=get_data(request), context={"api_caller": user}
+    )
+
+    serializer.is_valid(raise_exception=True)
+
+    serializer.save(owner=user)
+    return JsonResponse(serializer.data, status=status.HTTP_201_CREATED)
+
+
+def update_document(request, user: User, pk: AnyStr) -> HttpResponseBase:
+    instance = operations.get_document(user, pk, shared=True)
+    serializer = DocumentSerializer(
+        instance,
+        data=get_data(request),
+        partial=True,
+        context={"api_caller": user},
+    )
+
+    serializer.is_valid(raise_exception=True)
+
+    serializer.save()
+    return JsonResponse(serializer.data)
+
+
+def share_document(request, user: User, pk: AnyStr) -> HttpResponseBase:
+    instance = operations.get_document(user, pk, shared=False)
+    serializer = StringListSerializer(data=get_data(request))
+
+    serializer.is_valid(raise_exception=True)
+
+    operations.share_document(
+        instance, user, serializer.validated_data["id_list"]
+    )
+    return JsonResponse(DocumentSerializer(instance).data)
+
+
+def download_document(request, user: User, pk: AnyStr) -> HttpResponseBase:
+    instance = operations.get_document(user, pk, shared=True)
+    return operations.download_document(request, instance, user)
+
+
+@token_authenticated
+async def document_list(request) -> HttpResponseBase:
+    """POST: Create a document, as DocumentViewSet."""
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    return await run(request, create_document)
+
+
+@token_authenticated
+async def document_detail(request, pk: AnyStr) -> HttpResponseBase:
+    """PATCH: Edit the document, for the Owner and the Shared Users."""
+    if request.method != "PATCH":
+        return HttpResponseNotAllowed(["PATCH"])
+    return await run(request, update_document, pk)
+
+
+@token_authenticated
+async def document_share(request, pk: AnyStr) -> HttpResponseBase:
+    """POST: Share the document with the users, for the Owner."""
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    return await run(request, share_document, pk)
+
+
+@token_authenticated
+async def document_download(request, pk: AnyStr) -> HttpResponseBase:
+    """GET: Stream the file. HEAD: Its headers only."""
+    if request.method not in ("GET", "HEAD"):
+        return HttpResponseNotAllowed(["GET", "HEAD"])
+    return await run(request, download_document, pk)
@@ -0,0 +1,78 @@
+"""
+The document operations shared by DocumentViewSet and the async views: the
+access checks, the operations and the logging of their activity.
+"""
+
+from typing import AnyStr, List, NoReturn, Optional
+
+from django.db.models import QuerySet
+from django.http.response import HttpResponseBase
+
+from rest_framework.exceptions import NotFound
+
+from apps.store.access import get_accessible_document_ids, is_accessible
+from apps.store.models import Activity, Document, User
+from apps.utils.downloads import serve_file
+from apps.utils.profiling import instrument
+
+
+def get_document_queryset(
+    user: User, shared: bool, pk: Optional[AnyStr] = None
+) -> QuerySet:
+    """
+    The documents of the owner, or also the ones shared with the user: by
+    the cached ids when possible. Of a detail action, the pk is checked.
+    """
+    if not shared:
+        return Document.objects.owned_by(user)
+
+    document_ids = get_accessible_document_ids(user)
+    if document_ids is None:
+        return Document.objects.accessible_by(user)
+    if pk is not None:
+        # A membership check instead of a join
+        if not is_accessible(document_ids, pk):
+            return Document.objects.none()
+        return Document.objects.filter(pk=pk)
+    return Document.objects.filter(id__in=document_ids)
+
+
+@instrument("access")
+def get_document(user: User, pk: AnyStr, shared: bool) -> Document:
+    """The document of the owner, or also of a shared user."""
+    try:
+        return get_document_queryset(user, shared, pk).get(pk=pk)
+    except Document.DoesNotExist:
+        raise NotFound
+
+
+def share_document(
+    instance: Document, user: User, user_ids: List[AnyStr]
+) -> NoReturn:
+    """Share the document with the users, logged when one was added."""
+    if instance.add_shared_users(user_ids):
+        # Log the share operation
+        instance.log_activity(user, Activity.Operation.SHARE)
+
+
+def download_document(
+    request, instance: Document, user: User
+) -> HttpResponseBase:
+    """
+    Stream the file, with Range and conditional GET support. HEAD: Its
+    headers only.
+    """
+    if not instance.file:
+        raise NotFound("The document has no file.")
+
+    response = serve_file(
+        request,
+        instance.get_file_paths(),
+        instance.file.name,
+        instance.updated_at,
+    )
+    # Bytes were sent
+    if request.method == "GET" and response.status_code in (200, 206):
+        # Record the download operation, the file is left as it is
+        instance.record_activity(user, Activity.Operation.DOWNLOAD)
+    return response
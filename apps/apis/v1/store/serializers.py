@@ -1,8 +1,43 @@
-from typing import AnyStr
+from typing import AnyStr, Optional, Set
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Manager
 
 from rest_framework import serializers
 
-from apps.store.models import Document, User
+from apps.store.models import (
+    Activity,
+    Document,
+    DocumentVersion,
+    UploadSession,
+    User,
+)
+from apps.store.search import tokenize
+from apps.utils.caching import get_response_cache
+from apps.utils.profiling import instrument
+
+
+class DocumentListSerializer(serializers.ListSerializer):
+    """Reads the cached representations in one round trip."""
+
+    @instrument("serialize")
+    def to_representation(self, data):
+        cache = get_response_cache()
+        if cache is None:
+            return super().to_representation(data)
+
+        instances = data.all() if isinstance(data, Manager) else data
+        keys = [self.child.get_cache_key(instance) for instance in instances]
+        cached = cache.get_many(keys)
+        missing = {
+            key: self.child.to_uncached_representation(instance)
+            for key, instance in zip(keys, instances)
+            if key not in cached
+        }
+        if missing:
+            cache.set_many(missing, settings.RESPONSE_CACHE["TTL"])
+        return [cached.get(key) or missing[key] for key in keys]
 
 
 class DocumentSerializer(serializers.ModelSerializer):
@@ -15,6 +50,72 @@ class DocumentSerializer(serializers.ModelSerializer):
             # Because the field is captured while saving the serializer
             "owner": {"required": False}
         }
+        list_serializer_class = DocumentListSerializer
+
+    fields_query_param = "fields"
+
+    def __init__(self, *args, **kwargs):
+        """
+        Sparse fieldset: ?fields=id,owner renders these fields only, the
+        others are not computed, eg: the file_url.
+        """
+        super().__init__(*args, **kwargs)
+        names = self.get_requested_fields(self.context.get("request"))
+        if names is None:
+            return
+
+        for name in set(self.fields) - names:
+            self.fields.pop(name)
+
+    @classmethod
+    def get_requested_fields(cls, request) -> Optional[Set[AnyStr]]:
+        """
+        The fields of the sparse fieldset of the request, None: all of them.
+        Checked by the views before the action, see DocumentViewSet.initial.
+        """
+        requested = (
+            request.query_params.get(cls.fields_query_param)
+            if request is not None
+            else None
+        )
+        if not requested:
+            return None
+
+        names = {name.strip() for name in requested.split(",")}
+        unknown = names - set(cls.Meta.fields)
+        if unknown:
+            raise serializers.ValidationError(
+                {cls.fields_query_param: f"Unknown fields: {sorted(unknown)}"}
+            )
+        return names
+
+    def get_cache_key(self, instance: Document) -> AnyStr:
+        """
+        The version of the document, and the fields of a sparse fieldset.
+        The representation is the same for all the users, the key needs no
+        user.
+        """
+        key = f"document-data:{instance.pk}:{instance.updated_at.timestamp()}"
+        if set(self.fields) != set(self.Meta.fields):
+            key += f":{','.join(sorted(self.fields))}"
+        return key
+
+    @instrument("serialize")
+    def to_representation(self, instance):
+        """Cached by the version of the document, see RESPONSE_CACHE."""
+        cache = get_response_cache()
+        if cache is None:
+            return self.to_uncached_representation(instance)
+
+        key = self.get_cache_key(instance)
+        data = cache.get(key)
+        if data is None:
+            data = self.to_uncached_representation(instance)
+            cache.set(key, data, settings.RESPONSE_CACHE["TTL"])
+        return data
+
+    def to_uncached_representation(self, instance):
+        return super().to_representation(instance)
 
     def create(self, validated_data):
         """
@@ -24,13 +125,17 @@ class DocumentSerializer(serializers.ModelSerializer):
         In order to call the associated methods after the has been instance
         created.
         """
-        instance = super().create(validated_data)
-
-        # Create file object
-        instance.create_document()
+        # The empty content is shared, downloadable once created. Its
+        # reference is counted along with the row
+        with transaction.atomic():
+            validated_data["file"] = Document.save_empty_content()
+            instance = super().create(validated_data)
 
-        # Since file object is created
-        instance.refresh_from_db()
+        # Index and log the upload, in the background
+        instance.enqueue_file_operation(
+            "store.create_document_file",
+            idempotency_key=f"create-document:{instance.id}",
+        )
         return instance
 
     def update(self, instance, validated_data):
@@ -43,22 +148,138 @@ class DocumentSerializer(serializers.ModelSerializer):
         """
         instance = super().update(instance, validated_data)
         api_caller: User = self.context.get("api_caller")
-        user_type: AnyStr = instance.get_user_type(api_caller)
-        operation: AnyStr = "Edit"
+        operation: AnyStr = Activity.Operation.EDIT
 
         if (
             self.partial is False
         ):  # This is a re-upload ie, if partial is False
-            operation = "Upload"
+            operation = Activity.Operation.UPLOAD
 
-            # Truncate the file content
-            instance.truncate_the_file_content()
+            # Truncate the file content, in the background
+            instance.enqueue_file_operation(
+                "store.truncate_document_file",
+                idempotency_key=(
+                    f"truncate-document:{instance.id}:"
+                    f"{instance.updated_at.timestamp()}"
+                ),
+            )
 
         # Log the edit operation
-        instance.append_content_to_file(f"{user_type} - {operation}")
+        instance.log_activity(api_caller, operation)
         return instance
 
 
+class ActivitySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Activity
+        fields = ("id", "actor", "actor_type", "operation", "timestamp")
+
+
+class DocumentVersionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DocumentVersion
+        fields = ("number", "size", "digest", "created_at")
+
+
+class ActivityFilterSerializer(serializers.Serializer):
+    """Optional filters of the activity history."""
+
+    operation = serializers.ChoiceField(
+        choices=Activity.Operation.choices, required=False
+    )
+    actor = serializers.CharField(min_length=1, required=False)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+
+
+class SearchSerializer(serializers.Serializer):
+    """Expects the terms to search, all of them are matched."""
+
+    q = serializers.CharField(max_length=256)
+
+    def validate_q(self, value):
+        if not tokenize(value):
+            raise serializers.ValidationError("No term to search.")
+        return value
+
+
+class DocumentFilterSerializer(serializers.Serializer):
+    """Optional filters and ordering of the document list."""
+
+    SCOPES = ("all", "owned", "shared")
+    ORDERINGS = ("-created_at", "created_at", "-updated_at", "updated_at")
+
+    scope = serializers.ChoiceField(choices=SCOPES, default="all")
+    created_after = serializers.DateTimeField(required=False)
+    created_before = serializers.DateTimeField(required=False)
+    updated_after = serializers.DateTimeField(required=False)
+    updated_before = serializers.DateTimeField(required=False)
+    ordering = serializers.ChoiceField(choices=ORDERINGS, required=False)
+
+
+class ChangesFilterSerializer(serializers.Serializer):
+    """The cursor of the changes feed, the last sequence number read."""
+
+    since = serializers.IntegerField(min_value=0, required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=100)
+
+
+class BulkCreateSerializer(serializers.Serializer):
+    """Expects the number of documents to create."""
+
+    count = serializers.IntegerField(min_value=1, max_value=1000)
+
+
+class BulkShareSerializer(serializers.Serializer):
+    """Expects the documents and the users to share them with."""
+
+    document_ids = serializers.ListField(
+        child=serializers.CharField(min_length=1),
+        allow_empty=False,
+        max_length=10000,
+    )
+    user_ids = serializers.ListField(
+        child=serializers.CharField(min_length=1),
+        allow_empty=False,
+        max_length=1000,
+    )
+
+
+class UploadStartSerializer(serializers.Serializer):
+    """Expects the size of the file, and optionally its SHA-256."""
+
+    size = serializers.IntegerField(min_value=1)
+    checksum = serializers.RegexField(
+        r"^[0-9a-f]{64}$", required=False, default=""
+    )
+
+    def validate_size(self, value: int) -> int:
+        if value > settings.UPLOADS["MAX_SIZE"]:
+            raise serializers.ValidationError(
+                f"At most {settings.UPLOADS['MAX_SIZE']} bytes."
+            )
+        return value
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    # The received [start, end) ranges, the missing ones are to be sent
+    received = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = (
+            "id",
+            "size",
+            "checksum",
+            "expires_at",
+            "status",
+            "received",
+        )
+
+    def get_received(self, instance: UploadSession):
+        return [[start, end] for start, end in instance.get_received_ranges()]
+
+
 class StringListSerializer(serializers.Serializer):
     """Expects a list of strings."""
 
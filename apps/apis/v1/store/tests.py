@@ -1,13 +1,59 @@
+import base64
+import hashlib
+import os
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework.authtoken.models import Token
 
 from apps.store.factory import (
     DocumentFactory,
     UserFactory,
     UserDocumentFactory,
 )
-from apps.store.models import Document
+from apps.store.activity import get_activity_log_writer
+from apps.store.models import (
+    Activity,
+    Document,
+    DocumentChange,
+    DocumentVersion,
+    SearchEntry,
+    SearchTerm,
+    UploadSession,
+    User,
+    UserDocument,
+    read_files,
+)
+from apps.apis.v1.store.serializers import DocumentSerializer
+from apps.utils.asgi import ASGIHandler
+from apps.utils.authentication import TokenUserCache, get_token_user_cache
+from apps.utils.profiling import metrics
+from apps.utils.routers import read_from_replica
+from apps.utils.models import Blob, QueuedTask
 from apps.utils.tests import APITest
 
+# The content shared by the empty documents, its SHA-256
+EMPTY_FILE_URL = (
+    "/documents/blobs/e3/b0/"
+    "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855.txt"
+)
+
+
+def read_document_file(document: Document) -> bytes:
+    """The file of the document as downloaded, its activity lines included."""
+    return b"".join(read_files(document.get_file_paths(), 1024 * 1024))
+
 
 class DocumentAPITest(APITest):
     @classmethod
@@ -132,6 +178,211 @@ class DocumentAPITest(APITest):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), expected_response)
 
+    def test_list_several_collaborators(self):
+        # Arrange
+        user1, user2 = UserFactory(), UserFactory()
+        UserDocumentFactory(user=user1, document=self.default)
+        UserDocumentFactory(user=user2, document=self.default)
+        UserDocumentFactory(user=self.default.owner, document=self.default)
+
+        for user in (self.default.owner, user1):
+            self.client.credentials(
+                HTTP_AUTHORIZATION=self.get_auth_header(user)
+            )
+
+            # Act
+            response = self.client.get(self.list_url)
+
+            # Assert: No duplicates
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["count"], 1)
+            self.assertEqual(
+                [row["id"] for row in response.json()["results"]],
+                [self.default.id],
+            )
+
+    def test_list_filters(self):
+        # Arrange
+        owner = self.default.owner
+        self.client.credentials(HTTP_AUTHORIZATION=self.get_auth_header(owner))
+        shared = DocumentFactory()
+        UserDocumentFactory(user=owner, document=shared)
+        old = DocumentFactory(owner=owner)
+        Document.objects.filter(id=old.id).update(
+            created_at=timezone.now() - timezone.timedelta(days=10),
+            updated_at=timezone.now() - timezone.timedelta(days=5),
+        )
+        since = (timezone.now() - timezone.timedelta(days=7)).isoformat()
+        recent = (timezone.now() - timezone.timedelta(days=1)).isoformat()
+
+        def get_ids(**params):
+            response = self.client.get(self.list_url, params)
+            self.assertEqual(response.status_code, 200, response.data)
+            return sorted(row["id"] for row in response.json()["results"])
+
+        # Act
+        results = get_ids(scope="owned")
+        results2 = get_ids(scope="shared")
+        results3 = get_ids(created_after=since)
+        results4 = get_ids(created_before=since, pagination="cursor")
+        results5 = get_ids(updated_before=recent)
+        results6 = get_ids(scope="owned", updated_after=recent)
+
+        # Assert
+        self.assertEqual(results, sorted([self.default.id, old.id]))
+        self.assertEqual(results2, [shared.id])
+        self.assertEqual(results3, sorted([self.default.id, shared.id]))
+        self.assertEqual(results4, [old.id])
+        self.assertEqual(results5, [old.id])
+        self.assertEqual(results6, [self.default.id])
+
+        # Case 2: Invalid
+        # Act
+        response = self.client.get(self.list_url, {"scope": "all-of-them"})
+        response2 = self.client.get(self.list_url, {"created_after": "then"})
+
+        # Assert
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response2.status_code, 400)
+
+    def test_list_ordering(self):
+        # Arrange
+        owner = self.default.owner
+        self.client.credentials(HTTP_AUTHORIZATION=self.get_auth_header(owner))
+        documents = [
+            self.default,
+            *DocumentFactory.create_batch(2, owner=owner),
+        ]
+        # Updated in the reverse creation order
+        for days, document in enumerate(documents):
+            Document.objects.filter(id=document.id).update(
+                updated_at=timezone.now() - timezone.timedelta(days=days)
+            )
+        expected_ids = [document.id for document in documents]
+
+        # Act
+        response = self.client.get(self.list_url, {"ordering": "-updated_at"})
+        response2 = self.client.get(
+            self.list_url,
+            {"ordering": "updated_at", "pagination": "cursor", "limit": 2},
+        )
+        response3 = self.client.get(response2.json()["next"])
+
+        # Assert: Across the pages of the cursor too
+        self.assertEqual(
+            [row["id"] for row in response.json()["results"]], expected_ids
+        )
+        self.assertEqual(
+            [
+                row["id"]
+                for response in (response2, response3)
+                for row in response.json()["results"]
+            ],
+            expected_ids[::-1],
+        )
+
+    def test_sparse_fields(self):
+        # Arrange
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.default.owner)
+        )
+
+        # Act
+        response = self.client.get(self.list_url, {"fields": "id,owner"})
+        response2 = self.client.get(self.default_url, {"fields": "id"})
+        response3 = self.client.get(self.list_url, {"fields": "id,secret"})
+
+        # Assert
+        self.assertEqual(
+            response.json()["results"],
+            [{"id": self.default.id, "owner": self.default.owner_id}],
+        )
+        self.assertEqual(response2.json(), {"id": self.default.id})
+        self.assertEqual(response3.status_code, 400)
+
+        # Case 2: Unknown, checked before the share
+        # Arrange
+        share_url = reverse(
+            "store-v1:document-share", kwargs={"pk": self.default.id}
+        )
+
+        # Act
+        response = self.client.post(
+            f"{share_url}?fields=secret", {"id_list": [UserFactory().id]}
+        )
+
+        # Assert
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(self.default.shared_users.exists())
+
+        # Case 3: Cached apart from the whole representations
+        # Act
+        with override_settings(
+            RESPONSE_CACHE={**settings.RESPONSE_CACHE, "BACKEND": "default"}
+        ):
+            response = self.client.get(self.default_url, {"fields": "id"})
+            response2 = self.client.get(self.default_url)
+
+        # Assert
+        self.assertEqual(response.json(), {"id": self.default.id})
+        self.assertIn("file_url", response2.json())
+
+    def test_list_pagination_modes(self):
+        # Arrange
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.default.owner)
+        )
+        DocumentFactory.create_batch(2, owner=self.default.owner)
+        expected_ids = list(
+            Document.objects.filter(owner=self.default.owner)
+            .order_by("-created_at", "-id")
+            .values_list("id", flat=True)
+        )
+
+        # Case 1: Cursor
+        # Act
+        response = self.client.get(
+            self.list_url, data={"pagination": "cursor", "limit": 2}
+        )
+        next_response = self.client.get(response.json()["next"])
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(next_response.status_code, 200)
+        self.assertNotIn("count", response.json())
+        self.assertIsNone(next_response.json()["next"])
+        self.assertEqual(
+            [
+                row["id"]
+                for row in response.json()["results"]
+                + next_response.json()["results"]
+            ],
+            expected_ids,
+        )
+
+        # Case 2: Page number without the count
+        # Act
+        response = self.client.get(
+            self.list_url, data={"count": "false", "limit": 2}
+        )
+        next_response = self.client.get(response.json()["next"])
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.json()["count"])
+        self.assertIsNone(response.json()["previous"])
+        self.assertEqual(len(response.json()["results"]), 2)
+        self.assertIsNone(next_response.json()["next"])
+        self.assertIsNotNone(next_response.json()["previous"])
+        self.assertEqual(len(next_response.json()["results"]), 1)
+
+        # Case 3: Invalid mode
+        # Act
+        response = self.client.get(self.list_url, data={"pagination": "x"})
+
+        # Assert
+        self.assertEqual(response.status_code, 404)
+
     def test_detail(self):
         # Case 1: Owner
         # Arrange
@@ -194,7 +445,7 @@ class DocumentAPITest(APITest):
         expected_response = {
             **base_response,
             "id": document_id,
-            "file_url": f"/documents/{document_id}.txt",
+            "file_url": EMPTY_FILE_URL,
         }
 
         # Assert
@@ -206,6 +457,73 @@ class DocumentAPITest(APITest):
             ).exists()
         )
 
+    def test_bulk(self):
+        # Case 1: All created
+        # Arrange
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.default.owner)
+        )
+        url = reverse("store-v1:document-bulk")
+
+        # Act
+        response = self.client.post(url, data={"count": 3})
+
+        # Assert
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual(data["errors"], [])
+        self.assertEqual(len(data["results"]), 3)
+        for row in data["results"]:
+            self.assertEqual(row["owner"], self.default.owner_id)
+            # The empty content is shared
+            self.assertEqual(row["file_url"], EMPTY_FILE_URL)
+            document = Document.objects.get(id=row["id"])
+            self.assertTrue(
+                read_document_file(document).endswith(b"Owner - Upload \n")
+            )
+            self.assertTrue(
+                document.activities.filter(operation="Upload").exists()
+            )
+
+        # Assert: Indexed in bulk
+        response2 = self.client.get(
+            reverse("store-v1:document-search"), {"q": "owner upload"}
+        )
+        self.assertLessEqual(
+            {row["id"] for row in data["results"]},
+            {row["id"] for row in response2.data["results"]},
+        )
+
+        # Case 2: Partially created
+        # Arrange
+        writer = get_activity_log_writer()
+        write = writer.write
+        calls = []
+
+        def failing_write(path, lines):
+            calls.append(path)
+            if len(calls) == 2:
+                raise OSError("Disk full")
+            return write(path, lines)
+
+        # Act
+        with mock.patch.object(writer, "write", side_effect=failing_write):
+            response = self.client.post(url, data={"count": 3})
+
+        # Assert
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(
+            response.json()["errors"], [{"index": 1, "detail": "Disk full"}]
+        )
+        self.assertEqual(len(response.json()["results"]), 2)
+
+        # Case 3: Invalid count
+        # Act
+        response = self.client.post(url, data={"count": 0})
+
+        # Assert
+        self.assertEqual(response.status_code, 400)
+
     def test_share(self):
         # Case 1: First attempt
         # Arrange
@@ -233,6 +551,10 @@ class DocumentAPITest(APITest):
         self.assertTrue(self.default.shared_users.filter(id=user1.id).exists())
         # Only 1 user is present
         self.assertEqual(self.default.shared_users.count(), 1)
+        # Shared already, not logged
+        self.assertFalse(
+            self.default.activities.filter(operation="Share").exists()
+        )
 
         # Case 2: Try again
         # Arrange
@@ -260,6 +582,9 @@ class DocumentAPITest(APITest):
         self.assertTrue(self.default.shared_users.filter(id=user2.id).exists())
         # Only 2 users are present
         self.assertEqual(self.default.shared_users.count(), 2)
+        self.assertEqual(
+            self.default.activities.filter(operation="Share").count(), 1
+        )
 
         # Case 2: Non owner tries to share
         # Arrange
@@ -280,6 +605,64 @@ class DocumentAPITest(APITest):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(response.json(), expected_response)
 
+    def test_share_bulk(self):
+        # Case 1: First attempt
+        # Arrange
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.default.owner)
+        )
+        url = reverse("store-v1:document-share-bulk")
+        document = DocumentFactory(owner=self.default.owner)
+        user1, user2 = UserFactory(), UserFactory()
+        UserDocumentFactory(user=user1, document=self.default)
+        data = {
+            "document_ids": [self.default.id, document.id],
+            "user_ids": [user1.id, user2.id, "HHHHHHHHH"],  # Invalid ID
+        }
+
+        # Act
+        response = self.client.post(url, data=data)
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"created": 3})
+        for instance in (self.default, document):
+            self.assertEqual(
+                set(instance.shared_users.values_list("id", flat=True)),
+                {user1.id, user2.id},
+            )
+            self.assertTrue(
+                instance.activities.filter(operation="Share").exists()
+            )
+
+        # Case 2: Try again
+        # Act
+        response = self.client.post(url, data=data)
+
+        # Assert: Nothing new, not logged
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"created": 0})
+        self.assertEqual(self.default.shared_users.count(), 2)
+        self.assertEqual(
+            Activity.objects.filter(
+                document__in=[self.default, document], operation="Share"
+            ).count(),
+            2,
+        )
+
+        # Case 3: A document of another owner
+        # Arrange
+        other = DocumentFactory()
+        data["document_ids"].append(other.id)
+
+        # Act
+        response = self.client.post(url, data=data)
+
+        # Assert
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["document_ids"], [other.id])
+        self.assertFalse(other.shared_users.exists())
+
     def test_put(self):
         # Case 1: Owner
         # Arrange
@@ -300,7 +683,24 @@ class DocumentAPITest(APITest):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), expected_response)
 
-        # Case 2: Non owner
+        # Case 2: Truncated, the url of the new file
+        # Arrange
+        self.default.set_content(ContentFile(b"content"))
+        previous_url = self.default.file_url()
+
+        # Act
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(self.default_url, data=data)
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["file_url"], EMPTY_FILE_URL)
+        self.assertFalse(
+            self.default.file.storage.exists(self.default.file.name)
+        )
+        self.assertNotEqual(previous_url, EMPTY_FILE_URL)
+
+        # Case 3: Non owner
         # Arrange
         user1 = UserFactory()
         UserDocumentFactory(user=user1, document=self.default)
@@ -455,6 +855,143 @@ class DocumentAPITest(APITest):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), expected_response)
 
+    def test_download_file(self):
+        # Arrange
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.default.owner)
+        )
+        document = DocumentFactory(owner=self.default.owner)
+        document.create_document()
+        url = reverse("store-v1:document-download", kwargs={"pk": document.id})
+        content = read_document_file(document)
+
+        # Case 1: Whole file
+        # Act
+        response = self.client.get(url)
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), content)
+        self.assertEqual(response["Content-Length"], str(len(content)))
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        etag = response["ETag"]
+
+        # Case 2: Not modified, the download left the file as it is
+        # Act
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        # Assert
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(read_document_file(document), content)
+        self.assertEqual(
+            Activity.objects.filter(
+                document=document, operation=Activity.Operation.DOWNLOAD
+            ).count(),
+            1,
+        )
+
+        # Case 3: Range, resumed from the same version
+        # Act
+        response = self.client.get(
+            url, HTTP_RANGE="bytes=2-5", HTTP_IF_RANGE=etag
+        )
+
+        # Assert
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), content[2:6])
+        self.assertEqual(
+            response["Content-Range"], f"bytes 2-5/{len(content)}"
+        )
+        self.assertEqual(response["ETag"], etag)
+
+        # Case 4: Unsatisfiable range
+        # Act
+        response = self.client.get(url, HTTP_RANGE="bytes=100000-")
+
+        # Assert
+        self.assertEqual(response.status_code, 416)
+
+        # Case 5: Non shared User
+        # Arrange
+        user1 = UserFactory()
+        self.client.credentials(HTTP_AUTHORIZATION=self.get_auth_header(user1))
+
+        # Act
+        response = self.client.get(url)
+
+        # Assert
+        self.assertEqual(response.status_code, 404)
+
+    def test_activity(self):
+        # Case 1: Owner
+        # Arrange
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.default.owner)
+        )
+        url = reverse(
+            "store-v1:document-activity", kwargs={"pk": self.default.id}
+        )
+        download_url = reverse(
+            "store-v1:document-download", kwargs={"pk": self.default.id}
+        )
+        user1 = UserFactory()
+        UserDocumentFactory(user=user1, document=self.default)
+        self.client.post(download_url, data={})
+        self.client.patch(self.default_url, data={})
+        self.client.credentials(HTTP_AUTHORIZATION=self.get_auth_header(user1))
+        self.client.post(download_url, data={})
+
+        # Act
+        response = self.client.get(url, data={"limit": 2})
+
+        # Assert: Latest first
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(
+            [
+                (row["actor"], row["actor_type"], row["operation"])
+                for row in data["results"]
+            ],
+            [
+                (user1.id, "Collaborator", "Download"),
+                (self.default.owner_id, "Owner", "Edit"),
+            ],
+        )
+        self.assertIsNotNone(data["next"])
+
+        # Case 2: Next page
+        # Act
+        response = self.client.get(data["next"])
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(
+            [row["operation"] for row in data["results"]], ["Download"]
+        )
+        self.assertIsNone(data["next"])
+
+        # Case 3: Filtered
+        # Act
+        response = self.client.get(
+            url, data={"operation": "Download", "actor": user1.id}
+        )
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["results"]), 1)
+
+        # Case 4: Non shared User
+        # Arrange
+        user2 = UserFactory()
+        self.client.credentials(HTTP_AUTHORIZATION=self.get_auth_header(user2))
+
+        # Act
+        response = self.client.get(url)
+
+        # Assert
+        self.assertEqual(response.status_code, 404)
+
 
 class UserAPITest(APITest):
     @classmethod
@@ -613,3 +1150,1581 @@ class UserAPITest(APITest):
         # Assert
         self.assertEqual(response.status_code, 405)
         self.assertEqual(response.json(), expected_response)
+
+
+class DocumentStorageTest(APITest):
+    def test_deduplicated(self):
+        # Arrange
+        document1, document2 = DocumentFactory(), DocumentFactory()
+
+        # Act
+        document1.set_content(ContentFile(b"content"))
+        document2.set_content(ContentFile(b"content"))
+
+        # Assert: Stored once
+        self.assertEqual(document1.file.name, document2.file.name)
+        self.assertTrue(document1.file.name.startswith("documents/blobs/"))
+        path = document1.file.path
+
+        # Act: Logged, the shared content is left as is
+        document1.append_content_to_file("Owner - Edit")
+        document1.refresh_from_db()
+
+        # Assert
+        self.assertEqual(document1.file.name, document2.file.name)
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), b"content")
+        content = read_document_file(document1)
+        self.assertTrue(content.startswith(b"content"))
+        self.assertTrue(content.endswith(b"Owner - Edit \n"))
+        self.assertEqual(read_document_file(document2), b"content")
+
+        # Act: A reference is deleted
+        with self.captureOnCommitCallbacks(execute=True):
+            document2.delete()
+
+        # Assert: Still referred to
+        self.assertTrue(os.path.exists(path))
+
+        # Act: The last reference is deleted
+        log_path = document1.get_log_path()
+        with self.captureOnCommitCallbacks(execute=True):
+            document1.delete()
+
+        # Assert
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(log_path))
+
+    def test_reference_counted(self):
+        # Arrange
+        document1, document2 = DocumentFactory(), DocumentFactory()
+        document1.set_content(ContentFile(b"content"))
+        document2.set_content(ContentFile(b"content"))
+        storage, name = document1.file.storage, document1.file.name
+
+        # Case 1: Counted along with the rows
+        # Assert
+        self.assertEqual(Blob.objects.get(name=name).references, 2)
+
+        # Case 2: Stored again meanwhile, eg: by a save not committed yet
+        # Arrange
+        storage.reference(name)
+
+        # Act
+        with self.captureOnCommitCallbacks(execute=True):
+            document1.delete()
+            document2.delete()
+
+        # Assert: Kept for the new reference
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(Blob.objects.get(name=name).references, 1)
+
+        # Case 3: The last reference is released
+        # Act
+        with self.captureOnCommitCallbacks(execute=True):
+            storage.release(name)
+
+        # Assert
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(Blob.objects.filter(name=name).exists())
+
+    def test_download_range(self):
+        # Arrange: The range spans the content and the activity lines
+        document = DocumentFactory()
+        document.set_content(ContentFile(b"content"))
+        document.append_content_to_file("Owner - Edit")
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(document.owner)
+        )
+        url = reverse("store-v1:document-download", kwargs={"pk": document.id})
+        content = read_document_file(document)
+
+        # Act
+        response = self.client.get(url, HTTP_RANGE="bytes=4-10")
+
+        # Assert
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), content[4:11])
+        self.assertEqual(
+            response["Content-Range"], f"bytes 4-10/{len(content)}"
+        )
+
+    def test_migrate_document_files(self):
+        # Arrange
+        document1, document2 = DocumentFactory(), DocumentFactory()
+        storage = document1.file.storage
+        for document in (document1, document2):
+            document.file = storage.save(
+                f"documents/{document.id}.txt", ContentFile(b"content")
+            )
+            document.save()
+        path = document1.file.path
+
+        # Act
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("migrate_document_files", stdout=StringIO())
+
+        # Assert: Stored once
+        document1.refresh_from_db()
+        document2.refresh_from_db()
+        self.assertTrue(document1.file.name.startswith("documents/blobs/"))
+        self.assertEqual(document1.file.name, document2.file.name)
+        with document1.file.open("rb") as file:
+            self.assertEqual(file.read(), b"content")
+        self.assertFalse(os.path.exists(path))
+
+
+class CachedTokenAuthenticationTest(APITest):
+    @classmethod
+    def setUpTestData(cls):
+        """Setup base data for tests."""
+        super().setUpTestData()
+        cls.default = UserFactory()  # Default instance
+        cls.url = reverse(
+            "store-v1:user-detail", kwargs={"pk": cls.default.id}
+        )
+
+    def setUp(self):
+        super().setUp()
+        get_token_user_cache().clear()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.default)
+        )
+
+    def test_cached(self):
+        # Arrange: First request resolves the token
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+        # Act: Cached, only the user detail query
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+
+    def test_token_deleted(self):
+        # Arrange
+        self.client.get(self.url)
+
+        # Act
+        Token.objects.filter(user=self.default).delete()
+        response = self.client.get(self.url)
+
+        # Assert
+        self.assertEqual(response.status_code, 401)
+
+    def test_shared(self):
+        # Arrange: The caches of two processes, on the same shared cache
+        first = TokenUserCache(max_size=10, ttl=60, backend="default")
+        second = TokenUserCache(max_size=10, ttl=60, backend="default")
+        first.set("key", self.default)
+        self.assertEqual(second.get("key"), self.default)
+
+        # Act: The token is deleted by the first one
+        first.delete("key")
+
+        # Assert: At once for the other one
+        self.assertIsNone(second.get("key"))
+
+    def test_user_deactivated(self):
+        # Arrange
+        self.client.get(self.url)
+
+        # Act
+        self.default.is_active = False
+        self.default.save()
+        response = self.client.get(self.url)
+
+        # Assert
+        self.assertEqual(response.status_code, 401)
+
+    def test_user_saved(self):
+        # Arrange
+        self.client.get(self.url)
+        user = User.objects.get(id=self.default.id)
+
+        # Act: No auth field changed, the tokens are not queried
+        user.first_name = "Name"
+        with self.assertNumQueries(1):
+            user.save()
+
+        # Assert: Still cached
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+
+class ReplicaRoutingTest(APITest):
+    @classmethod
+    def setUpTestData(cls):
+        """Setup base data for tests."""
+        super().setUpTestData()
+        cls.default = DocumentFactory()  # Default instance
+        cls.list_url = reverse("store-v1:document-list")
+        cls.user_url = reverse(
+            "store-v1:user-detail", kwargs={"pk": cls.default.owner_id}
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.default.owner)
+        )
+        # Headers of the ASGI requests, by their names
+        self.async_auth = {
+            "AUTHORIZATION": self.get_auth_header(self.default.owner)
+        }
+
+    def test_routing(self):
+        with mock.patch(
+            "apps.utils.middleware.read_from_replica",
+            wraps=read_from_replica,
+        ) as replica:
+            # Case 1: Safe methods, from a replica
+            # Act
+            response = self.client.get(self.list_url)
+            response2 = self.client.get(self.user_url)
+
+            # Assert
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response2.status_code, 200)
+            self.assertEqual(replica.call_count, 2)
+
+            # Case 2: Create, from the primary
+            # Act
+            response = self.client.post(self.list_url)
+
+            # Assert
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(replica.call_count, 2)
+
+    async def test_routing_async(self):
+        with mock.patch(
+            "apps.utils.middleware.read_from_replica",
+            wraps=read_from_replica,
+        ) as replica:
+            # Act: Under ASGI, the view middleware runs in a thread
+            response = await AsyncClient().get(
+                self.list_url, **self.async_auth
+            )
+
+            # Assert
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(replica.call_count, 1)
+
+    @override_settings(DATABASE_REPLICAS=["default"])
+    def test_read_your_writes(self):
+        caches[settings.READ_YOUR_WRITES["CACHE"]].clear()
+        with mock.patch(
+            "apps.utils.middleware.read_from_replica",
+            wraps=read_from_replica,
+        ) as replica:
+            # Arrange: A write of the user
+            response = self.client.post(self.list_url)
+            self.assertEqual(response.status_code, 201)
+
+            # Act
+            response = self.client.get(self.list_url)
+
+            # Assert: Pinned to the primary, the new document is listed
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(replica.call_count, 0)
+            self.assertEqual(response.data["count"], 2)
+
+            # Act: Another user
+            self.client.credentials(
+                HTTP_AUTHORIZATION=self.get_auth_header(UserFactory())
+            )
+            response = self.client.get(self.list_url)
+
+            # Assert: Not pinned
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(replica.call_count, 1)
+
+
+class AccessibleDocumentCacheTest(APITest):
+    @classmethod
+    def setUpTestData(cls):
+        """Setup base data for tests."""
+        super().setUpTestData()
+        cls.default = DocumentFactory()  # Default instance
+        cls.collaborator = UserFactory()
+        cls.list_url = reverse("store-v1:document-list")
+        cls.default_url = reverse(
+            "store-v1:document-detail", kwargs={"pk": cls.default.id}
+        )
+        cls.share_url = reverse(
+            "store-v1:document-share", kwargs={"pk": cls.default.id}
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.collaborator)
+        )
+
+    def test_invalidation(self):
+        # Case 1: Not shared yet, cached
+        # Act
+        response = self.client.get(self.list_url)
+
+        # Assert
+        self.assertEqual(response.data["count"], 0)
+
+        # Case 2: Shared, by the bulk insert
+        # Act
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.default.owner)
+        )
+        self.client.post(self.share_url, {"id_list": [self.collaborator.id]})
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.collaborator)
+        )
+        response = self.client.get(self.list_url)
+        response2 = self.client.get(self.default_url)
+
+        # Assert
+        self.assertEqual(response.data["count"], 1)
+        self.assertEqual(response2.status_code, 200)
+
+        # Case 3: Unshared
+        # Act
+        UserDocument.objects.filter(user=self.collaborator).delete()
+        response = self.client.get(self.default_url)
+
+        # Assert
+        self.assertEqual(response.status_code, 404)
+
+        # Case 4: A new document of the user
+        # Act
+        DocumentFactory(owner=self.collaborator)
+        response = self.client.get(self.list_url)
+
+        # Assert
+        self.assertEqual(response.data["count"], 1)
+
+    def test_membership(self):
+        # Arrange: Cached
+        UserDocumentFactory(user=self.collaborator, document=self.default)
+        self.client.get(self.list_url)
+
+        # Act
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.default_url)
+
+        # Assert: No join on the shares
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(
+            any(
+                "store_userdocument" in query["sql"]
+                for query in queries.captured_queries
+            )
+        )
+
+
+class ConditionalRequestTest(APITest):
+    @classmethod
+    def setUpTestData(cls):
+        """Setup base data for tests."""
+        super().setUpTestData()
+        cls.default = DocumentFactory()  # Default instance
+        cls.list_url = reverse("store-v1:document-list")
+        cls.default_url = reverse(
+            "store-v1:document-detail", kwargs={"pk": cls.default.id}
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.default.owner)
+        )
+
+    def test_retrieve(self):
+        # Arrange
+        response = self.client.get(self.default_url)
+        etag = response["ETag"]
+
+        # Case 1: Same version
+        # Act
+        with mock.patch.object(
+            DocumentSerializer, "to_representation"
+        ) as to_representation:
+            response = self.client.get(
+                self.default_url, HTTP_IF_NONE_MATCH=etag
+            )
+
+        # Assert: Not serialized
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        to_representation.assert_not_called()
+
+        # Case 2: Updated
+        # Act
+        self.client.patch(self.default_url)
+        response = self.client.get(self.default_url, HTTP_IF_NONE_MATCH=etag)
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_list(self):
+        # Arrange
+        response = self.client.get(self.list_url)
+        etag = response["ETag"]
+
+        # Case 1: Same version
+        # Act
+        response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+
+        # Assert
+        self.assertEqual(response.status_code, 304)
+
+        # Case 2: New document
+        # Act
+        DocumentFactory(owner=self.default.owner)
+        response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["count"], 2)
+
+    @override_settings(
+        RESPONSE_CACHE={**settings.RESPONSE_CACHE, "BACKEND": "default"}
+    )
+    def test_response_cache(self):
+        # Arrange
+        DocumentFactory(owner=self.default.owner)
+        with mock.patch.object(
+            DocumentSerializer,
+            "to_uncached_representation",
+            autospec=True,
+            side_effect=DocumentSerializer.to_uncached_representation,
+        ) as serialize:
+            self.client.get(self.list_url)
+
+            # Act
+            response = self.client.get(self.list_url)
+            response2 = self.client.get(self.default_url)
+
+            # Assert: Serialized once per document
+            self.assertEqual(response.data["count"], 2)
+            self.assertEqual(response2.data["id"], self.default.id)
+            self.assertEqual(serialize.call_count, 2)
+
+            # Act: Updated, a new version
+            self.client.patch(self.default_url)
+            response = self.client.get(self.default_url)
+
+            # Assert
+            self.assertEqual(serialize.call_count, 3)
+
+
+class AsyncDocumentAPITest(APITest):
+    @classmethod
+    def setUpTestData(cls):
+        """Setup base data for tests."""
+        super().setUpTestData()
+        cls.default = DocumentFactory()  # Default instance
+        cls.default.create_document()
+        cls.collaborator = UserFactory()
+        cls.list_url = reverse("store-v1:async-document-list")
+        cls.default_url = reverse(
+            "store-v1:async-document-detail", kwargs={"pk": cls.default.id}
+        )
+        cls.share_url = reverse(
+            "store-v1:async-document-share", kwargs={"pk": cls.default.id}
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.async_client = AsyncClient()
+        # Headers of the ASGI requests, by their names
+        self.owner_auth = {
+            "AUTHORIZATION": self.get_auth_header(self.default.owner)
+        }
+        self.collaborator_auth = {
+            "AUTHORIZATION": self.get_auth_header(self.collaborator)
+        }
+
+    async def test_no_auth(self):
+        # Act
+        response = await self.async_client.post(self.list_url)
+
+        # Assert
+        self.assertEqual(response.status_code, 401)
+
+    async def test_post(self):
+        # Act
+        response = await self.async_client.post(
+            self.list_url,
+            {},
+            content_type="application/json",
+            **self.owner_auth,
+        )
+
+        # Assert
+        self.assertEqual(response.status_code, 201)
+        document = await sync_to_async(Document.objects.get)(
+            id=response.json()["id"]
+        )
+        self.assertTrue(document.file)
+
+    async def test_patch_share(self):
+        # Case 1: Not shared yet
+        # Act
+        response = await self.async_client.patch(
+            self.default_url, **self.collaborator_auth
+        )
+
+        # Assert
+        self.assertEqual(response.status_code, 404)
+
+        # Case 2: Shared
+        # Act
+        response = await self.async_client.post(
+            self.share_url,
+            {"id_list": [self.collaborator.id]},
+            content_type="application/json",
+            **self.owner_auth,
+        )
+        response2 = await self.async_client.patch(
+            self.default_url, **self.collaborator_auth
+        )
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response2.status_code, 200)
+
+        # Case 3: Invalid
+        # Act
+        response = await self.async_client.post(
+            self.share_url,
+            {},
+            content_type="application/json",
+            **self.owner_auth,
+        )
+
+        # Assert
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("id_list", response.json())
+
+    async def test_download(self):
+        # Act
+        response = await self.async_client.get(
+            reverse(
+                "store-v1:async-document-download",
+                kwargs={"pk": self.default.id},
+            ),
+            **self.owner_auth,
+        )
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+
+        # Act: Sent by the ASGI handler of the project
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await ASGIHandler().send_response(response, send)
+
+        # Assert
+        self.assertEqual(messages[0]["status"], 200)
+        content = b"".join(message.get("body", b"") for message in messages)
+        self.assertIn(b"Owner - Upload", content)
+
+
+@override_settings(TASKS={**settings.TASKS, "BACKEND": "database"})
+class BackgroundFileOperationTest(APITest):
+    def setUp(self):
+        super().setUp()
+        self.user = UserFactory()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.user)
+        )
+
+    def test_post_put(self):
+        # Act
+        response = self.client.post(reverse("store-v1:document-list"))
+
+        # Assert: The empty file is created at once, indexed by the worker
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["file_url"], EMPTY_FILE_URL)
+        download_url = reverse(
+            "store-v1:document-download", kwargs={"pk": response.data["id"]}
+        )
+        self.assertEqual(self.client.get(download_url).status_code, 200)
+
+        # Act
+        url = reverse(
+            "store-v1:document-detail", kwargs={"pk": response.data["id"]}
+        )
+        self.client.patch(url)
+        response2 = self.client.put(url)
+        call_command("run_tasks", "--once", stdout=StringIO())
+
+        # Assert: Accepted, the file being replaced has no url
+        self.assertEqual(response2.status_code, 202)
+        self.assertNotIn("file_url", response2.data)
+
+        # Assert: In the order of the requests
+        document = Document.objects.get(id=response.data["id"])
+        content = read_document_file(document).decode()
+        self.assertNotIn("Owner - Edit", content)
+        self.assertTrue(content.endswith("Owner - Upload \n"))
+
+    def test_log_line(self):
+        # Arrange
+        response = self.client.post(reverse("store-v1:document-list"))
+        call_command("run_tasks", "--once", stdout=StringIO())
+        url = reverse(
+            "store-v1:document-detail", kwargs={"pk": response.data["id"]}
+        )
+        count = QueuedTask.objects.count()
+
+        # Act
+        self.client.patch(url)
+
+        # Assert: No file operation pending, written at once
+        self.assertEqual(QueuedTask.objects.count(), count)
+        document = Document.objects.get(id=response.data["id"])
+        content = read_document_file(document).decode()
+        self.assertTrue(content.endswith("Owner - Edit \n"))
+
+
+class QueryBudgetTest(APITest):
+    # Once the token and the accessible ids are cached, see APITest
+    budgets = {
+        "document-list": {"queries": 2, "file_operations": 0},
+        "document-retrieve": {"queries": 1, "file_operations": 0},
+        # Update and its changes feed rows (2 queries), and activity. The
+        # line is indexed by a flush
+        "document-partial-update": {"queries": 5, "file_operations": 5},
+        # Activity, the file is read by the test
+        "document-download": {"queries": 2, "file_operations": 7},
+        "user-list": {"queries": 2, "file_operations": 0},
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        """Setup base data for tests."""
+        super().setUpTestData()
+        cls.user = UserFactory()
+        cls.documents = DocumentFactory.create_batch(60, owner=cls.user)
+        for document in cls.documents[:20]:
+            UserDocumentFactory.create_batch(3, document=document)
+        cls.default = cls.documents[0]
+        cls.default.create_document()
+        cls.list_url = reverse("store-v1:document-list")
+        cls.default_url = reverse(
+            "store-v1:document-detail", kwargs={"pk": cls.default.id}
+        )
+
+    def setUp(self):
+        super().setUp()
+        get_token_user_cache().clear()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.user)
+        )
+
+    def test_list(self):
+        # Case 1: The first call, also reads the token and the ids
+        # Act
+        with self.assertWithinBudget("document-list", queries=4):
+            response = self.client.get(self.list_url)
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+
+        # Case 2: No matter the page size and the pagination
+        for data in (
+            {"limit": 1},
+            {"limit": 50},
+            {"limit": 50, "page": 2},
+            {"limit": 1000, "pagination": "cursor"},
+        ):
+            # Act
+            with self.assertWithinBudget("document-list"):
+                response = self.client.get(self.list_url, data)
+
+            # Assert
+            self.assertEqual(response.status_code, 200)
+
+    def test_detail(self):
+        # Arrange: Cached
+        self.client.get(self.list_url)
+
+        # Act
+        with self.assertWithinBudget("document-retrieve"):
+            response = self.client.get(self.default_url)
+        with self.assertWithinBudget("document-partial-update"):
+            # Along with the changes, recorded once committed
+            with self.captureOnCommitCallbacks(execute=True):
+                response2 = self.client.patch(self.default_url)
+        with self.assertWithinBudget("document-download"):
+            response3 = self.client.get(
+                reverse(
+                    "store-v1:document-download",
+                    kwargs={"pk": self.default.id},
+                )
+            )
+            content = b"".join(response3.streaming_content)
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response2.status_code, 200)
+        self.assertIn(b"Owner - Edit", content)
+
+    def test_user_list(self):
+        # Arrange: Cached
+        self.client.get(self.list_url)
+
+        # Act
+        with self.assertWithinBudget("user-list"):
+            response = self.client.get(
+                reverse("store-v1:user-list"), {"limit": 1000}
+            )
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(
+    DOCUMENT_ACCESS_CACHE={**settings.DOCUMENT_ACCESS_CACHE, "BACKEND": None}
+)
+class UncachedQueryBudgetTest(QueryBudgetTest):
+    # As in the default settings: the access checks are subqueries on the
+    # shares, in place of the cached ids
+    budgets = {
+        "document-list": {"queries": 2, "file_operations": 0},
+        "document-retrieve": {"queries": 1, "file_operations": 0},
+        "document-partial-update": {"queries": 5, "file_operations": 5},
+        "document-download": {"queries": 2, "file_operations": 7},
+        "user-list": {"queries": 2, "file_operations": 0},
+    }
+
+
+@override_settings(
+    PROFILING={
+        **settings.PROFILING,
+        "SAMPLE_RATE": 1.0,
+        "METRICS_TOKEN": "metrics-token",
+    }
+)
+class ProfilingTest(APITest):
+    @classmethod
+    def setUpTestData(cls):
+        """Setup base data for tests."""
+        super().setUpTestData()
+        cls.default = DocumentFactory()  # Default instance
+        cls.default.create_document()
+        cls.default_url = reverse(
+            "store-v1:document-detail", kwargs={"pk": cls.default.id}
+        )
+
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.default.owner)
+        )
+        # Headers of the ASGI requests, by their names
+        self.async_auth = {
+            "AUTHORIZATION": self.get_auth_header(self.default.owner)
+        }
+
+    async def test_server_timing_async(self):
+        # Act
+        response = await AsyncClient().patch(
+            self.default_url, **self.async_auth
+        )
+
+        # Assert: Along with the thread of the view
+        self.assertEqual(response.status_code, 200)
+        timings = response["Server-Timing"]
+        self.assertIn("file-append", timings)
+        self.assertRegex(timings, r"db;dur=[\d.]+;desc=\"[1-9]\d* queries")
+
+    def test_server_timing(self):
+        # Case 1: Sampled
+        # Act
+        response = self.client.patch(self.default_url)
+
+        # Assert: The phases, the bytes of the log line
+        timings = {
+            entry.split(";")[0]: entry
+            for entry in response["Server-Timing"].split(", ")
+        }
+        self.assertTrue(
+            {
+                "total",
+                "db",
+                "auth",
+                "access",
+                "serialize",
+                "file-append",
+                "file-write",
+            }
+            <= set(timings)
+        )
+        self.assertRegex(
+            timings["file-write"], r"desc=\"\d+ queries \d+ bytes\""
+        )
+
+        # Case 2: Not sampled
+        # Act
+        with override_settings(
+            PROFILING={**settings.PROFILING, "SAMPLE_RATE": 0.0}
+        ):
+            response = self.client.patch(self.default_url)
+
+        # Assert
+        self.assertNotIn("Server-Timing", response)
+
+    def test_metrics(self):
+        # Arrange
+        self.client.get(self.default_url)
+        url = reverse("metrics")
+
+        # Case 1: No token
+        # Act
+        response = self.client.get(url)
+
+        # Assert
+        self.assertEqual(response.status_code, 401)
+
+        # Case 2: By the route
+        # Act
+        self.client.credentials()
+        response = self.client.get(
+            url, HTTP_AUTHORIZATION="Bearer metrics-token"
+        )
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn(
+            'doclib_phase_seconds_count{view="store-v1:document-detail",'
+            'phase="total"} 1',
+            content,
+        )
+        self.assertIn("doclib_lock_acquired_total", content)
+
+        # Case 3: Not served
+        # Act
+        with override_settings(
+            PROFILING={**settings.PROFILING, "METRICS_TOKEN": None}
+        ):
+            response = self.client.get(
+                url, HTTP_AUTHORIZATION="Bearer metrics-token"
+            )
+
+        # Assert
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(
+    DOCUMENT_VERSIONS={"CHUNK_SIZE": 16, "SNAPSHOT_INTERVAL": 3}
+)
+class DocumentVersionTest(APITest):
+    def setUp(self):
+        super().setUp()
+        self.document = DocumentFactory()
+        self.document.create_document()
+        self.collaborator = UserFactory()
+        UserDocumentFactory(user=self.collaborator, document=self.document)
+        self.detail_url = reverse(
+            "store-v1:document-detail", kwargs={"pk": self.document.id}
+        )
+        self.versions_url = reverse(
+            "store-v1:document-versions", kwargs={"pk": self.document.id}
+        )
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.document.owner)
+        )
+
+    def get_version_url(self, name, number):
+        return reverse(
+            f"store-v1:document-{name}",
+            kwargs={"pk": self.document.id, "number": number},
+        )
+
+    def read_file(self):
+        self.document.refresh_from_db()
+        return read_document_file(self.document)
+
+    def test_reupload(self):
+        # Arrange
+        before = self.read_file()
+
+        # Act
+        response = self.client.put(self.detail_url)
+        after = self.read_file()
+        response2 = self.client.get(self.versions_url)
+        response3 = self.client.get(
+            self.get_version_url("version-download", 1)
+        )
+
+        # Assert: The content before the truncate is kept
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [version["number"] for version in response2.data["results"]], [1]
+        )
+        self.assertEqual(response2.data["results"][0]["size"], len(before))
+        self.assertEqual(b"".join(response3.streaming_content), before)
+        self.assertTrue(after.endswith(b"Owner - Upload \n"))
+
+        # Case 2: For the shared users, as the downloads
+        # Act
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.collaborator)
+        )
+        response = self.client.get(self.versions_url)
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), 1)
+
+    def test_chunks(self):
+        # Arrange
+        storage = DocumentVersion.get_storage()
+        self.document.set_content(ContentFile(b"a" * 40))
+
+        # Act: Along with the activity lines
+        version1 = self.document.create_version()
+        get_activity_log_writer().write(
+            self.document.get_log_path(), ["b" * 10]
+        )
+        version2 = self.document.create_version()
+        version3 = self.document.create_version()
+
+        # Assert: The unchanged chunks are shared
+        chunks1 = list(version1.chunks.values_list("name", flat=True))
+        chunks2 = list(version2.chunks.values_list("name", flat=True))
+        self.assertEqual(len(chunks1), 3)  # 16 + 16 + 8 bytes
+        self.assertEqual(chunks2[:2], chunks1[:2])
+        self.assertNotEqual(chunks2[2], chunks1[2])
+        self.assertEqual(len(set(chunks1) | set(chunks2)), 4)
+
+        # Assert: The third one is a snapshot
+        self.assertFalse(version2.snapshot)
+        self.assertTrue(version3.snapshot)
+        self.assertEqual(
+            b"".join(version2.iter_content()), b"a" * 40 + b"b" * 10
+        )
+        self.assertEqual(
+            b"".join(version3.iter_content()), b"a" * 40 + b"b" * 10
+        )
+
+        # Assert: Counted per occurrence, twice in each version
+        self.assertEqual(chunks1[0], chunks1[1])
+        self.assertEqual(Blob.objects.get(name=chunks1[0]).references, 6)
+
+        # Arrange: Stored again meanwhile, by a version not committed yet
+        storage.reference(chunks1[2])
+
+        # Act: Deleted along with the document, once committed
+        with self.captureOnCommitCallbacks(execute=True):
+            self.document.delete()
+
+            # Assert: Kept until committed
+            self.assertTrue(storage.exists(chunks1[0]))
+
+        # Assert: No version refers to them anymore
+        for name in {*chunks1, *chunks2, version3.snapshot} - {chunks1[2]}:
+            self.assertFalse(storage.exists(name))
+        self.assertTrue(storage.exists(chunks1[2]))
+        self.assertEqual(Blob.objects.get(name=chunks1[2]).references, 1)
+
+    def test_restore(self):
+        # Arrange
+        before = self.read_file()
+        self.client.put(self.detail_url)
+        edited = self.read_file()
+
+        # Case 1: By a shared user
+        # Act
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.collaborator)
+        )
+        response = self.client.post(self.get_version_url("restore", 1))
+
+        # Assert
+        self.assertEqual(response.status_code, 404)
+
+        # Case 2: By the owner
+        # Act
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.document.owner)
+        )
+        response = self.client.post(self.get_version_url("restore", 1))
+
+        # Assert: Logged after the restored content, the replaced content is
+        # a version
+        self.assertEqual(response.status_code, 200)
+        content = self.read_file()
+        self.assertTrue(content.startswith(before))
+        self.assertTrue(content.endswith(b"Owner - Restore \n"))
+        version = self.document.versions.get(number=2)
+        self.assertEqual(b"".join(version.iter_content()), edited)
+
+        # Case 3: Unknown version
+        # Act
+        response = self.client.post(self.get_version_url("restore", 9))
+
+        # Assert
+        self.assertEqual(response.status_code, 404)
+
+
+class UploadTest(APITest):
+    def setUp(self):
+        super().setUp()
+        self.document = DocumentFactory()
+        self.document.create_document()
+        self.uploads_url = reverse(
+            "store-v1:document-uploads", kwargs={"pk": self.document.id}
+        )
+        self.content = os.urandom(1000)
+        self.checksum = hashlib.sha256(self.content).hexdigest()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.document.owner)
+        )
+
+    def get_upload_url(self, name, upload_id):
+        return reverse(
+            f"store-v1:document-{name}",
+            kwargs={"pk": self.document.id, "upload_id": upload_id},
+        )
+
+    def put_chunk(self, upload_id, offset, data, checksum=None):
+        digest = hashlib.sha256(checksum or data).digest()
+        return self.client.put(
+            self.get_upload_url("upload", upload_id),
+            data,
+            content_type="application/octet-stream",
+            HTTP_UPLOAD_OFFSET=str(offset),
+            HTTP_UPLOAD_CHECKSUM=f"sha256 {base64.b64encode(digest).decode()}",
+        )
+
+    def test_upload(self):
+        # Arrange
+        response = self.client.post(
+            self.uploads_url,
+            {"size": len(self.content), "checksum": self.checksum},
+        )
+        upload_id = response.data["id"]
+
+        # Case 1: In any order, one of them corrupted
+        # Act
+        self.put_chunk(upload_id, 600, self.content[600:])
+        response = self.put_chunk(
+            upload_id, 0, self.content[:300], checksum=b"other"
+        )
+        response2 = self.put_chunk(upload_id, 300, self.content[300:600])
+
+        # Assert: The corrupted one is to be sent again
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response2.data["received"], [[300, 1000]])
+
+        # Case 2: Corrupted, over the received ones
+        # Act
+        response = self.put_chunk(
+            upload_id, 500, self.content[500:700], checksum=b"other"
+        )
+        response2 = self.client.get(self.get_upload_url("upload", upload_id))
+
+        # Assert: The overwritten ranges are to be sent again too
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response2.data["received"], [])
+
+        # Case 3: Commit before the upload is complete
+        # Act
+        response = self.client.post(
+            self.get_upload_url("commit-upload", upload_id)
+        )
+
+        # Assert
+        self.assertEqual(response.status_code, 400)
+
+        # Case 4: Resumed, then committed
+        # Act
+        self.put_chunk(upload_id, 0, self.content[:300])
+        self.put_chunk(upload_id, 300, self.content[300:600])
+        self.put_chunk(upload_id, 600, self.content[600:])
+        response = self.client.post(
+            self.get_upload_url("commit-upload", upload_id)
+        )
+
+        # Assert: Moved in place, the previous content is a version
+        self.assertEqual(response.status_code, 200)
+        self.document.refresh_from_db()
+        self.assertEqual(
+            self.document.file.name,
+            f"documents/blobs/{self.checksum[:2]}/{self.checksum[2:4]}/"
+            f"{self.checksum}.txt",
+        )
+        with open(self.document.file.path, "rb") as file:
+            self.assertEqual(file.read(), self.content)
+        content = read_document_file(self.document)
+        self.assertTrue(content.startswith(self.content))
+        self.assertTrue(content.endswith(b"Owner - Upload \n"))
+        self.assertEqual(self.document.versions.count(), 1)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_committing(self):
+        # Arrange
+        response = self.client.post(
+            self.uploads_url, {"size": len(self.content)}
+        )
+        upload = UploadSession.objects.get(id=response.data["id"])
+
+        # Case 1: Commit while a chunk is being written
+        # Arrange
+        upload.start_write()
+
+        # Act
+        response = self.client.post(
+            self.get_upload_url("commit-upload", upload.id)
+        )
+
+        # Assert
+        self.assertEqual(response.status_code, 409)
+
+        # Case 2: A chunk once the commit is started
+        # Arrange
+        upload.end_write()
+        upload.start_commit()
+
+        # Act
+        response = self.put_chunk(upload.id, 0, self.content)
+
+        # Assert: Refused, the commit neither
+        self.assertEqual(response.status_code, 409)
+        upload.refresh_from_db()
+        self.assertEqual(upload.writers, 0)
+        response = self.client.post(
+            self.get_upload_url("commit-upload", upload.id)
+        )
+        self.assertEqual(response.status_code, 409)
+
+    def test_checksum_mismatch(self):
+        # Arrange
+        response = self.client.post(
+            self.uploads_url,
+            {"size": len(self.content), "checksum": "0" * 64},
+        )
+        upload_id = response.data["id"]
+        self.put_chunk(upload_id, 0, self.content)
+        name = self.document.file.name
+        uploads = self.document.activities.filter(
+            operation=Activity.Operation.UPLOAD
+        ).count()
+
+        # Act
+        response = self.client.post(
+            self.get_upload_url("commit-upload", upload_id)
+        )
+        response2 = self.client.get(self.get_upload_url("upload", upload_id))
+
+        # Assert: Checked by the commit, nothing stored nor logged
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response2.data["status"], "Failed")
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.file.name, name)
+        self.assertFalse(self.document.versions.exists())
+        self.assertEqual(
+            self.document.activities.filter(
+                operation=Activity.Operation.UPLOAD
+            ).count(),
+            uploads,
+        )
+        response = self.put_chunk(upload_id, 0, self.content)
+        self.assertEqual(response.status_code, 409)
+
+    def test_not_allowed(self):
+        # Case 1: By a shared user
+        # Arrange
+        collaborator = UserFactory()
+        UserDocumentFactory(user=collaborator, document=self.document)
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(collaborator)
+        )
+
+        # Act
+        response = self.client.post(self.uploads_url, {"size": 10})
+
+        # Assert
+        self.assertEqual(response.status_code, 404)
+
+        # Case 2: Out of the file
+        # Arrange
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.document.owner)
+        )
+        response = self.client.post(self.uploads_url, {"size": 10})
+
+        # Act
+        response = self.put_chunk(response.data["id"], 5, b"0123456789")
+
+        # Assert
+        self.assertEqual(response.status_code, 400)
+
+    def test_purge_uploads(self):
+        # Arrange
+        upload = UploadSession.start(self.document, 10)
+        UploadSession.objects.filter(id=upload.id).update(
+            expires_at=timezone.now()
+        )
+
+        # Act
+        response = self.put_chunk(upload.id, 0, b"0123456789")
+        call_command("purge_uploads", stdout=StringIO())
+
+        # Assert
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(upload.get_path()))
+
+
+class SearchTest(APITest):
+    def setUp(self):
+        super().setUp()
+        self.owner = UserFactory()
+        self.search_url = reverse("store-v1:document-search")
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.owner)
+        )
+
+    def create_document(self, content, owner=None):
+        document = DocumentFactory(owner=owner or self.owner)
+        document.set_content(ContentFile(content.encode()))
+        return document
+
+    def search(self, query, **params):
+        response = self.client.get(self.search_url, {"q": query, **params})
+        self.assertEqual(response.status_code, 200, response.data)
+        return [document["id"] for document in response.data["results"]]
+
+    def test_search(self):
+        # Arrange
+        often = self.create_document("invoice invoice invoice paid\n")
+        once = self.create_document("invoice of march, not paid\n")
+        self.create_document("nothing to see\n")
+
+        # Act
+        results = self.search("Invoice")
+        results2 = self.search("invoice march")
+        results3 = self.search("invoice missing")
+
+        # Assert: Ranked, all the terms are matched
+        self.assertEqual(results, [often.id, once.id])
+        self.assertEqual(results2, [once.id])
+        self.assertEqual(results3, [])
+
+        # Case 2: The activity lines, appended to the index
+        # Act
+        self.client.patch(
+            reverse("store-v1:document-detail", kwargs={"pk": often.id})
+        )
+
+        # Assert: Once flushed
+        self.assertEqual(self.search("edit owner"), [])
+        get_activity_log_writer().flush()
+        self.assertEqual(self.search("edit owner"), [often.id])
+
+        # Case 3: The replaced content
+        # Act
+        self.client.put(
+            reverse("store-v1:document-detail", kwargs={"pk": often.id})
+        )
+
+        # Assert
+        self.assertEqual(self.search("invoice"), [once.id])
+
+    def test_access(self):
+        # Arrange
+        shared = self.create_document("report", owner=UserFactory())
+        UserDocumentFactory(user=self.owner, document=shared)
+        self.create_document("report", owner=UserFactory())
+        owned = self.create_document("report report")
+
+        # Act
+        results = self.search("report")
+
+        # Assert: The owned and the shared documents only
+        self.assertEqual(sorted(results), sorted([owned.id, shared.id]))
+
+        # Case 2: Deleted, unindexed
+        # Act
+        self.client.delete(
+            reverse("store-v1:document-detail", kwargs={"pk": owned.id})
+        )
+
+        # Assert
+        self.assertEqual(self.search("report"), [shared.id])
+        self.assertEqual(SearchEntry.objects.count(), 2)
+
+    def test_pagination(self):
+        # Arrange
+        documents = [
+            self.create_document("term " * count) for count in range(1, 4)
+        ]
+
+        # Act
+        response = self.client.get(self.search_url, {"q": "term", "limit": 2})
+        response2 = self.client.get(response.data["next"])
+        response3 = self.client.get(self.search_url, {"q": "?!"})
+
+        # Assert
+        self.assertEqual(
+            [document["id"] for document in response.data["results"]],
+            [documents[2].id, documents[1].id],
+        )
+        self.assertIn("score", response.data["results"][0])
+        self.assertEqual(
+            [document["id"] for document in response2.data["results"]],
+            [documents[0].id],
+        )
+        self.assertIsNone(response2.data["next"])
+        self.assertEqual(response3.status_code, 400)
+
+    @override_settings(SEARCH={"BACKEND": "python", "MAX_CONTENT_SIZE": 100})
+    def test_python_backend(self):
+        # Arrange
+        often = self.create_document("alpha alpha beta\n")
+        once = self.create_document("alpha gamma\n")
+
+        # Act
+        results = self.search("alpha")
+        results2 = self.search("alpha gamma")
+        often.write_to_file("gamma gamma\n")
+        get_activity_log_writer().flush()
+        results3 = self.search("gamma")
+
+        # Assert
+        self.assertEqual(results, [often.id, once.id])
+        self.assertEqual(results2, [once.id])
+        self.assertEqual(results3, [often.id, once.id])
+        self.assertEqual(
+            SearchTerm.objects.get(
+                entry__document=often, term="gamma"
+            ).frequency,
+            2,
+        )
+
+        # Case 2: Indexed in bulk
+        # Act
+        documents, _ = Document.bulk_create_documents(self.owner, 2)
+
+        # Assert
+        self.assertEqual(
+            sorted(self.search("upload")),
+            sorted(document.id for document in documents),
+        )
+
+        # Case 2: Past the max size, the appends are not indexed
+        # Act
+        often.write_to_file("delta " * 20)
+
+        # Assert
+        self.assertEqual(self.search("delta"), [])
+
+    def test_rebuild(self):
+        # Arrange
+        document = self.create_document("needle")
+        SearchEntry.objects.all().delete()
+
+        # Act
+        results = self.search("needle")
+        call_command("rebuild_search_index", "--missing", stdout=StringIO())
+
+        # Assert
+        self.assertEqual(results, [])
+        self.assertEqual(self.search("needle"), [document.id])
+
+
+class ChangesFeedTest(APITest):
+    def setUp(self):
+        super().setUp()
+        self.owner = UserFactory()
+        self.collaborator = UserFactory()
+        self.changes_url = reverse("store-v1:document-changes")
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.collaborator)
+        )
+
+    def get_changes(self, since, **params):
+        response = self.client.get(
+            self.changes_url, {"since": since, **params}
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def get_cursor(self):
+        return self.client.get(self.changes_url).data["cursor"]
+
+    def commit(self):
+        """The changes are recorded once committed."""
+        return self.captureOnCommitCallbacks(execute=True)
+
+    def test_changes(self):
+        # Arrange
+        with self.commit():
+            document = DocumentFactory(owner=self.owner)
+            other = DocumentFactory(owner=self.owner)
+        cursor = self.get_cursor()
+
+        # Act
+        with self.commit():
+            document.add_shared_users([self.collaborator.id])
+        data = self.get_changes(cursor)
+        with self.commit():
+            document.save()
+        data2 = self.get_changes(data["cursor"])
+        data3 = self.get_changes(data2["cursor"])
+
+        # Assert: Only the changes of the visible documents
+        self.assertEqual(
+            [(row["id"], row["operation"]) for row in data["results"]],
+            [(document.id, "share")],
+        )
+        self.assertEqual(data["results"][0]["document"]["id"], document.id)
+        self.assertEqual(
+            [(row["id"], row["operation"]) for row in data2["results"]],
+            [(document.id, "update")],
+        )
+        self.assertEqual(data3["results"], [])
+        self.assertEqual(data3["cursor"], data2["cursor"])
+        self.assertFalse(
+            DocumentChange.objects.filter(
+                user=self.collaborator, document_id=other.id
+            ).exists()
+        )
+
+        # Case 2: Idle, the changes of the others only
+        # Act
+        with self.commit():
+            other.save()
+        data4 = self.get_changes(data3["cursor"])
+
+        # Assert: The cursor moves on
+        self.assertEqual(data4["results"], [])
+        self.assertGreater(data4["cursor"], data3["cursor"])
+
+        # Case 3: Unshared, then deleted: tombstones with no data
+        # Arrange
+        cursor = data4["cursor"]
+
+        # Act
+        with self.commit():
+            UserDocument.objects.get(
+                user=self.collaborator, document=document
+            ).delete()
+        data = self.get_changes(cursor)
+        with self.commit():
+            document.add_shared_users([self.collaborator.id])
+            document.delete()
+        data2 = self.get_changes(data["cursor"])
+
+        # Assert: The last change of each document
+        self.assertEqual(
+            [(row["operation"], row["document"]) for row in data["results"]],
+            [("unshare", None)],
+        )
+        self.assertEqual(
+            [(row["operation"], row["document"]) for row in data2["results"]],
+            [("delete", None)],
+        )
+
+    def test_once_per_operation(self):
+        # Arrange
+        with self.commit():
+            document = DocumentFactory(owner=self.owner)
+            document.create_document()
+            document.add_shared_users([self.collaborator.id])
+        cursor = self.get_cursor()
+
+        # Act: Its row is touched, then its file saved
+        with self.commit():
+            document.truncate_the_file_content()
+        data = self.get_changes(cursor)
+
+        # Assert: A single change per user
+        self.assertEqual(
+            DocumentChange.objects.filter(
+                id__gt=cursor, document_id=document.id
+            ).count(),
+            2,
+        )
+        self.assertEqual(
+            [(row["id"], row["operation"]) for row in data["results"]],
+            [(document.id, "update")],
+        )
+
+    def test_pages(self):
+        # Arrange
+        self.client.credentials(
+            HTTP_AUTHORIZATION=self.get_auth_header(self.owner)
+        )
+        cursor = self.get_cursor()
+        with self.commit():
+            documents, _ = Document.bulk_create_documents(self.owner, 3)
+
+        # Act
+        data = self.get_changes(cursor, limit=2, fields="id")
+        data2 = self.get_changes(data["cursor"], limit=2)
+
+        # Assert
+        self.assertTrue(data["has_more"])
+        self.assertFalse(data2["has_more"])
+        self.assertEqual(
+            [
+                row["id"]
+                for data in (data, data2)
+                for row in data["results"]
+                if row["operation"] == "create"
+            ],
+            [document.id for document in documents],
+        )
+        self.assertEqual(
+            data["results"][0]["document"], {"id": documents[0].id}
+        )
+
+    def test_settle_and_purge(self):
+        # Arrange
+        with self.commit():
+            document = DocumentFactory(owner=self.owner)
+            document.add_shared_users([self.collaborator.id])
+
+        # Act
+        with override_settings(
+            DOCUMENT_CHANGES={**settings.DOCUMENT_CHANGES, "SETTLE": 60}
+        ):
+            data = self.get_changes(0)
+
+        # Assert: Held back
+        self.assertEqual(data["results"], [])
+
+        # Case 2: Purged, the cursor is gone
+        # Arrange
+        DocumentChange.objects.update(
+            created_at=timezone.now() - timezone.timedelta(days=365)
+        )
+        with self.commit():
+            DocumentFactory(owner=self.owner)  # The latest change is kept
+
+        # Act
+        call_command("purge_document_changes", stdout=StringIO())
+        response = self.client.get(self.changes_url, {"since": 0})
+        response2 = self.client.get(
+            self.changes_url, {"since": self.get_cursor()}
+        )
+
+        # Assert
+        self.assertEqual(DocumentChange.objects.count(), 1)
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response2.status_code, 200)
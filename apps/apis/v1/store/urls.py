@@ -2,6 +2,7 @@ from django.urls import include, path
 
 from rest_framework.routers import SimpleRouter
 
+from . import async_views
 from .views import DocumentViewSet, UserViewSet
 
 app_name = "store-v1"
@@ -11,6 +12,31 @@ router = SimpleRouter()
 router.register(r"document", DocumentViewSet, basename="document")
 router.register(r"user", UserViewSet, basename="user")
 
+# Async variants of the document actions, for the ASGI servers
+async_urlpatterns = [
+    path(
+        "document/",
+        async_views.document_list,
+        name="async-document-list",
+    ),
+    path(
+        "document/<str:pk>/",
+        async_views.document_detail,
+        name="async-document-detail",
+    ),
+    path(
+        "document/<str:pk>/share/",
+        async_views.document_share,
+        name="async-document-share",
+    ),
+    path(
+        "document/<str:pk>/download/",
+        async_views.document_download,
+        name="async-document-download",
+    ),
+]
+
 urlpatterns = [
     path("", include(router.urls)),
+    path("async/", include(async_urlpatterns)),
 ]
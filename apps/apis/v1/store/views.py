@@ -1,16 +1,58 @@
-from typing import AnyStr
+from datetime import timedelta
+from typing import AnyStr, Dict, Tuple
 
-from django.db.models import Q
+from django.conf import settings
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
 
+from rest_framework import status
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 
-from apps.store.models import Document, User
+from apps.store.models import (
+    Activity,
+    Document,
+    DocumentChange,
+    UploadSession,
+    User,
+)
+from apps.store.search import get_search_backend
+from apps.utils.caching import (
+    get_etag,
+    get_not_modified_response,
+    set_version_headers,
+)
+from apps.utils.pagination import (
+    KeysetPagination,
+    RankedPagination,
+    SelectablePagination,
+)
+from apps.utils.profiling import instrument
+from apps.utils.tasks import has_pending
 
+from .operations import (
+    download_document,
+    get_document_queryset,
+    share_document,
+)
 from .serializers import (
+    ActivityFilterSerializer,
+    ActivitySerializer,
+    BulkCreateSerializer,
+    BulkShareSerializer,
+    ChangesFilterSerializer,
+    DocumentFilterSerializer,
     DocumentSerializer,
+    DocumentVersionSerializer,
+    SearchSerializer,
     StringListSerializer,
+    UploadSessionSerializer,
+    UploadStartSerializer,
     UserSerializer,
 )
 
@@ -19,40 +61,213 @@ class DocumentViewSet(ModelViewSet):
     """
     Provides following APIs:
 
-    List and Detail: For Owner and Shared User
+    List and Detail: For Owner and Shared User. The list is filterable and
+    orderable, see DocumentFilterSerializer, both take a sparse ?fields=
     Create: Any user, Logging
+    Bulk create (POST): Any user, Logging
     Delete: For Owner
     Update (PUT): Is the re-upload feature, For Owner, Logging
     Partial update (PATCH): Normal edit, For Owner and Shared Users, Logging
-    Share (POST): For owner
-    Download: Any user, Logging
+    Share (POST): For owner, Logging
+    Bulk share (POST): For owner of all the documents, Logging
+    Download: Any user, Logging. GET streams the file
+    Activity: For Owner and Shared User
+    Search of the file contents: For Owner and Shared User, ranked
+    Changes feed: The changes of the documents of the user, since a cursor
+    Versions and their download: For Owner and Shared User
+    Restore a version (POST): For Owner, Logging
+    Resumable upload of the file (POST, PUT chunks, POST commit): For Owner,
+    Logging
     """
 
     permission_classes = (IsAuthenticated,)
     serializer_class = DocumentSerializer
+    pagination_class = SelectablePagination
     model = Document
     queryset = model.objects.all()
 
+    # Actions allowed for the Owner and the Shared Users
+    shared_actions = (
+        "list",
+        "retrieve",
+        "partial_update",
+        "download",
+        "activity",
+        "versions",
+        "version_download",
+        "search",
+        "changes",
+    )
+    # Safe methods read from a replica, see ReplicaRoutingMiddleware
+    replica_reads = True
+
+    def initial(self, request, *args, **kwargs):
+        """
+        Also check the sparse fieldset, before the action: the ones with
+        side effects render the document once done.
+        """
+        super().initial(request, *args, **kwargs)
+        self.get_serializer_class().get_requested_fields(request)
+
     def get_queryset(self):
-        if self.action in ["list", "retrieve", "partial_update", "download"]:
-            # Owner or Shared User
-            return self.queryset.filter(
-                Q(owner_id=self.request.user.id)
-                | Q(shared_users__id=self.request.user.id)
+        # Owner, or also Shared User
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        return get_document_queryset(
+            self.request.user,
+            shared=self.action in self.shared_actions,
+            pk=self.kwargs.get(lookup_url_kwarg),
+        )
+
+    def filter_queryset(self, queryset):
+        """The filters and the ordering of the list, by the query params."""
+        queryset = super().filter_queryset(queryset)
+        if self.action != "list":
+            return queryset
+        serializer = DocumentFilterSerializer(data=self.request.query_params)
+
+        serializer.is_valid(raise_exception=True)
+
+        filters = serializer.validated_data
+        # Each scope, filter and ordering is a range of an index on
+        # ([owner,] -created_at | -updated_at, -id)
+        if filters["scope"] == "owned":
+            # Accessible anyway, no access check
+            queryset = self.queryset.owned_by(self.request.user)
+        elif filters["scope"] == "shared":
+            queryset = self.queryset.shared_with(self.request.user)
+        if "created_after" in filters:
+            queryset = queryset.filter(
+                created_at__gte=filters["created_after"]
+            )
+        if "created_before" in filters:
+            queryset = queryset.filter(
+                created_at__lt=filters["created_before"]
+            )
+        if "updated_after" in filters:
+            queryset = queryset.filter(
+                updated_at__gte=filters["updated_after"]
             )
-        # Owner
-        return self.queryset.filter(owner_id=self.request.user.id)
+        if "updated_before" in filters:
+            queryset = queryset.filter(
+                updated_at__lt=filters["updated_before"]
+            )
+        if "ordering" in filters:
+            field = filters["ordering"]
+            # The id breaks the ties, in the same direction
+            queryset = queryset.order_by(
+                field, "-id" if field.startswith("-") else "id"
+            )
+        return queryset
+
+    @instrument("access")
+    def get_object(self):
+        """Profiled, the access check of the detail actions."""
+        return super().get_object()
+
+    def list(self, request, *args, **kwargs):
+        """
+        Conditional: the ETag is the version of the page, its documents and
+        its links, checked before serializing it.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is None:  # Not paginated
+            return super().list(request, *args, **kwargs)
+
+        envelope = self.get_paginated_response([]).data
+        etag = get_etag(
+            request.user.id,
+            *envelope.values(),
+            *((document.pk, document.updated_at) for document in page),
+        )
+        response = get_not_modified_response(request, etag)
+        if response is not None:
+            return response
+
+        serializer = self.get_serializer(page, many=True)
+        response = self.get_paginated_response(serializer.data)
+        return set_version_headers(response, etag)
+
+    def retrieve(self, request, *args, **kwargs):
+        """Conditional: the ETag / Last-Modified of the updated_at."""
+        instance = self.get_object()
+        etag = get_etag(instance.pk, instance.updated_at)
+        response = get_not_modified_response(
+            request, etag, instance.updated_at
+        )
+        if response is not None:
+            return response
+
+        serializer = self.get_serializer(instance)
+        response = Response(serializer.data)
+        return set_version_headers(response, etag, instance.updated_at)
+
+    def update(self, request, *args, **kwargs):
+        """
+        The re-upload (PUT) truncates the file in the background: the
+        truncated document once done, else 202 without the file_url, whose
+        file is being replaced.
+        """
+        if kwargs.get("partial", False):
+            return super().update(request, *args, **kwargs)
+
+        instance = self.get_object()
+        serializer = self.get_serializer(instance, data=request.data)
+
+        serializer.is_valid(raise_exception=True)
+
+        self.perform_update(serializer)
+        if has_pending(instance.get_task_group()):
+            data = serializer.data
+            data.pop("file_url", None)
+            return Response(data, status=status.HTTP_202_ACCEPTED)
+        # Truncated already, eg: by the sync backend
+        instance.refresh_from_db()
+        return Response(self.get_serializer(instance).data)
 
     def perform_create(self, serializer):
         # Saving the owner of the document
         serializer.save(owner=self.request.user)
 
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            # Locks the row before the signals read the related rows. A
+            # write first, on SQLite too: see SearchBackend.replace
+            Document.objects.filter(pk=instance.pk).update(
+                updated_at=timezone.now()
+            )
+            instance.delete()
+
     def get_serializer_context(self):
         """Overridden to track the api caller."""
         context = super().get_serializer_context()
         context["api_caller"] = self.request.user
         return context
 
+    @action(methods=["POST"], detail=False, url_path="bulk")
+    def bulk(self, request, *args, **kwargs):
+        """
+        Create many documents in one go. The documents whose file could not
+        be written are reported in errors, by their position.
+        """
+        serializer = BulkCreateSerializer(data=request.data)
+
+        serializer.is_valid(raise_exception=True)
+
+        documents, errors = Document.bulk_create_documents(
+            request.user, serializer.validated_data["count"]
+        )
+        data = {
+            "results": self.get_serializer(documents, many=True).data,
+            "errors": [
+                {"index": position, "detail": detail}
+                for position, detail in errors
+            ],
+        }
+        if errors:  # Partially created
+            return Response(data, status=status.HTTP_207_MULTI_STATUS)
+        return Response(data, status=status.HTTP_201_CREATED)
+
     @action(methods=["POST"], detail=True, url_path="share")
     def share(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -60,24 +275,399 @@ class DocumentViewSet(ModelViewSet):
 
         serializer.is_valid(raise_exception=True)
 
-        instance.add_shared_users(serializer.validated_data["id_list"])
+        share_document(
+            instance, request.user, serializer.validated_data["id_list"]
+        )
         return self.retrieve(request, *args, **kwargs)
 
-    @action(methods=["POST"], detail=True, url_path="download")
+    @action(methods=["POST"], detail=False, url_path="share-bulk")
+    def share_bulk(self, request, *args, **kwargs):
+        """Share every document with every valid user."""
+        serializer = BulkShareSerializer(data=request.data)
+
+        serializer.is_valid(raise_exception=True)
+
+        document_ids = set(serializer.validated_data["document_ids"])
+        # Ownership of all the documents, in one query
+        documents = list(
+            self.get_queryset()
+            .filter(id__in=document_ids)
+            .only("id", "owner_id", "file")
+        )
+        if len(documents) != len(document_ids):
+            missing = document_ids - {document.id for document in documents}
+            raise NotFound(
+                {"detail": "Not found.", "document_ids": sorted(missing)}
+            )
+
+        added = Document.share_documents(
+            documents, serializer.validated_data["user_ids"]
+        )
+        # Log the share operations, written in batches by the writer
+        for document in documents:
+            if document.id in added:
+                document.log_activity(request.user, Activity.Operation.SHARE)
+        return Response({"created": sum(added.values())})
+
+    @action(methods=["GET", "POST"], detail=True, url_path="download")
     def download(self, request, *args, **kwargs):
+        """
+        GET: The content of the file, streamed with Range and conditional
+        GET support. HEAD: Its headers only.
+        POST: The document details.
+        """
         instance = self.get_object()
         api_caller: User = request.user
-        user_type: AnyStr = instance.get_user_type(api_caller)
-        operation: AnyStr = "Download"
-        # Log the download operation
-        instance.append_content_to_file(f"{user_type} - {operation}")
+
+        if request.method in ("GET", "HEAD"):
+            return download_document(request, instance, api_caller)
+
+        # Record the download operation
+        instance.record_activity(api_caller, Activity.Operation.DOWNLOAD)
+        return self.retrieve(request, *args, **kwargs)
+
+    @action(methods=["GET"], detail=True, url_path="activity")
+    def activity(self, request, *args, **kwargs):
+        """Activity history of the document, latest first."""
+        instance = self.get_object()
+        serializer = ActivityFilterSerializer(data=request.query_params)
+
+        serializer.is_valid(raise_exception=True)
+
+        filters = serializer.validated_data
+        # Each filter narrows down an index on (document, ...)
+        queryset = instance.activities.all()
+        if "operation" in filters:
+            queryset = queryset.filter(operation=filters["operation"])
+        if "actor" in filters:
+            queryset = queryset.filter(actor_id=filters["actor"])
+        if "since" in filters:
+            queryset = queryset.filter(timestamp__gte=filters["since"])
+        if "until" in filters:
+            queryset = queryset.filter(timestamp__lt=filters["until"])
+
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = ActivitySerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(methods=["GET"], detail=False, url_path="search")
+    def search(self, request, *args, **kwargs):
+        """
+        The accessible documents whose file has all the terms of ?q=, the
+        best ranked first, along with their score.
+        """
+        backend = get_search_backend()
+        if backend is None:
+            raise NotFound("The search is disabled.")
+        serializer = SearchSerializer(data=request.query_params)
+
+        serializer.is_valid(raise_exception=True)
+
+        results = SearchResults(
+            backend, serializer.validated_data["q"], self.get_queryset()
+        )
+        paginator = RankedPagination()
+        page = paginator.paginate_queryset(results, request, view=self)
+        documents = Document.objects.in_bulk(
+            [document_id for document_id, _ in page]
+        )
+        data = []
+        for document_id, score in page:
+            if document_id in documents:  # Else deleted meanwhile
+                data.append(
+                    {
+                        **self.get_serializer(documents[document_id]).data,
+                        "score": score,
+                    }
+                )
+        return paginator.get_paginated_response(data)
+
+    @action(methods=["GET"], detail=False, url_path="changes")
+    def changes(self, request, *args, **kwargs):
+        """
+        The documents created, updated, shared, unshared or deleted since the
+        ?since= cursor: the last change of each, along with its data, null
+        once the user cannot see it anymore. Without a cursor, the current
+        one: list the documents, then poll the changes from it.
+        """
+        serializer = ChangesFilterSerializer(data=request.query_params)
+
+        serializer.is_valid(raise_exception=True)
+
+        since = serializer.validated_data.get("since")
+        limit = serializer.validated_data["limit"]
+        # Held back until the transactions of the lower numbers committed
+        settled = DocumentChange.objects.filter(
+            created_at__lte=timezone.now()
+            - timedelta(seconds=settings.DOCUMENT_CHANGES["SETTLE"])
+        )
+        # The latest settled number, the cursor of a client caught up
+        head = (
+            settled.order_by("-id").values_list("id", flat=True).first() or 0
+        )
+        if since is None:
+            return Response({"cursor": head, "has_more": False, "results": []})
+
+        # The purge keeps the latest change, the numbers are contiguous
+        oldest = (
+            DocumentChange.objects.order_by("id")
+            .values_list("id", flat=True)
+            .first()
+        )
+        if oldest is not None and since < oldest - 1:
+            return Response(
+                {"detail": "The changes since the cursor were purged."},
+                status=status.HTTP_410_GONE,
+            )
+
+        rows = list(
+            settled.filter(user_id=request.user.id, id__gt=since, id__lte=head)
+            .order_by("id")
+            .values_list("id", "document_id", "operation")[: limit + 1]
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        # The last change of each document, in the feed order
+        latest: Dict[AnyStr, Tuple[int, AnyStr]] = {}
+        for number, document_id, operation in rows:
+            latest.pop(document_id, None)
+            latest[document_id] = (number, operation)
+        documents = list(self.get_queryset().filter(id__in=latest))
+        # By id, the sparse fieldsets could leave it out
+        data = dict(
+            zip(
+                (document.id for document in documents),
+                self.get_serializer(documents, many=True).data,
+            )
+        )
+        return Response(
+            {
+                # Past the changes of the others too, the cursor of an idle
+                # user keeps up with the purge
+                "cursor": rows[-1][0] if has_more else max(head, since),
+                "has_more": has_more,
+                "results": [
+                    {
+                        "id": document_id,
+                        "seq": number,
+                        "operation": operation,
+                        "document": data.get(document_id),
+                    }
+                    for document_id, (number, operation) in latest.items()
+                ],
+            }
+        )
+
+    @action(methods=["GET"], detail=True, url_path="versions")
+    def versions(self, request, *args, **kwargs):
+        """Past contents of the file, saved by the re-uploads, latest first."""
+        instance = self.get_object()
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(
+            instance.versions.all(), request, view=self
+        )
+        serializer = DocumentVersionSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(
+        methods=["GET"],
+        detail=True,
+        url_path=r"versions/(?P<number>\d+)/download",
+    )
+    def version_download(self, request, number, *args, **kwargs):
+        """The content of the version, streamed from its chunks."""
+        instance = self.get_object()
+        version = get_object_or_404(instance.versions, number=number)
+
+        response = StreamingHttpResponse(
+            version.iter_content(), content_type="text/plain"
+        )
+        response["Content-Length"] = version.size
+        response["Content-Disposition"] = (
+            f'attachment; filename="{instance.id}.v{version.number}.txt"'
+        )
+        # Record the download operation
+        instance.record_activity(request.user, Activity.Operation.DOWNLOAD)
+        return response
+
+    @action(
+        methods=["POST"],
+        detail=True,
+        url_path=r"versions/(?P<number>\d+)/restore",
+    )
+    def restore(self, request, number, *args, **kwargs):
+        """
+        Restore the content of the version, in the background. The current
+        content becomes a version, the restore can be undone.
+        """
+        instance = self.get_object()
+        version = get_object_or_404(instance.versions, number=number)
+
+        instance.enqueue_file_operation(
+            "store.restore_document_version", version.number
+        )
+        # Log the restore operation
+        instance.log_activity(request.user, Activity.Operation.RESTORE)
+        return self.retrieve(request, *args, **kwargs)
+
+    @action(methods=["POST"], detail=True, url_path="uploads")
+    def uploads(self, request, *args, **kwargs):
+        """
+        Start a resumable upload of the file, then PUT its chunks and commit
+        it. The upload expires after UPLOADS["EXPIRY"].
+        """
+        instance = self.get_object()
+        serializer = UploadStartSerializer(data=request.data)
+
+        serializer.is_valid(raise_exception=True)
+
+        upload = UploadSession.start(instance, **serializer.validated_data)
+        return Response(
+            UploadSessionSerializer(upload).data,
+            status=status.HTTP_201_CREATED,
+        )
+
+    @action(
+        methods=["GET", "PUT"],
+        detail=True,
+        url_path=r"uploads/(?P<upload_id>[^/.]+)",
+    )
+    def upload(self, request, upload_id, *args, **kwargs):
+        """
+        GET: The received ranges, to resume the upload.
+        PUT: A chunk, the raw bytes of the body written from the
+        `Upload-Offset` header, checked by `Upload-Checksum: sha256 <base64
+        digest>`. The chunks can be sent in any order, in parallel.
+        """
+        upload = self.get_upload(self.get_object(), upload_id)
+        if request.method == "GET":
+            return Response(UploadSessionSerializer(upload).data)
+
+        offset, length, checksum = self.get_chunk_headers(request, upload)
+        if not upload.start_write():
+            return Response(
+                {"detail": "The upload is committed, or failed."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        try:
+            # Streamed from the request, never parsed as its data
+            received = upload.receive(offset, request.stream, length, checksum)
+        finally:
+            upload.end_write()
+        if not received:
+            raise ValidationError(
+                {"Upload-Checksum": ["The chunk does not match it."]}
+            )
+        return Response(UploadSessionSerializer(upload).data)
+
+    @action(
+        methods=["POST"],
+        detail=True,
+        url_path=r"uploads/(?P<upload_id>[^/.]+)/commit",
+    )
+    def commit_upload(self, request, upload_id, *args, **kwargs):
+        """
+        Replace the file with the complete upload, in the background. The
+        replaced content becomes a version.
+
+        The chunks are refused from then on. The file is checked against the
+        checksum by the background commit: on a mismatch, the status of the
+        upload becomes Failed.
+        """
+        instance = self.get_object()
+        upload = self.get_upload(instance, upload_id)
+        # No chunk is written meanwhile, then none can be
+        if not upload.start_commit():
+            return Response(
+                {"detail": "Chunks are being written, or it is committed."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        if not upload.is_complete():
+            upload.set_status(UploadSession.Status.UPLOADING)
+            raise ValidationError(
+                {
+                    "detail": "Chunks are missing.",
+                    "received": UploadSessionSerializer(upload).data[
+                        "received"
+                    ],
+                }
+            )
+
+        # Logged by the commit
+        instance.enqueue_file_operation(
+            "store.commit_document_upload",
+            upload.id,
+            request.user.id,
+            idempotency_key=f"commit-upload:{upload.id}",
+        )
         return self.retrieve(request, *args, **kwargs)
 
+    @staticmethod
+    def get_upload(instance: Document, upload_id: AnyStr) -> UploadSession:
+        """The unexpired upload of the document."""
+        return get_object_or_404(
+            instance.uploads, id=upload_id, expires_at__gt=timezone.now()
+        )
+
+    @staticmethod
+    def get_chunk_headers(
+        request, upload: UploadSession
+    ) -> Tuple[int, int, bytes]:
+        """The offset, the length and the checksum of a chunk."""
+        try:
+            offset = int(request.headers["Upload-Offset"])
+            length = int(request.headers["Content-Length"])
+        except (KeyError, ValueError):
+            raise ValidationError(
+                {
+                    "Upload-Offset": [
+                        "Upload-Offset and Content-Length are required."
+                    ]
+                }
+            )
+        if (
+            offset < 0
+            or length <= 0
+            or length > settings.UPLOADS["MAX_CHUNK_SIZE"]
+            or offset + length > upload.size
+        ):
+            raise ValidationError(
+                {"Upload-Offset": ["The chunk is out of the file."]}
+            )
+
+        checksum = UploadSession.parse_checksum(
+            request.headers.get("Upload-Checksum", "")
+        )
+        if checksum is None:
+            raise ValidationError(
+                {"Upload-Checksum": ["Expects: sha256 <base64 digest>."]}
+            )
+        return offset, length, checksum
+
+
+class SearchResults:
+    """The ranked results of a search, fetched by the slices of a page."""
+
+    def __init__(self, backend, query: AnyStr, queryset):
+        self.backend = backend
+        self.query = query
+        self.queryset = queryset
+
+    def __getitem__(self, key: slice):
+        return self.backend.search(
+            self.query, self.queryset, key.stop - key.start, key.start
+        )
+
 
 class UserViewSet(ReadOnlyModelViewSet):
     """Provides only the list and detail APIs."""
 
     permission_classes = (IsAuthenticated,)
     serializer_class = UserSerializer
+    pagination_class = SelectablePagination
     model = User
-    queryset = model.objects.all()
+    queryset = model.objects.order_by("created_at", "id")
+    # Safe methods read from a replica, see ReplicaRoutingMiddleware
+    replica_reads = True
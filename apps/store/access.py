@@ -0,0 +1,101 @@
+import bisect
+import time
+from typing import AnyStr, Iterable, NoReturn, Tuple, Union
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, router, transaction
+
+from apps.utils.profiling import instrument
+
+# Cached in place of the ids of the users having too many documents
+TOO_MANY = "too-many"
+
+
+def get_cache():
+    """The cache of DOCUMENT_ACCESS_CACHE, None when it is disabled."""
+    backend = settings.DOCUMENT_ACCESS_CACHE["BACKEND"]
+    return caches[backend] if backend else None
+
+
+def get_version(cache, user_id: AnyStr) -> int:
+    """
+    Current version of the ids of the user. An evicted version restarts
+    from the clock, never from a number an older entry was stored under.
+    """
+    key = f"document-access-version:{user_id}"
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), settings.DOCUMENT_ACCESS_CACHE["TTL"])
+        version = cache.get(key)
+    return version
+
+
+@instrument("access")
+def get_accessible_document_ids(user) -> Union[Tuple[AnyStr, ...], None]:
+    """
+    Sorted ids of the documents owned by or shared with the user, cached
+    under the version of the user. None when the cache is disabled or the
+    user has too many documents, the caller then queries them.
+
+    An invalidation bumps the version: the ids computed from the data as
+    it was before are stored under the old version, never read again.
+    """
+    from .models import Document
+
+    cache = get_cache()
+    if cache is None:
+        return None
+
+    options = settings.DOCUMENT_ACCESS_CACHE
+    key = f"document-access:{user.id}:{get_version(cache, user.id)}"
+    document_ids = cache.get(key)
+    if document_ids is None:
+        # From the primary, a lagging replica would be cached for the TTL
+        documents = Document.objects.db_manager(router.db_for_write(Document))
+        document_ids = sorted(
+            documents.accessible_by(user)
+            .order_by()
+            .values_list("id", flat=True)[: options["MAX_SIZE"] + 1]
+        )
+        if len(document_ids) > options["MAX_SIZE"]:
+            document_ids = TOO_MANY
+        else:
+            document_ids = tuple(document_ids)
+        cache.set(key, document_ids, options["TTL"])
+
+    return None if document_ids == TOO_MANY else document_ids
+
+
+def is_accessible(
+    document_ids: Tuple[AnyStr, ...], document_id: AnyStr
+) -> bool:
+    """Membership in the sorted ids, in O(log n)."""
+    position = bisect.bisect_left(document_ids, document_id)
+    return (
+        position < len(document_ids) and document_ids[position] == document_id
+    )
+
+
+def invalidate_accessible_documents(user_ids: Iterable[AnyStr]) -> NoReturn:
+    """
+    Bump the versions of the users. In a transaction, again on commit: the
+    ids cached meanwhile by the other requests lack the uncommitted rows.
+    """
+    cache = get_cache()
+    if cache is None:
+        return
+
+    user_ids = set(user_ids)
+
+    def bump():
+        for user_id in user_ids:
+            key = f"document-access-version:{user_id}"
+            try:
+                cache.incr(key)
+            except ValueError:  # Evicted, the next read restarts it
+                pass
+
+    bump()
+    if connection.in_atomic_block:
+        transaction.on_commit(bump)
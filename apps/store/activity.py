@@ -0,0 +1,253 @@
+import atexit
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, AnyStr, Dict, List, NoReturn, Optional
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, close_old_connections
+
+from apps.utils.locks import LockTimeout, get_lock_manager
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityLogWriter:
+    """
+    Buffers activity log lines and records in memory and writes them in
+    batches from a background worker.
+
+    The lines are grouped by file path, so a flush costs one open/write/close
+    per document instead of one per logged operation. The structured records
+    are inserted with a single bulk create per batch.
+
+    The lines of a file are taken from the queue and written while holding
+    the lock of the file, the one the truncates hold while discarding them.
+
+    The lines are also added to the search index, see index(): one update
+    per document and flush, always out of the requests.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, max_batch_size: int = 500):
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+
+        self._pending: Dict[AnyStr, List[AnyStr]] = OrderedDict()
+        self._records: List[Any] = []
+        self._indexed: Dict[AnyStr, List[AnyStr]] = OrderedDict()
+        self._pending_count = 0
+        self._lock = threading.Lock()
+        # Serialises the flushes, so batches are written in the queued order
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_settings(cls) -> "ActivityLogWriter":
+        options = settings.ACTIVITY_LOG
+        return cls(
+            flush_interval=options["FLUSH_INTERVAL"],
+            max_batch_size=options["MAX_BATCH_SIZE"],
+        )
+
+    @staticmethod
+    def is_synchronous() -> bool:
+        # Read on every call, so that tests can override it
+        return settings.ACTIVITY_LOG["SYNCHRONOUS"]
+
+    def append(self, path: AnyStr, line: AnyStr) -> NoReturn:
+        """Queue the line to be appended to the file at the path."""
+        if self.is_synchronous() or self._stopped.is_set():
+            with get_lock_manager().lock(path):
+                self.write(path, [line])
+            return
+
+        with self._lock:
+            self._pending.setdefault(path, []).append(line)
+            self._pending_count += 1
+            is_full = self._pending_count >= self.max_batch_size
+
+        self._notify(is_full)
+
+    def record(self, instance: Any) -> NoReturn:
+        """Queue the unsaved model instance to be bulk created."""
+        if self.is_synchronous() or self._stopped.is_set():
+            self._save([instance])
+            return
+
+        with self._lock:
+            self._records.append(instance)
+            self._pending_count += 1
+            is_full = self._pending_count >= self.max_batch_size
+
+        self._notify(is_full)
+
+    def index(self, document_id: AnyStr, line: AnyStr) -> NoReturn:
+        """
+        Queue the line to be added to the search index of the document.
+        Also when SYNCHRONOUS: indexed once MAX_BATCH_SIZE lines are queued.
+        """
+        with self._lock:
+            self._indexed.setdefault(document_id, []).append(line)
+            self._pending_count += 1
+            is_full = self._pending_count >= self.max_batch_size
+
+        if self._stopped.is_set():
+            self.flush()
+        elif self.is_synchronous():
+            if is_full:
+                self.flush()
+        else:
+            self._notify(is_full)
+
+    def discard_index(self, document_id: AnyStr) -> List[AnyStr]:
+        """
+        Drop the queued index lines of the document, eg: before its content
+        is indexed again, and return them.
+        """
+        with self._lock:
+            lines = self._indexed.pop(document_id, [])
+            self._pending_count -= len(lines)
+        return lines
+
+    def discard(self, path: AnyStr) -> List[AnyStr]:
+        """
+        Drop the queued lines of the file, eg: before truncating it, and
+        return them. The caller holds the lock of the file.
+        """
+        with self._lock:
+            lines = self._pending.pop(path, [])
+            self._pending_count -= len(lines)
+        return lines
+
+    def flush(self) -> NoReturn:
+        """Write all the queued lines and records, then index the lines."""
+        with self._flush_lock:
+            with self._lock:
+                records, self._records = self._records, []
+                indexed, self._indexed = self._indexed, OrderedDict()
+                self._pending_count -= len(records) + sum(
+                    len(lines) for lines in indexed.values()
+                )
+                paths = list(self._pending)
+
+            if records:
+                self._save(records)
+
+            for path in paths:
+                try:
+                    with get_lock_manager().lock(path):
+                        with self._lock:
+                            lines = self._pending.pop(path, [])
+                            self._pending_count -= len(lines)
+                        if lines:
+                            self.write(path, lines)
+                except LockTimeout:  # Left in the queue, for the next flush
+                    logger.warning("Activity log of %s is locked", path)
+                except OSError:  # Eg: the disk is full
+                    logger.exception("Could not write the activity log")
+
+            if indexed:
+                self._index(indexed)
+
+    def stop(self) -> NoReturn:
+        """Stop the worker and flush whatever is left in the queue."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        self.flush()
+
+    @staticmethod
+    def write(path: AnyStr, lines: List[AnyStr]) -> NoReturn:
+        """Append the lines to the file. The caller holds its lock."""
+        try:
+            # Open the file in append mode
+            file = open(path, "a")
+        except FileNotFoundError:  # The first file of its directory
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file = open(path, "a")
+        with file:
+            file.write("".join(lines))
+
+    def _save(self, records: List[Any]) -> NoReturn:
+        model = type(records[0])
+        try:
+            model.objects.bulk_create(records, batch_size=self.max_batch_size)
+        except IntegrityError:
+            # Eg: a document was deleted meanwhile, save the rest
+            document_ids = {record.document_id for record in records}
+            existing_ids = set(
+                model._meta.get_field("document")
+                .related_model.objects.filter(id__in=document_ids)
+                .values_list("id", flat=True)
+            )
+            model.objects.bulk_create(
+                [r for r in records if r.document_id in existing_ids],
+                batch_size=self.max_batch_size,
+            )
+
+    @staticmethod
+    def _index(indexed: Dict[AnyStr, List[AnyStr]]) -> NoReturn:
+        from .search import get_search_backend
+
+        backend = get_search_backend()
+        if backend is None:  # Disabled
+            return
+        try:
+            backend.append(
+                {
+                    document_id: "".join(lines)
+                    for document_id, lines in indexed.items()
+                }
+            )
+        except DatabaseError:  # Indexed again with the next content
+            logger.exception("Could not index the activity log")
+
+    def _notify(self, is_full: bool) -> NoReturn:
+        self._ensure_worker()
+        if is_full:  # Do not wait for the interval
+            self._wakeup.set()
+
+    def _ensure_worker(self) -> NoReturn:
+        if self._worker is not None or self._stopped.is_set():
+            return
+
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="activity-log-writer", daemon=True
+                )
+                self._worker.start()
+
+    def _run(self) -> NoReturn:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:  # Keep the worker alive
+                logger.exception("Could not flush the activity log")
+            finally:
+                # The worker owns a connection of its own
+                close_old_connections()
+
+
+_writer: Optional[ActivityLogWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_activity_log_writer() -> ActivityLogWriter:
+    """Return the process wide writer, created on the first use."""
+    global _writer
+
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = ActivityLogWriter.from_settings()
+                # Make sure nothing queued is lost on shutdown
+                atexit.register(_writer.stop)
+    return _writer
@@ -0,0 +1,514 @@
+import base64
+import bisect
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from typing import Any, AnyStr, Callable, Dict, List, Optional, Tuple, Union
+
+import django
+import factory.random
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from apps.store.activity import get_activity_log_writer
+from apps.store.factory import DocumentFactory, UserFactory
+from apps.store.models import Document, UploadSession, User, UserDocument
+from apps.utils.db import temporary_databases
+from apps.utils.locks import get_lock_manager
+from apps.utils.tasks import ThreadPoolBackend, get_backend
+
+# An API call: method, url, data and optionally the extra arguments of the
+# client, eg: the headers of a chunk
+Call = Union[
+    Tuple[AnyStr, AnyStr, Any], Tuple[AnyStr, AnyStr, Any, Dict[AnyStr, Any]]
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark every action of the document and user APIs on a seeded "
+        "dataset, with a skewed sharing: throughput, latency percentiles and "
+        "query counts. The data is seeded in temporary databases, created "
+        "like the ones of the tests and dropped at the end, the files are "
+        "written to a temporary MEDIA_ROOT. Run it with the settings under "
+        "test, eg: the database and the task backend."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--documents", type=int, default=10000)
+        parser.add_argument(
+            "--shares",
+            type=int,
+            default=3,
+            help="Mean collaborators per document",
+        )
+        parser.add_argument(
+            "--skew",
+            type=float,
+            default=1.1,
+            help="Zipf exponent of the collaborators, 0: uniform",
+        )
+        parser.add_argument(
+            "--requests", type=int, default=50, help="Requests per action"
+        )
+        parser.add_argument("--warmup", type=int, default=3)
+        parser.add_argument(
+            "--actions", default="", help="Comma separated, default: all"
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument(
+            "--json", action="store_true", help="Machine readable output"
+        )
+        parser.add_argument("--output", help="Write the JSON results here")
+        parser.add_argument(
+            "--compare", help="JSON results of a baseline, eg: another commit"
+        )
+
+    def handle(self, *args, **options):
+        if options["requests"] < 2:
+            raise CommandError("At least 2 requests, for the percentiles.")
+
+        # Requests of the test client, files in a throwaway directory
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"],
+            MEDIA_ROOT=os.path.join(directory, "media"),
+        ):
+            # Committed as in production: the on commit tasks, the replica
+            # routing and the activity log writer run
+            with temporary_databases(directory):
+                try:
+                    results = self.run(**options)
+                finally:
+                    self.wait()
+
+        report = {"meta": self.get_meta(options), "results": results}
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump(report, file, indent=2)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.write_table(results)
+
+        if options["compare"]:
+            with open(options["compare"]) as file:
+                self.write_comparison(json.load(file)["results"], results)
+
+    def run(self, **options) -> Dict[AnyStr, Dict[AnyStr, Any]]:
+        rng = random.Random(options["seed"])
+        factory.random.reseed_random(options["seed"])
+
+        started = time.perf_counter()
+        user = self.seed(rng, **options)
+        self.stdout.write(
+            f"Seeded in {time.perf_counter() - started:.1f}s",
+            self.style.NOTICE,
+        )
+
+        # The failures are measured as statuses, eg: the lock timeouts
+        client = APIClient(raise_request_exception=False)
+        client.credentials(HTTP_AUTHORIZATION=f"Token {user.get_token()}")
+
+        # Distinct calls for the warmup, eg: the deletes
+        actions = self.get_actions(
+            user, rng, options["requests"] + options["warmup"]
+        )
+        if options["actions"]:
+            selected = options["actions"].split(",")
+            unknown = set(selected) - set(actions)
+            if unknown:
+                raise CommandError(f"Unknown actions: {sorted(unknown)}")
+            actions = {name: actions[name] for name in selected}
+
+        results = {
+            name: self.measure(client, calls, options["warmup"])
+            for name, calls in actions.items()
+        }
+        return results
+
+    @staticmethod
+    def wait():
+        """Let the work left in the background end, before the drop."""
+        backend = get_backend()
+        if isinstance(backend, ThreadPoolBackend):
+            backend.executor.shutdown(wait=True)
+        get_activity_log_writer().flush()
+
+    def seed(
+        self,
+        rng: random.Random,
+        users,
+        documents,
+        shares,
+        skew,
+        batch_size,
+        **options,
+    ) -> User:
+        """
+        Seed the users and the documents, shared with collaborators drawn by
+        a Zipf law: a few users get most of the shares. Returns the most
+        shared user, the one the requests are made as.
+        """
+        user_objects = [UserFactory.build() for _ in range(users)]
+        for number, user in enumerate(user_objects):
+            user.username = f"benchmark-{number}"  # Unique
+        User.objects.bulk_create(user_objects, batch_size=batch_size)
+        user_ids = [user.id for user in user_objects]
+
+        cumulative = list(
+            itertools.accumulate(
+                1 / rank**skew for rank in range(1, users + 1)
+            )
+        )
+
+        def collaborators() -> set:
+            count = min(
+                int(rng.expovariate(1 / shares)) if shares else 0, users
+            )
+            return {
+                user_ids[
+                    bisect.bisect(cumulative, rng.random() * cumulative[-1])
+                ]
+                for _ in range(count)
+            }
+
+        for start in range(0, documents, batch_size):
+            batch = [
+                Document(owner_id=rng.choice(user_ids))
+                for _ in range(min(batch_size, documents - start))
+            ]
+            Document.objects.bulk_create(batch)
+            UserDocument.objects.bulk_create(
+                (
+                    UserDocument(document_id=document.id, user_id=user_id)
+                    for document in batch
+                    for user_id in collaborators() - {document.owner_id}
+                ),
+                batch_size=batch_size,
+                ignore_conflicts=True,
+            )
+
+        return User.objects.get(id=user_ids[0])
+
+    def get_actions(
+        self, user: User, rng: random.Random, requests: int
+    ) -> Dict[AnyStr, List[Call]]:
+        """The calls of each action, on the data of the user."""
+        # Files for the file actions, and own documents to alter or delete
+        owned = [DocumentFactory(owner=user) for _ in range(requests * 2 + 10)]
+        for document in owned:
+            document.set_content(
+                ContentFile(f"{document.id} benchmark content\n".encode())
+            )
+        # A version to list, download and restore
+        for document in owned[:requests]:
+            with get_lock_manager().lock(document.get_log_path()):
+                document.create_version()
+        # Uploads of a chunk each: started, then the chunk is sent, or
+        # received already for the commit
+        chunk = bytes(rng.getrandbits(8) for _ in range(64 * 1024))
+        checksum = hashlib.sha256(chunk)
+        chunk_headers = {
+            "content_type": "application/octet-stream",
+            "HTTP_UPLOAD_OFFSET": "0",
+            "HTTP_UPLOAD_CHECKSUM": (
+                f"sha256 {base64.b64encode(checksum.digest()).decode()}"
+            ),
+        }
+        sending = [
+            UploadSession.start(document, len(chunk), checksum.hexdigest())
+            for document in owned[:requests]
+        ]
+        committed = [
+            UploadSession.start(document, len(chunk), checksum.hexdigest())
+            for document in owned[:requests]
+        ]
+        for upload in committed:
+            upload.receive(0, io.BytesIO(chunk), len(chunk), checksum.digest())
+        accessible = list(
+            Document.objects.accessible_by(user).values_list("id", flat=True)
+        )
+        others = list(
+            User.objects.exclude(id=user.id).values_list("id", flat=True)[:100]
+        )
+        readable = accessible or [owned[0].id]
+
+        def document_url(name: AnyStr, pk: AnyStr, **kwargs) -> AnyStr:
+            return reverse(
+                f"store-v1:document-{name}", kwargs={"pk": pk, **kwargs}
+            )
+
+        def upload_url(name: AnyStr, upload: UploadSession) -> AnyStr:
+            return document_url(name, upload.document_id, upload_id=upload.id)
+
+        def repeat(call: Callable[[int], Call]) -> List[Call]:
+            return [call(number) for number in range(requests)]
+
+        list_url = reverse("store-v1:document-list")
+        user_list_url = reverse("store-v1:user-list")
+        return {
+            "document-list": repeat(lambda n: ("get", list_url, {})),
+            "document-list-cursor": repeat(
+                lambda n: ("get", list_url, {"pagination": "cursor"})
+            ),
+            "document-list-owned": repeat(
+                lambda n: (
+                    "get",
+                    list_url,
+                    {"scope": "owned", "ordering": "-updated_at"},
+                )
+            ),
+            "document-list-sparse": repeat(
+                lambda n: ("get", list_url, {"fields": "id"})
+            ),
+            "document-retrieve": repeat(
+                lambda n: (
+                    "get",
+                    document_url("detail", rng.choice(readable)),
+                    {},
+                )
+            ),
+            "document-create": repeat(lambda n: ("post", list_url, {})),
+            "document-bulk": repeat(
+                lambda n: (
+                    "post",
+                    reverse("store-v1:document-bulk"),
+                    {"count": 10},
+                )
+            ),
+            "document-partial-update": repeat(
+                lambda n: ("patch", document_url("detail", owned[n].id), {})
+            ),
+            "document-update": repeat(
+                lambda n: ("put", document_url("detail", owned[n].id), {})
+            ),
+            "document-share": repeat(
+                lambda n: (
+                    "post",
+                    document_url("share", owned[n].id),
+                    {"id_list": rng.sample(others, min(5, len(others)))},
+                )
+            ),
+            "document-share-bulk": repeat(
+                lambda n: (
+                    "post",
+                    reverse("store-v1:document-share-bulk"),
+                    {
+                        "document_ids": [
+                            document.id for document in rng.sample(owned, 10)
+                        ],
+                        "user_ids": rng.sample(others, min(5, len(others))),
+                    },
+                )
+            ),
+            "document-download": repeat(
+                lambda n: ("get", document_url("download", owned[n].id), {})
+            ),
+            "document-activity": repeat(
+                lambda n: ("get", document_url("activity", owned[n].id), {})
+            ),
+            "document-search": repeat(
+                lambda n: (
+                    "get",
+                    reverse("store-v1:document-search"),
+                    {"q": "benchmark content"},
+                )
+            ),
+            "document-changes": repeat(
+                lambda n: (
+                    "get",
+                    reverse("store-v1:document-changes"),
+                    {"since": 0},
+                )
+            ),
+            "document-versions": repeat(
+                lambda n: ("get", document_url("versions", owned[n].id), {})
+            ),
+            "document-version-download": repeat(
+                lambda n: (
+                    "get",
+                    document_url("version-download", owned[n].id, number=1),
+                    {},
+                )
+            ),
+            "document-version-restore": repeat(
+                lambda n: (
+                    "post",
+                    document_url("restore", owned[n].id, number=1),
+                    {},
+                )
+            ),
+            "document-upload-start": repeat(
+                lambda n: (
+                    "post",
+                    document_url("uploads", owned[n].id),
+                    {"size": len(chunk), "checksum": checksum.hexdigest()},
+                )
+            ),
+            "document-upload-chunk": repeat(
+                lambda n: (
+                    "put",
+                    upload_url("upload", sending[n]),
+                    chunk,
+                    chunk_headers,
+                )
+            ),
+            "document-upload-commit": repeat(
+                lambda n: (
+                    "post",
+                    upload_url("commit-upload", committed[n]),
+                    {},
+                )
+            ),
+            "document-destroy": repeat(
+                lambda n: (
+                    "delete",
+                    document_url("detail", owned[requests + n].id),
+                    {},
+                )
+            ),
+            "user-list": repeat(lambda n: ("get", user_list_url, {})),
+            "user-retrieve": repeat(
+                lambda n: (
+                    "get",
+                    reverse(
+                        "store-v1:user-detail",
+                        kwargs={"pk": rng.choice(others or [user.id])},
+                    ),
+                    {},
+                )
+            ),
+        }
+
+    def measure(
+        self, client: APIClient, calls: List[Call], warmup: int
+    ) -> Dict[AnyStr, Any]:
+        for call in calls[:warmup]:
+            self.call(client, *call)
+
+        calls = calls[warmup:]
+        timings, queries, statuses = [], [], {}
+        started = time.perf_counter()
+        for call in calls:
+            with CaptureQueriesContext(connection) as captured:
+                call_started = time.perf_counter()
+                status = self.call(client, *call)
+                timings.append((time.perf_counter() - call_started) * 1000)
+            queries.append(len(captured))
+            statuses[status] = statuses.get(status, 0) + 1
+        elapsed = time.perf_counter() - started
+
+        quantiles = statistics.quantiles(timings, n=100, method="inclusive")
+        return {
+            "requests": len(calls),
+            "throughput": len(calls) / elapsed,  # Requests per second
+            "latency_ms": {
+                "mean": statistics.mean(timings),
+                "p50": quantiles[49],
+                "p90": quantiles[89],
+                "p99": quantiles[98],
+                "max": max(timings),
+            },
+            "queries": {
+                "mean": statistics.mean(queries),
+                "max": max(queries),
+            },
+            "statuses": {
+                str(status): count for status, count in statuses.items()
+            },
+        }
+
+    @staticmethod
+    def call(
+        client: APIClient,
+        method: AnyStr,
+        url: AnyStr,
+        data: Any,
+        extra: Optional[Dict[AnyStr, Any]] = None,
+    ) -> int:
+        response = getattr(client, method)(url, data, **(extra or {}))
+        if response.streaming:  # Read as a client would
+            for _ in response.streaming_content:
+                pass
+        return response.status_code
+
+    @staticmethod
+    def get_meta(options: Dict[AnyStr, Any]) -> Dict[AnyStr, Any]:
+        try:
+            commit = subprocess.run(
+                ["git", "rev-parse", "HEAD"],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+
+        return {
+            "commit": commit,
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "options": {
+                key: options[key]
+                for key in (
+                    "users",
+                    "documents",
+                    "shares",
+                    "skew",
+                    "requests",
+                    "warmup",
+                    "seed",
+                )
+            },
+        }
+
+    def write_table(self, results: Dict[AnyStr, Dict[AnyStr, Any]]):
+        self.stdout.write(
+            f"{'action':<24} {'req/s':>8} {'p50':>8} {'p90':>8} {'p99':>8} "
+            f"{'queries':>8}  (ms)"
+        )
+        for name, row in results.items():
+            latency = row["latency_ms"]
+            self.stdout.write(
+                f"{name:<24} {row['throughput']:>8.1f} {latency['p50']:>8.2f} "
+                f"{latency['p90']:>8.2f} {latency['p99']:>8.2f} "
+                f"{row['queries']['mean']:>8.1f}"
+            )
+
+    def write_comparison(
+        self,
+        baseline: Dict[AnyStr, Dict[AnyStr, Any]],
+        results: Dict[AnyStr, Dict[AnyStr, Any]],
+    ):
+        self.stdout.write(
+            f"{'action':<24} {'p50 %':>8} {'p99 %':>8} {'queries':>8}"
+        )
+        for name, row in results.items():
+            if name not in baseline:
+                continue
+            before = baseline[name]
+
+            def change(key: AnyStr) -> float:
+                previous = before["latency_ms"][key]
+                return (row["latency_ms"][key] - previous) / previous * 100
+
+            self.stdout.write(
+                f"{name:<24} {change('p50'):>+8.1f} {change('p99'):>+8.1f} "
+                f"{row['queries']['mean'] - before['queries']['mean']:>+8.1f}"
+            )
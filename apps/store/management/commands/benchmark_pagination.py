@@ -0,0 +1,109 @@
+import json
+import statistics
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from django.core.management.base import BaseCommand
+
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from apps.store.factory import DocumentFactory, UserFactory
+from apps.store.models import Document
+from apps.utils.db import temporary_databases
+from apps.utils.pagination import CustomPageNumberPagination, KeysetPagination
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the latency of deep pages of the document list between the "
+        "page number and the keyset pagination. The data is seeded in "
+        "temporary databases, created like the ones of the tests and "
+        "dropped at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--documents", type=int, default=20000)
+        parser.add_argument("--limit", type=int, default=50)
+        parser.add_argument(
+            "--pages", default="1,10,100,400", help="Comma separated pages"
+        )
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument(
+            "--json", action="store_true", help="Machine readable output"
+        )
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory, temporary_databases(
+            directory
+        ):
+            results = self.run(**options)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(
+            f"{'page':>6} {'page number':>12} {'no count':>12} "
+            f"{'keyset':>12}  (median ms)"
+        )
+        for row in results:
+            self.stdout.write(
+                f"{row['page']:>6} {row['page_number']:>12.2f} "
+                f"{row['page_number_no_count']:>12.2f} {row['keyset']:>12.2f}"
+            )
+
+    def run(self, documents, limit, pages, repeat, **options):
+        owner = UserFactory()
+        Document.objects.bulk_create(
+            DocumentFactory.build(owner=owner) for _ in range(documents)
+        )
+        queryset = Document.objects.accessible_by(owner)
+        factory = APIRequestFactory()
+
+        def measure(paginator_class: type, params: Dict) -> float:
+            request = Request(factory.get("/", params))
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                paginator_class().paginate_queryset(queryset, request)
+                timings.append((time.perf_counter() - started) * 1000)
+            return statistics.median(timings)
+
+        results: List[Dict[str, Any]] = []
+        for page in [int(page) for page in pages.split(",")]:
+            if (page - 1) * limit >= documents:
+                break
+
+            params = {"page": page, "limit": limit}
+            results.append(
+                {
+                    "page": page,
+                    "page_number": measure(CustomPageNumberPagination, params),
+                    "page_number_no_count": measure(
+                        CustomPageNumberPagination, {**params, "count": "0"}
+                    ),
+                    "keyset": measure(
+                        KeysetPagination,
+                        self.get_keyset_params(queryset, page, limit),
+                    ),
+                }
+            )
+        return results
+
+    @staticmethod
+    def get_keyset_params(queryset: Any, page: int, limit: int) -> Dict:
+        """Parameters of the keyset request landing on the same page."""
+        params = {"limit": limit}
+        if page == 1:
+            return params
+
+        paginator = KeysetPagination()
+        paginator.ordering = paginator.get_ordering(queryset)
+        # Last row of the previous page, not part of the measured time
+        last = queryset.order_by(*paginator.ordering)[(page - 1) * limit - 1]
+        params[paginator.cursor_query_param] = paginator.encode_cursor(
+            paginator.get_position(last)
+        )
+        return params
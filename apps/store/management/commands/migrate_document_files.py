@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from apps.store.models import Document
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the private document files, eg: of the flat documents/<id>.txt "
+        "layout, into the content-addressed storage, in batches: the "
+        "identical files are then stored once. Safe to re-run. Run it while "
+        "no file is replaced."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Only count the files"
+        )
+
+    def handle(self, *args, **options):
+        storage = Document._meta.get_field("file").storage
+        queryset = (
+            Document.objects.exclude(file="")
+            .exclude(file__contains=f"/{storage.blob_directory}/")
+            .order_by("id")
+            .only("id", "file", "updated_at")
+        )
+
+        if options["dry_run"]:
+            self.stdout.write(f"{queryset.count()} files to move")
+            return
+
+        moved = 0
+        last_id = ""
+        while True:
+            # Keyset on the id, the moved rows leave the queryset anyway
+            batch = list(
+                queryset.filter(id__gt=last_id)[: options["batch_size"]]
+            )
+            if not batch:
+                break
+
+            # The references are counted along with the rows
+            with transaction.atomic():
+                for document in batch:
+                    previous_name = document.file.name
+                    # Copied, the private file is deleted once no row
+                    # refers to it: an interrupted run loses nothing
+                    with storage.open(previous_name, "rb") as file:
+                        document.file = storage.save_content_addressed(
+                            file, directory="documents", extension=".txt"
+                        )
+                    document.updated_at = timezone.now()  # A new file url
+                    storage.release(previous_name)
+
+                Document.objects.bulk_update(batch, ["file", "updated_at"])
+            moved += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write(f"{moved} files moved")
+
+        self.stdout.write(self.style.SUCCESS(f"Done, {moved} files moved"))
@@ -0,0 +1,29 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.store.models import DocumentChange
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the changes older than DOCUMENT_CHANGES_RETENTION days, eg: "
+        "from a cron job. The clients with an older cursor sync again."
+    )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(
+            days=settings.DOCUMENT_CHANGES["RETENTION"]
+        )
+        latest = (
+            DocumentChange.objects.order_by("-id")
+            .values_list("id", flat=True)
+            .first()
+        )
+        # The latest is kept, the feed tells the purged cursors by it
+        count, _ = DocumentChange.objects.filter(
+            created_at__lt=cutoff, id__lt=latest or 0
+        ).delete()
+        self.stdout.write(f"Purged {count} changes.")
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.store.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the expired uploads along with their part files, eg: from a "
+        "cron job."
+    )
+
+    def handle(self, *args, **options):
+        # One by one, the signal deletes the part file
+        count = 0
+        for upload in UploadSession.objects.filter(
+            expires_at__lte=timezone.now()
+        ).iterator():
+            upload.delete()
+            count += 1
+        self.stdout.write(f"Purged {count} uploads.")
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.store.models import Document
+from apps.store.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = (
+        "Index the files of the documents again, eg: after a change of the "
+        "search backend. Run it while no file is written, the writes in "
+        "between could be indexed twice."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--missing",
+            action="store_true",
+            help="Only the documents that are not indexed",
+        )
+
+    def handle(self, *args, **options):
+        if get_search_backend() is None:
+            raise CommandError("The search is disabled, see SEARCH_BACKEND.")
+
+        documents = Document.objects.order_by("id")
+        if options["missing"]:
+            documents = documents.filter(search_entry__isnull=True)
+
+        count = 0
+        for document in documents.iterator():
+            document.update_search_index()
+            count += 1
+        self.stdout.write(f"Indexed {count} documents.")
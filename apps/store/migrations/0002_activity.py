@@ -0,0 +1,93 @@
+# Generated by Django 4.0.1 on 2026-10-18 08:36
+
+import apps.utils.models
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Activity",
+            fields=[
+                (
+                    "id",
+                    models.CharField(
+                        default=apps.utils.models.get_short_uuid,
+                        editable=False,
+                        max_length=12,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("actor_type", models.CharField(max_length=16)),
+                (
+                    "operation",
+                    models.CharField(
+                        choices=[
+                            ("Upload", "Upload"),
+                            ("Edit", "Edit"),
+                            ("Download", "Download"),
+                            ("Share", "Share"),
+                        ],
+                        max_length=16,
+                    ),
+                ),
+                (
+                    "timestamp",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+                (
+                    "actor",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="activities",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "document",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="activities",
+                        to="store.document",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "Activities",
+                "ordering": ("-timestamp", "-id"),
+            },
+        ),
+        migrations.AddIndex(
+            model_name="activity",
+            index=models.Index(
+                fields=["document", "-timestamp", "-id"],
+                name="activity_document_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="activity",
+            index=models.Index(
+                fields=["document", "operation", "-timestamp", "-id"],
+                name="activity_document_op_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="activity",
+            index=models.Index(
+                fields=["actor", "-timestamp", "-id"],
+                name="activity_actor_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,64 @@
+from django.db import migrations
+from django.db.models import Count, Q
+
+# Duplicated (user, document) pairs handled per batch
+BATCH_SIZE = 500
+
+
+def deduplicate_user_documents(apps, schema_editor):
+    """
+    Keep the first share of every (user, document) pair, so that the unique
+    constraint can be added. The pairs are streamed and handled in batches.
+    """
+    UserDocument = apps.get_model("store", "UserDocument")
+    duplicates = (
+        UserDocument.objects.values("user_id", "document_id")
+        .annotate(shares=Count("id"))
+        .filter(shares__gt=1)
+        .order_by()
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+
+    batch = []
+    for pair in duplicates:
+        batch.append(pair)
+        if len(batch) == BATCH_SIZE:
+            delete_duplicates(UserDocument, batch)
+            batch = []
+    if batch:
+        delete_duplicates(UserDocument, batch)
+
+
+def delete_duplicates(UserDocument, pairs):
+    pair_filter = Q()
+    for pair in pairs:
+        pair_filter |= Q(
+            user_id=pair["user_id"], document_id=pair["document_id"]
+        )
+
+    kept = set()
+    duplicate_ids = []
+    for pk, user_id, document_id in (
+        UserDocument.objects.filter(pair_filter)
+        .order_by("created_at", "id")
+        .values_list("id", "user_id", "document_id")
+    ):
+        if (user_id, document_id) in kept:
+            duplicate_ids.append(pk)
+        else:
+            kept.add((user_id, document_id))
+
+    UserDocument.objects.filter(id__in=duplicate_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0003_pagination_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            deduplicate_user_documents, migrations.RunPython.noop
+        ),
+    ]
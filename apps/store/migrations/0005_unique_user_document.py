@@ -0,0 +1,31 @@
+# Generated by Django 4.0.1 on 2026-10-18 08:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0004_deduplicate_userdocument"),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name="userdocument",
+            constraint=models.UniqueConstraint(
+                fields=("user", "document"), name="unique_user_document"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="userdocument",
+            name="user",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="user_documents",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.0.1 on 2026-10-18 08:44
+
+import apps.store.models
+import apps.utils.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0005_unique_user_document"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="document",
+            name="file",
+            field=models.FileField(
+                blank=True,
+                db_index=True,
+                storage=apps.utils.storage.get_document_storage,
+                upload_to=apps.store.models.document_file_path,
+            ),
+        ),
+    ]
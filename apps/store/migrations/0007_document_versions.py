@@ -0,0 +1,109 @@
+# Generated by Django 4.0.1 on 2026-10-18 09:07
+
+import apps.utils.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0006_sharded_document_files"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DocumentVersion",
+            fields=[
+                (
+                    "id",
+                    models.CharField(
+                        default=apps.utils.models.get_short_uuid,
+                        editable=False,
+                        max_length=12,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("number", models.PositiveIntegerField()),
+                ("size", models.BigIntegerField()),
+                ("digest", models.CharField(max_length=64)),
+                (
+                    "snapshot",
+                    models.CharField(
+                        blank=True, db_index=True, max_length=255
+                    ),
+                ),
+                (
+                    "document",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="versions",
+                        to="store.document",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "Document Versions",
+                "ordering": ("-number",),
+            },
+        ),
+        migrations.AlterField(
+            model_name="activity",
+            name="operation",
+            field=models.CharField(
+                choices=[
+                    ("Upload", "Upload"),
+                    ("Edit", "Edit"),
+                    ("Download", "Download"),
+                    ("Share", "Share"),
+                    ("Restore", "Restore"),
+                ],
+                max_length=16,
+            ),
+        ),
+        migrations.CreateModel(
+            name="VersionChunk",
+            fields=[
+                (
+                    "id",
+                    models.CharField(
+                        default=apps.utils.models.get_short_uuid,
+                        editable=False,
+                        max_length=12,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("position", models.PositiveIntegerField()),
+                ("name", models.CharField(db_index=True, max_length=255)),
+                (
+                    "version",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="chunks",
+                        to="store.documentversion",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ("position",),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="versionchunk",
+            constraint=models.UniqueConstraint(
+                fields=("version", "position"), name="unique_version_chunk"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="documentversion",
+            constraint=models.UniqueConstraint(
+                fields=("document", "number"), name="unique_document_version"
+            ),
+        ),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 4.0.1 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_search_index(apps, schema_editor):
+    """The full-text index of the database, see apps/store/search.py."""
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE store_search USING fts5(content)"
+        )
+    elif vendor == "postgresql":
+        schema_editor.execute(
+            "ALTER TABLE store_searchentry ADD COLUMN vector tsvector"
+        )
+        schema_editor.execute(
+            "CREATE INDEX search_vector_idx ON store_searchentry "
+            "USING GIN (vector)"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS store_search")
+    elif vendor == "postgresql":
+        schema_editor.execute(
+            "ALTER TABLE store_searchentry DROP COLUMN IF EXISTS vector"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0008_upload_sessions"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SearchEntry",
+            fields=[
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("size", models.PositiveIntegerField(default=0)),
+                (
+                    "document",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="search_entry",
+                        to="store.document",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "Search Entries",
+            },
+        ),
+        migrations.CreateModel(
+            name="SearchTerm",
+            fields=[
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("term", models.CharField(max_length=64)),
+                ("frequency", models.PositiveIntegerField()),
+                (
+                    "entry",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="terms",
+                        to="store.searchentry",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="searchterm",
+            index=models.Index(
+                fields=["term", "entry"], name="search_term_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="searchterm",
+            constraint=models.UniqueConstraint(
+                fields=("entry", "term"), name="unique_search_term"
+            ),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
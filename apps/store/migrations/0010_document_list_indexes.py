@@ -0,0 +1,46 @@
+# Generated by Django 4.0.1 on 2026-10-18 09:16
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0009_search"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="document",
+            index=models.Index(
+                fields=["-updated_at", "-id"], name="document_updated_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="document",
+            index=models.Index(
+                fields=["owner", "-created_at", "-id"],
+                name="document_owner_created_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="document",
+            index=models.Index(
+                fields=["owner", "-updated_at", "-id"],
+                name="document_owner_updated_idx",
+            ),
+        ),
+        # Covered by the owner indexes, once they are built
+        migrations.AlterField(
+            model_name="document",
+            name="owner",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="documents",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.0.1 on 2026-10-18 09:18
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0010_document_list_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DocumentChange",
+            fields=[
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("document_id", models.CharField(max_length=10)),
+                (
+                    "operation",
+                    models.CharField(
+                        choices=[
+                            ("create", "Create"),
+                            ("update", "Update"),
+                            ("share", "Share"),
+                            ("unshare", "Unshare"),
+                            ("delete", "Delete"),
+                        ],
+                        max_length=16,
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="document_changes",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="documentchange",
+            index=models.Index(
+                fields=["user", "id"], name="document_change_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="documentchange",
+            index=models.Index(
+                fields=["created_at"], name="document_change_created_idx"
+            ),
+        ),
+    ]
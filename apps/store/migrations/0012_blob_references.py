@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+def count_references(apps, schema_editor):
+    """The references to the content-addressed document files."""
+    Blob = apps.get_model("utils", "Blob")
+    Document = apps.get_model("store", "Document")
+
+    Blob.objects.filter(name__startswith="documents/").delete()
+    references = (
+        Document.objects.filter(file__contains="/blobs/")
+        .order_by()
+        .values("file")
+        .annotate(count=models.Count("id"))
+        .values_list("file", "count")
+    )
+    Blob.objects.bulk_create(
+        (Blob(name=name, references=count) for name, count in references),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("utils", "0003_blob"),
+        ("store", "0011_document_changes"),
+    ]
+
+    operations = [
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations, models
+
+
+def count_references(apps, schema_editor):
+    """The references to the chunks and the snapshots of the versions."""
+    Blob = apps.get_model("utils", "Blob")
+    DocumentVersion = apps.get_model("store", "DocumentVersion")
+    VersionChunk = apps.get_model("store", "VersionChunk")
+
+    Blob.objects.filter(name__startswith="versions/").delete()
+    references = {}
+    for name, count in (
+        VersionChunk.objects.order_by()
+        .values("name")
+        .annotate(count=models.Count("id"))
+        .values_list("name", "count")
+    ):
+        references[name] = references.get(name, 0) + count
+    for name, count in (
+        DocumentVersion.objects.exclude(snapshot="")
+        .order_by()
+        .values("snapshot")
+        .annotate(count=models.Count("id"))
+        .values_list("snapshot", "count")
+    ):
+        references[name] = references.get(name, 0) + count
+    Blob.objects.bulk_create(
+        (
+            Blob(name=name, references=count)
+            for name, count in references.items()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("store", "0012_blob_references"),
+    ]
+
+    operations = [
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.1 on 2026-10-18 10:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_version_blob_references'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='status',
+            field=models.CharField(choices=[('Uploading', 'Uploading'), ('Committing', 'Committing'), ('Failed', 'Failed')], default='Uploading', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='writers',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.1 on 2026-10-18 10:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0014_upload_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='documentchange',
+            name='document_id',
+            field=models.CharField(max_length=12),
+        ),
+    ]
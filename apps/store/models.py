@@ -1,13 +1,49 @@
-from typing import Any, AnyStr, List, NoReturn, Union
+import base64
+import hashlib
+import os
+import posixpath
+from collections import Counter
+from datetime import timedelta
+from itertools import islice
+from typing import (
+    Any,
+    AnyStr,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    NoReturn,
+    Tuple,
+    Union,
+)
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.core.files.base import ContentFile
-from django.db import models, transaction
+from django.core.files import File
+from django.db import (
+    DatabaseError,
+    connections,
+    models,
+    router,
+    transaction,
+)
 from django.utils import timezone
 
 from rest_framework.authtoken.models import Token
 from rest_framework.settings import api_settings
 
+from apps.utils.locks import get_lock_manager
 from apps.utils.models import BaseModel
+from apps.utils.profiling import add_bytes_written, instrument
+from apps.utils.storage import (
+    ChecksumMismatch,
+    get_document_storage,
+    get_sharded_name,
+)
+from apps.utils.tasks import enqueue, has_pending
+
+from .access import invalidate_accessible_documents
+from .activity import get_activity_log_writer
 
 
 class User(AbstractUser, BaseModel):
@@ -17,6 +53,12 @@ class User(AbstractUser, BaseModel):
     This is added so that in the future more fields related to user can added.
     """
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Keyset pagination of the users
+            models.Index(fields=["created_at", "id"], name="user_created_idx")
+        ]
+
     def __str__(self) -> AnyStr:
         return f"{self.get_username()}, {self.email} ({self.id})"
 
@@ -25,14 +67,77 @@ class User(AbstractUser, BaseModel):
         return token.key
 
 
+class DocumentQuerySet(models.QuerySet):
+    def owned_by(self, user: User) -> "DocumentQuerySet":
+        """Documents owned by the user."""
+        return self.filter(owner_id=user.id)
+
+    def shared_with(self, user: User) -> "DocumentQuerySet":
+        """Documents shared with the user, by their owners."""
+        return self.filter(
+            id__in=UserDocument.objects.filter(user_id=user.id)
+            .order_by()
+            .values("document_id")
+        )
+
+    def accessible_by(self, user: User) -> "DocumentQuerySet":
+        """
+        Documents owned by or shared with the user.
+
+        Resolved as a single IN over the UNION of the owned and the shared
+        document ids, instead of an OR across a join on the shared users:
+        both sides are plain index lookups and no row is repeated for the
+        documents having several collaborators.
+        """
+        owned_ids = (
+            Document.objects.filter(owner_id=user.id).order_by().values("id")
+        )
+        shared_ids = (
+            UserDocument.objects.filter(user_id=user.id)
+            .order_by()
+            .values("document_id")
+        )
+        return self.filter(id__in=owned_ids.union(shared_ids, all=True))
+
+
+def read_files(paths: List[AnyStr], size: int) -> Iterator[bytes]:
+    """The content of the files, one after the other, in chunks of the size."""
+    buffer = b""
+    for path in paths:
+        with open(path, "rb") as file:
+            for data in iter(lambda: file.read(size - len(buffer)), b""):
+                buffer += data
+                if len(buffer) == size:
+                    yield buffer
+                    buffer = b""
+    if buffer:
+        yield buffer
+
+
+def document_file_path(instance: Any, filename: AnyStr) -> AnyStr:
+    """Sharded path of the file of a document."""
+    return get_sharded_name("documents", filename)
+
+
 class Document(BaseModel):
     """The model that represents the uploaded document."""
 
     owner = models.ForeignKey(
-        User, on_delete=models.CASCADE, related_name="documents"
+        User,
+        on_delete=models.CASCADE,
+        related_name="documents",
+        db_index=False,  # Leading column of the owner indexes
+    )
+    # Local file storage reference, content-addressed and shared between
+    # the identical documents, see get_file_paths() for the activity lines.
+    # Private to the document for the files saved before, see the
+    # migrate_document_files command
+    file = models.FileField(
+        blank=True,
+        upload_to=document_file_path,
+        storage=get_document_storage,
+        db_index=True,  # Reference counting of the shared files
     )
-    # Local file storage reference
-    file = models.FileField(blank=True, upload_to="documents")
 
     # Collaborators
     shared_users = models.ManyToManyField(
@@ -41,9 +146,29 @@ class Document(BaseModel):
         related_name="shared_documents",
     )
 
+    objects = DocumentQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "Documents"
         ordering = ("-created_at",)  # Latest first
+        indexes = [
+            # Keyset pagination of the documents
+            models.Index(
+                fields=["-created_at", "-id"], name="document_created_idx"
+            ),
+            models.Index(
+                fields=["-updated_at", "-id"], name="document_updated_idx"
+            ),
+            # The owned documents, in either order, eg: ?scope=owned
+            models.Index(
+                fields=["owner", "-created_at", "-id"],
+                name="document_owner_created_idx",
+            ),
+            models.Index(
+                fields=["owner", "-updated_at", "-id"],
+                name="document_owner_updated_idx",
+            ),
+        ]
 
     def file_url(self) -> Union[AnyStr, None]:
         """Return file url."""
@@ -51,67 +176,466 @@ class Document(BaseModel):
             return self.file.url
         return None
 
+    def get_log_path(self) -> AnyStr:
+        """
+        Path of the activity lines of the document, read after the content
+        of its file. Private to the document, the content can be shared.
+        """
+        return self.file.storage.path(
+            get_sharded_name("documents", f"{self.id}.log")
+        )
+
+    def get_file_paths(self) -> List[AnyStr]:
+        """The files read as the file of the document, one after the other."""
+        paths = [self.file.path]
+        log_path = self.get_log_path()
+        if os.path.exists(log_path):
+            paths.append(log_path)
+        return paths
+
+    @classmethod
+    def save_empty_content(cls, references: int = 1) -> AnyStr:
+        """
+        The empty content, shared by all the empty documents. Referenced
+        `references` times, in the current transaction.
+        """
+        storage = cls._meta.get_field("file").storage
+        return storage.save_bytes_content_addressed(
+            b"", directory="documents", extension=".txt", references=references
+        )
+
+    @instrument("file-create")
     def create_document(self) -> NoReturn:
-        """Create the document file for the object."""
+        """
+        Create the document file for the object, unless set on insert, then
+        index it and log its upload.
+        """
 
         if bool(self.file) is False:  # If the file doesn't exist, create
-            self.file.save(f"{self.id}.txt", ContentFile(""))
-            self.save(update_fields=["file"])
-            self.append_content_to_file("Owner - Upload")
+            # Referenced along with the row
+            with transaction.atomic():
+                self.file = self.save_empty_content()
+                self.save(update_fields=["file", "updated_at"])
+        self.update_search_index("")
+        # A file operation itself, not queued behind its own task
+        self.log_activity(self.owner, Activity.Operation.UPLOAD, queued=False)
 
-    def append_content_to_file(self, content: AnyStr) -> NoReturn:
+    @classmethod
+    def bulk_create_documents(
+        cls, owner: User, number: int
+    ) -> Tuple[List["Document"], List[Tuple[int, AnyStr]]]:
         """
-        If the file exists, append the content to the end along with timestamp.
+        Create the documents of the owner along with their files.
+
+        The documents share the empty content, each activity log is written
+        once, with its upload line, and the rows are inserted with a single
+        bulk create. Returns the created documents and the (position, error)
+        of the ones that failed.
         """
-        if self.file:  # Since field can be null
-            # Format the timestamp details
-            timestamp = timezone.localtime(timezone.now()).strftime(
-                api_settings.DATETIME_FORMAT
+        line: AnyStr = cls.format_log_line(
+            f"Owner - {Activity.Operation.UPLOAD}"
+        )
+        writer = get_activity_log_writer()
+        documents: List[Document] = []
+        errors: List[Tuple[int, AnyStr]] = []
+
+        for position in range(number):
+            document = cls(owner=owner)
+            try:
+                writer.write(document.get_log_path(), [line])
+            except OSError as error:
+                errors.append((position, str(error)))
+                continue
+            documents.append(document)
+
+        try:
+            with transaction.atomic():
+                # Referenced by each row, counted along with them
+                name: AnyStr = cls.save_empty_content(
+                    references=len(documents)
+                )
+                for document in documents:
+                    document.file = name
+                cls.objects.bulk_create(documents)
+        except DatabaseError:
+            # No row points to the logs
+            for document in documents:
+                os.remove(document.get_log_path())
+            raise
+
+        # Bulk creates send no signal
+        invalidate_accessible_documents([owner.id])
+        DocumentChange.record(
+            DocumentChange.Operation.CREATE,
+            ((owner.id, document.id) for document in documents),
+        )
+        from .search import get_search_backend
+
+        backend = get_search_backend()
+        if backend is not None and documents:
+            backend.create({document.id: line for document in documents})
+
+        timestamp = timezone.now()
+        for document in documents:
+            writer.record(
+                Activity(
+                    document_id=document.id,
+                    actor_id=owner.id,
+                    actor_type="Owner",
+                    operation=Activity.Operation.UPLOAD,
+                    timestamp=timestamp,
+                )
+            )
+        return documents, errors
+
+    def set_content(self, content: File) -> NoReturn:
+        """
+        Replace the content of the file, its activity lines included. It is
+        saved in the content-addressed storage, so identical contents are
+        stored once.
+        """
+        storage = self.file.storage
+        previous_name: Union[AnyStr, None] = self.file.name or None
+
+        # The references are counted along with the row
+        with transaction.atomic():
+            self.file = storage.save_content_addressed(
+                content, directory="documents", extension=".txt"
             )
-            # Open the file in append mode
-            file = open(self.file.path, "a")
+            with get_lock_manager().lock(self.get_log_path()):
+                self.clear_log()
+            self.save(update_fields=["file", "updated_at"])
+            if previous_name:
+                storage.release(previous_name)
+        self.update_search_index()
+
+    def clear_log(self) -> NoReturn:
+        """
+        Drop the activity lines, the queued and the written ones. The caller
+        holds the lock of the log.
+        """
+        self.delete_log(self.get_log_path())
 
-            # Add the timestamp details to content
-            file.write(f"{timestamp} - {content} \n")
-            file.close()
+    @staticmethod
+    def delete_log(log_path: AnyStr) -> NoReturn:
+        """Drop the lines of the log at the path, see clear_log()."""
+        get_activity_log_writer().discard(log_path)
+        try:
+            os.remove(log_path)
+        except FileNotFoundError:
+            pass
 
-    def add_shared_users(self, id_list: List[AnyStr]) -> NoReturn:
-        """Add valid users to the document."""
-        # Exclude already added users
-        user_queryset = User.objects.filter(id__in=id_list).exclude(
-            id__in=self.shared_users.values("id")
+    def record_activity(self, actor: User, operation: AnyStr) -> "Activity":
+        """
+        Record the operation of the actor as a structured activity record
+        only, eg: a download, which leaves the file it serves as it is.
+        """
+        activity = Activity(
+            document_id=self.id,
+            actor_id=actor.id,
+            actor_type=self.get_user_type(actor),
+            operation=operation,
+            timestamp=timezone.now(),
         )
+        get_activity_log_writer().record(activity)
+        return activity
 
-        # Create User document objects
-        user_document_objects: List[Any] = [
-            UserDocument(document=self, user=user)
-            for user in user_queryset.iterator()
-        ]
+    def log_activity(
+        self, actor: User, operation: AnyStr, queued: bool = True
+    ) -> NoReturn:
+        """
+        Record the operation of the actor on the document, both as a line in
+        the file and as a structured activity record.
+        """
+        activity = self.record_activity(actor, operation)
+        self.append_content_to_file(
+            f"{activity.actor_type} - {operation}",
+            idempotency_key=f"activity:{activity.id}",
+            queued=queued,
+        )
+
+    @instrument("file-append")
+    def append_content_to_file(
+        self,
+        content: AnyStr,
+        idempotency_key: Union[AnyStr, None] = None,
+        queued: bool = True,
+    ) -> NoReturn:
+        """
+        Append the content to the end of the file along with timestamp.
+
+        Queued after the pending file operations of the document, eg: a
+        truncate, else written at once. The timestamp is the one of the call.
+        Queued along with the path of the log: the task makes no query.
+        """
+        line: AnyStr = self.format_log_line(content)
+        if queued and has_pending(self.get_task_group()):
+            self.enqueue_file_operation(
+                "store.append_document_file",
+                line,
+                self.get_log_path() if self.file else None,
+                idempotency_key=idempotency_key,
+            )
+        else:
+            self.write_to_file(line)
 
-        # Create in bulk manner
-        UserDocument.objects.bulk_create(
-            user_document_objects, ignore_conflicts=True  # If any
+    @instrument("file-write")
+    def write_to_file(self, line: AnyStr) -> NoReturn:
+        """
+        If the file exists, append the line.
+
+        The write is buffered by the activity log writer and lands in the file
+        with the next batch, under the lock of the file. So does the line in
+        the search index.
+        """
+        if self.file:  # Since field can be null
+            self.write_line(self.id, self.get_log_path(), line)
+
+    @staticmethod
+    def write_line(
+        document_id: AnyStr, log_path: AnyStr, line: AnyStr
+    ) -> NoReturn:
+        """Append the line to the log at the path, see write_to_file()."""
+        writer = get_activity_log_writer()
+        writer.append(log_path, line)
+        add_bytes_written(len(line.encode()))
+        writer.index(document_id, line)
+
+    def enqueue_file_operation(
+        self,
+        name: AnyStr,
+        *args,
+        idempotency_key: Union[AnyStr, None] = None,
+    ) -> NoReturn:
+        """
+        Run the task in the background, after the earlier file operations of
+        the document: they share its group.
+        """
+        enqueue(
+            name,
+            self.id,
+            *args,
+            group=self.get_task_group(),
+            idempotency_key=idempotency_key,
         )
 
+    def get_task_group(self) -> AnyStr:
+        return f"document:{self.id}"
+
+    @staticmethod
+    def format_log_line(content: AnyStr) -> AnyStr:
+        """Add the timestamp details to content."""
+        # Format the timestamp details, at the time of the operation
+        timestamp = timezone.localtime(timezone.now()).strftime(
+            api_settings.DATETIME_FORMAT
+        )
+        return f"{timestamp} - {content} \n"
+
+    @instrument("share")
+    def add_shared_users(self, id_list: List[AnyStr]) -> int:
+        """Add valid users to the document, returns the number added."""
+        return self.share_documents([self], id_list).get(self.id, 0)
+
+    @classmethod
+    def share_documents(
+        cls, documents: List["Document"], id_list: List[AnyStr]
+    ) -> Dict[AnyStr, int]:
+        """
+        Add valid users to all the documents, in one transaction.
+
+        The rows are upserted in chunked bulk inserts: the already added
+        users are skipped by the unique (user, document) constraint. Returns
+        the number of the users added to each document, by its id, counted
+        from the rows the inserts returned: the ones with none are left out.
+        """
+        user_ids: List[AnyStr] = list(
+            User.objects.filter(id__in=id_list).values_list("id", flat=True)
+        )
+        document_ids: List[AnyStr] = [document.id for document in documents]
+        user_document_objects: Iterable[UserDocument] = (
+            UserDocument(document_id=document_id, user_id=user_id)
+            for document_id in document_ids
+            for user_id in user_ids
+        )
+        added: Counter = Counter()
+
+        with transaction.atomic():
+            # Bounded memory, whatever the size of the matrix
+            while True:
+                batch = list(
+                    islice(user_document_objects, UserDocument.BATCH_SIZE)
+                )
+                if not batch:
+                    break
+                added.update(UserDocument.insert_new(batch))
+            # Bulk creates send no signal. The already added users get a
+            # change too, their clients fetch the document again
+            invalidate_accessible_documents(user_ids)
+            DocumentChange.record(
+                DocumentChange.Operation.SHARE,
+                (
+                    (user_id, document_id)
+                    for document_id in document_ids
+                    for user_id in user_ids
+                ),
+            )
+        return dict(added)
+
     def get_user_type(self, user: User) -> AnyStr:
-        if self.owner == user:
+        if self.owner_id == user.id:
             return "Owner"
 
         return "Collaborator"
 
+    @instrument("file-truncate")
     def truncate_the_file_content(self) -> NoReturn:
         """Truncates the file."""
         # Make sure this is thread safe.
         cls = self.__class__
 
         with transaction.atomic():
-            instance = cls.objects.select_for_update().get(pk=self.pk)
-            instance.save(update_fields=["updated_at"])
+            # Locks the row. A write first, on SQLite too: see
+            # SearchBackend.replace
+            if not cls.objects.filter(pk=self.pk).update(
+                updated_at=timezone.now()
+            ):
+                return  # Deleted meanwhile
             if self.file:  # Since field can be null
-                # Open the file in r+ mode
-                file = open(self.file.path, "r+")
-                file.truncate(0)
-                file.close()
+                storage = self.file.storage
+                previous_name: AnyStr = self.file.name
+
+                # Row locks are a no-op on SQLite, the lock of the log
+                # serializes the truncate with the appends of the other
+                # processes
+                with get_lock_manager().lock(self.get_log_path()):
+                    # The history is kept
+                    self.create_version()
+
+                    self.file = self.save_empty_content()
+                    self.clear_log()
+                    self.save(update_fields=["file", "updated_at"])
+                storage.release(previous_name)
+                self.update_search_index("")
+
+    def create_version(self) -> Union["DocumentVersion", None]:
+        """
+        Version the current content of the file, its queued lines included.
+        The caller holds the lock of the log. None when the file is empty.
+        """
+        writer = get_activity_log_writer()
+        lines = writer.discard(self.get_log_path())
+        if lines:
+            writer.write(self.get_log_path(), lines)
+        return DocumentVersion.create_from_files(self, self.get_file_paths())
+
+    @instrument("file-restore")
+    def restore_version(self, version: "DocumentVersion") -> NoReturn:
+        """
+        Replace the content of the file with the one of the version. The
+        current content is versioned first, so a restore can be undone.
+        """
+        cls = self.__class__
+
+        with transaction.atomic():
+            # Locks the row. A write first, on SQLite too: see
+            # SearchBackend.replace
+            if not cls.objects.filter(pk=self.pk).update(
+                updated_at=timezone.now()
+            ):
+                return  # Deleted meanwhile
+            storage = self.file.storage
+            previous_name: Union[AnyStr, None] = self.file.name or None
+
+            with get_lock_manager().lock(self.get_log_path()):
+                if previous_name is not None:
+                    self.create_version()
+
+                # The downloads in progress read the previous content to
+                # the end, its files are not modified
+                self.file = storage.save_chunks_content_addressed(
+                    version.iter_content(),
+                    directory="documents",
+                    extension=".txt",
+                )
+                self.clear_log()
+                self.save(update_fields=["file", "updated_at"])
+            if previous_name is not None:
+                storage.release(previous_name)
+            self.update_search_index()
+
+    @instrument("file-commit")
+    def commit_upload(self, upload: "UploadSession") -> bool:
+        """
+        Make the uploaded file the file of the document. The chunks were
+        written in place: the file is moved, never copied. The current
+        content is versioned first, as on a re-upload.
+
+        The file is checked against the checksum of the upload by the read
+        which hashes it: on a mismatch, the upload is marked as failed.
+        Return whether it was committed.
+        """
+        cls = self.__class__
+
+        try:
+            with transaction.atomic():
+                # Locks the row. A write first, on SQLite too: see
+                # SearchBackend.replace
+                if not cls.objects.filter(pk=self.pk).update(
+                    updated_at=timezone.now()
+                ):
+                    return False  # Deleted meanwhile
+                storage = self.file.storage
+                previous_name: Union[AnyStr, None] = self.file.name or None
+
+                with get_lock_manager().lock(self.get_log_path()):
+                    # Checked before anything is stored, the version too
+                    name = storage.save_file_content_addressed(
+                        upload.get_path(),
+                        directory="documents",
+                        extension=".txt",
+                        checksum=upload.checksum,
+                    )
+                    if previous_name is not None:
+                        self.create_version()
+                    self.file = name
+                    self.clear_log()
+                    self.save(update_fields=["file", "updated_at"])
+                if previous_name is not None:
+                    storage.release(previous_name)
+                upload.delete()
+                self.update_search_index()
+        except ChecksumMismatch:
+            upload.set_status(UploadSession.Status.FAILED)
+            return False
+        return True
+
+    @instrument("search-index")
+    def update_search_index(
+        self, content: Optional[AnyStr] = None
+    ) -> NoReturn:
+        """
+        Index the content of the file, read from it when not given: its
+        first SEARCH["MAX_CONTENT_SIZE"] characters.
+        """
+        from .search import get_search_backend
+
+        backend = get_search_backend()
+        if backend is None:  # Disabled
+            return
+        # Read along with the content, or replaced by it
+        get_activity_log_writer().discard_index(self.id)
+        if content is None:
+            parts: List[AnyStr] = []
+            remaining: int = settings.SEARCH["MAX_CONTENT_SIZE"]
+            paths = self.get_file_paths() if self.file else []
+            for path in paths:
+                with open(path, encoding="utf-8", errors="replace") as file:
+                    parts.append(file.read(remaining))
+                remaining -= len(parts[-1])
+                if remaining <= 0:
+                    break
+            content = "".join(parts)
+        backend.replace(self.id, content)
 
 
 class UserDocument(BaseModel):
@@ -120,8 +644,14 @@ class UserDocument(BaseModel):
     documents.
     """
 
+    # Rows per insert of the bulk shares
+    BATCH_SIZE = 1000
+
     user = models.ForeignKey(
-        User, on_delete=models.CASCADE, related_name="user_documents"
+        User,
+        on_delete=models.CASCADE,
+        related_name="user_documents",
+        db_index=False,  # Leading column of the unique constraint
     )
     document = models.ForeignKey(
         Document, on_delete=models.CASCADE, related_name="user_documents"
@@ -129,3 +659,539 @@ class UserDocument(BaseModel):
 
     class Meta:
         verbose_name_plural = "User Documents"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "document"], name="unique_user_document"
+            )
+        ]
+
+    @classmethod
+    def insert_new(cls, objects: List["UserDocument"]) -> List[AnyStr]:
+        """
+        Insert the rows, skipping the existing (user, document) pairs.
+
+        Returns the document id of each inserted row: INSERT .. ON CONFLICT
+        DO NOTHING RETURNING, so concurrent shares are not counted twice.
+        """
+        connection = connections[router.db_for_write(cls)]
+        if not connection.features.can_return_rows_from_bulk_insert:
+            # SQLite < 3.35: the requested pairs that exist are read first
+            pairs = {(obj.document_id, obj.user_id) for obj in objects}
+            existing = set(
+                cls.objects.filter(
+                    document_id__in={document_id for document_id, _ in pairs},
+                    user_id__in={user_id for _, user_id in pairs},
+                ).values_list("document_id", "user_id")
+            )
+            cls.objects.bulk_create(objects, ignore_conflicts=True)
+            return [document_id for document_id, _ in pairs - existing]
+
+        fields = [
+            cls._meta.get_field(name)
+            for name in ("id", "created_at", "updated_at", "document", "user")
+        ]
+        quote_name = connection.ops.quote_name
+        columns = ", ".join(quote_name(field.column) for field in fields)
+        row = f"({', '.join(['%s'] * len(fields))})"
+        batch_size = connection.ops.bulk_batch_size(fields, objects)
+        now = timezone.now()
+        document_ids: List[AnyStr] = []
+        with connection.cursor() as cursor:
+            for start in range(0, len(objects), batch_size):
+                batch = objects[start : start + batch_size]
+                params: List[Any] = []
+                for obj in batch:
+                    obj.created_at = obj.updated_at = now
+                    params += [
+                        field.get_db_prep_save(
+                            getattr(obj, field.attname), connection
+                        )
+                        for field in fields
+                    ]
+                cursor.execute(
+                    f"INSERT INTO {quote_name(cls._meta.db_table)} "
+                    f"({columns}) VALUES {', '.join([row] * len(batch))} "
+                    "ON CONFLICT DO NOTHING "
+                    f"RETURNING {quote_name(fields[3].column)}",
+                    params,
+                )
+                document_ids += [document_id for document_id, in cursor]
+        return document_ids
+
+
+class Activity(BaseModel):
+    """
+    Append-only record of an operation performed on a document.
+
+    The same operations are logged as text lines in the document file, this
+    is the queryable copy.
+    """
+
+    class Operation(models.TextChoices):
+        UPLOAD = "Upload"
+        EDIT = "Edit"
+        DOWNLOAD = "Download"
+        SHARE = "Share"
+        RESTORE = "Restore"
+
+    document = models.ForeignKey(
+        Document, on_delete=models.CASCADE, related_name="activities"
+    )
+    # Kept when the user is deleted, the history still holds
+    actor = models.ForeignKey(
+        User, null=True, on_delete=models.SET_NULL, related_name="activities"
+    )
+    actor_type = models.CharField(max_length=16)
+    operation = models.CharField(max_length=16, choices=Operation.choices)
+    # Time of the operation, the record itself is saved in batches
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name_plural = "Activities"
+        ordering = ("-timestamp", "-id")  # Latest first
+        indexes = [
+            models.Index(
+                fields=["document", "-timestamp", "-id"],
+                name="activity_document_idx",
+            ),
+            models.Index(
+                fields=["document", "operation", "-timestamp", "-id"],
+                name="activity_document_op_idx",
+            ),
+            models.Index(
+                fields=["actor", "-timestamp", "-id"],
+                name="activity_actor_idx",
+            ),
+        ]
+
+
+class DocumentVersion(BaseModel):
+    """
+    A past content of a document, saved before a re-upload or a restore.
+
+    The content is split in chunks of DOCUMENT_VERSIONS["CHUNK_SIZE"], saved
+    in the content-addressed storage: a chunk is written once, whatever the
+    number of versions sharing it, eg: the unchanged start of a log. A
+    version is read from its chunks, with no chain of deltas to replay.
+    Every SNAPSHOT_INTERVAL-th version also keeps its whole content, read
+    in one go.
+    """
+
+    document = models.ForeignKey(
+        Document, on_delete=models.CASCADE, related_name="versions"
+    )
+    # 1, 2, ... per document
+    number = models.PositiveIntegerField()
+    size = models.BigIntegerField()
+    # SHA-256 of the content
+    digest = models.CharField(max_length=64)
+    # Name of the whole content in the storage, for the snapshots
+    snapshot = models.CharField(max_length=255, blank=True, db_index=True)
+
+    class Meta:
+        verbose_name_plural = "Document Versions"
+        ordering = ("-number",)  # Latest first
+        constraints = [
+            models.UniqueConstraint(
+                fields=["document", "number"], name="unique_document_version"
+            )
+        ]
+
+    # Directory of the chunks and the snapshots in the storage
+    directory = "versions"
+
+    @staticmethod
+    def get_storage() -> Any:
+        return Document._meta.get_field("file").storage
+
+    @classmethod
+    def create_from_files(
+        cls, document: Document, paths: List[AnyStr]
+    ) -> Union["DocumentVersion", None]:
+        """
+        Version the content of the files, one after the other, only its new
+        chunks are written. The caller holds the lock of the files. None
+        when they are empty.
+        """
+        options = settings.DOCUMENT_VERSIONS
+        storage = cls.get_storage()
+        digest = hashlib.sha256()
+        names: List[AnyStr] = []
+        size = 0
+
+        # The references to the chunks are counted along with the rows
+        with transaction.atomic():
+            for chunk in read_files(paths, options["CHUNK_SIZE"]):
+                digest.update(chunk)
+                size += len(chunk)
+                names.append(
+                    storage.save_bytes_content_addressed(chunk, cls.directory)
+                )
+            if not size:
+                return None
+
+            last = (
+                cls.objects.filter(document=document)
+                .order_by("-number")
+                .values_list("number", flat=True)
+                .first()
+            )
+            version = cls(
+                document=document,
+                number=(last or 0) + 1,
+                size=size,
+                digest=digest.hexdigest(),
+            )
+            interval = options["SNAPSHOT_INTERVAL"]
+            # A single chunk is a snapshot already
+            if interval and version.number % interval == 0 and len(names) > 1:
+                version.snapshot = storage.save_chunks_content_addressed(
+                    read_files(paths, options["CHUNK_SIZE"]), cls.directory
+                )
+            version.save()
+            VersionChunk.objects.bulk_create(
+                VersionChunk(version=version, position=position, name=name)
+                for position, name in enumerate(names)
+            )
+        return version
+
+    def iter_content(self) -> Iterator[bytes]:
+        """The content, from the snapshot if any, else from the chunks."""
+        if self.snapshot:
+            names = [self.snapshot]
+        else:
+            names = list(self.chunks.values_list("name", flat=True))
+        return self._read(self.get_storage(), names)
+
+    @staticmethod
+    def _read(storage: Any, names: List[AnyStr]) -> Iterator[bytes]:
+        for name in names:
+            with storage.open(name, "rb") as file:
+                yield from file.chunks()
+
+    def get_blob_names(self) -> List[AnyStr]:
+        """The names of the chunks and of the snapshot."""
+        names = list(self.chunks.values_list("name", flat=True))
+        if self.snapshot:
+            names.append(self.snapshot)
+        return names
+
+    @classmethod
+    def release_blobs(cls, names: Iterable[AnyStr]) -> NoReturn:
+        """
+        Uncount the references to the chunks and the snapshots, one per
+        occurrence, in the current transaction: the ones no version refers
+        to anymore are deleted once committed, see
+        ContentAddressedStorage.release.
+        """
+        storage = cls.get_storage()
+        for name, count in sorted(Counter(names).items()):
+            storage.release(name, count)
+
+
+class VersionChunk(BaseModel):
+    """A chunk of the content of a version, by its position."""
+
+    version = models.ForeignKey(
+        DocumentVersion, on_delete=models.CASCADE, related_name="chunks"
+    )
+    position = models.PositiveIntegerField()
+    # Name in the storage, shared by the identical chunks
+    name = models.CharField(max_length=255, db_index=True)
+
+    class Meta:
+        ordering = ("position",)
+        constraints = [
+            models.UniqueConstraint(
+                fields=["version", "position"], name="unique_version_chunk"
+            )
+        ]
+
+
+class UploadSession(BaseModel):
+    """
+    A resumable upload of the file of a document.
+
+    The chunks are written in place in a part file of the final size, from
+    their offsets, in any order and in parallel. The received ranges are
+    recorded, a client resumes with the missing ones. The complete part
+    file is moved in place of the file of the document.
+    """
+
+    class Status(models.TextChoices):
+        UPLOADING = "Uploading"
+        COMMITTING = "Committing"
+        # The file does not match the checksum
+        FAILED = "Failed"
+
+    # Bytes read from the request per write
+    read_size = 1024 * 1024
+
+    document = models.ForeignKey(
+        Document, on_delete=models.CASCADE, related_name="uploads"
+    )
+    size = models.BigIntegerField()
+    # Optional SHA-256 of the whole file, checked on commit
+    checksum = models.CharField(max_length=64, blank=True)
+    expires_at = models.DateTimeField()
+    status = models.CharField(
+        max_length=16, choices=Status.choices, default=Status.UPLOADING
+    )
+    # The chunks being written, the upload is committed with none
+    writers = models.PositiveIntegerField(default=0)
+
+    # Directory of the part files in the storage
+    directory = "uploads"
+
+    @classmethod
+    def start(
+        cls, document: Document, size: int, checksum: AnyStr = ""
+    ) -> "UploadSession":
+        upload = cls.objects.create(
+            document=document,
+            size=size,
+            checksum=checksum,
+            expires_at=timezone.now()
+            + timedelta(seconds=settings.UPLOADS["EXPIRY"]),
+        )
+        path = upload.get_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Sparse, of the final size: the chunks are written at their offsets
+        with open(path, "wb") as file:
+            file.truncate(size)
+        return upload
+
+    def get_path(self) -> AnyStr:
+        storage = Document._meta.get_field("file").storage
+        return storage.path(posixpath.join(self.directory, f"{self.id}.part"))
+
+    def start_write(self) -> bool:
+        """Count a chunk being written, unless the upload is committing."""
+        return bool(
+            self.__class__.objects.filter(
+                id=self.id, status=self.Status.UPLOADING
+            ).update(writers=models.F("writers") + 1)
+        )
+
+    def end_write(self) -> NoReturn:
+        self.__class__.objects.filter(id=self.id).update(
+            writers=models.F("writers") - 1
+        )
+
+    def start_commit(self) -> bool:
+        """
+        Mark the upload as committing, unless chunks are being written: the
+        later ones are refused.
+        """
+        started = self.__class__.objects.filter(
+            id=self.id, status=self.Status.UPLOADING, writers=0
+        ).update(status=self.Status.COMMITTING)
+        if started:
+            self.status = self.Status.COMMITTING
+        return bool(started)
+
+    def set_status(self, status: AnyStr) -> NoReturn:
+        self.status = status
+        self.save(update_fields=["status", "updated_at"])
+
+    def receive(
+        self, offset: int, stream: Any, length: int, checksum: bytes
+    ) -> bool:
+        """
+        Write the `length` bytes of the stream at the offset, as they are
+        read. The range is recorded when the SHA-256 of the bytes is the
+        checksum, else it is to be sent again: along with the received
+        ranges it overwrote.
+        """
+        digest = hashlib.sha256()
+        received = False
+        descriptor = os.open(self.get_path(), os.O_WRONLY)
+        try:
+            position = offset
+            while position < offset + length:
+                data = stream.read(
+                    min(self.read_size, offset + length - position)
+                )
+                if not data:  # Shorter than announced
+                    break
+                digest.update(data)
+                position += os.pwrite(descriptor, data, position)
+            received = (
+                position == offset + length and digest.digest() == checksum
+            )
+        finally:
+            os.close(descriptor)
+            if not received:
+                self.chunks.annotate(
+                    end=models.F("offset") + models.F("size")
+                ).filter(offset__lt=offset + length, end__gt=offset).delete()
+
+        if not received:
+            return False
+        UploadChunk.objects.update_or_create(
+            upload=self, offset=offset, defaults={"size": length}
+        )
+        return True
+
+    def get_received_ranges(self) -> List[Tuple[int, int]]:
+        """The received (start, end) ranges, merged, the ends excluded."""
+        ranges: List[Tuple[int, int]] = []
+        for offset, size in self.chunks.order_by("offset").values_list(
+            "offset", "size"
+        ):
+            if ranges and offset <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], offset + size))
+            else:
+                ranges.append((offset, offset + size))
+        return ranges
+
+    def is_complete(self) -> bool:
+        return self.get_received_ranges() == [(0, self.size)]
+
+    @staticmethod
+    def parse_checksum(header: AnyStr) -> Optional[bytes]:
+        """The digest of an `Upload-Checksum: sha256 <base64>` header."""
+        algorithm, _, value = header.partition(" ")
+        if algorithm.lower() != "sha256":
+            return None
+        try:
+            checksum = base64.b64decode(value, validate=True)
+        except ValueError:
+            return None
+        return checksum if len(checksum) == 32 else None
+
+
+class UploadChunk(BaseModel):
+    """A received range of an upload."""
+
+    upload = models.ForeignKey(
+        UploadSession, on_delete=models.CASCADE, related_name="chunks"
+    )
+    offset = models.BigIntegerField()
+    size = models.BigIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["upload", "offset"], name="unique_upload_chunk"
+            )
+        ]
+
+
+class SearchEntry(BaseModel):
+    """The indexed content of a document, see search.py."""
+
+    # The rowid of the FTS5 table
+    id = models.BigAutoField(primary_key=True)
+    document = models.OneToOneField(
+        Document, on_delete=models.CASCADE, related_name="search_entry"
+    )
+    # Characters indexed, bounded by SEARCH["MAX_CONTENT_SIZE"]
+    size = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "Search Entries"
+
+
+class SearchTerm(BaseModel):
+    """A term of an entry, the inverted index of the python backend."""
+
+    MAX_LENGTH = 64
+
+    id = models.BigAutoField(primary_key=True)
+    entry = models.ForeignKey(
+        SearchEntry, on_delete=models.CASCADE, related_name="terms"
+    )
+    term = models.CharField(max_length=MAX_LENGTH)
+    frequency = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["entry", "term"], name="unique_search_term"
+            )
+        ]
+        indexes = [
+            # The postings of a term
+            models.Index(fields=["term", "entry"], name="search_term_idx"),
+        ]
+
+
+class DocumentChange(BaseModel):
+    """
+    A change of a document, fanned out to each user it is visible to: the
+    changes feed of their clients, read by the sequence number (the id).
+    """
+
+    class Operation(models.TextChoices):
+        CREATE = "create"
+        UPDATE = "update"
+        SHARE = "share"
+        UNSHARE = "unshare"
+        DELETE = "delete"
+
+    BATCH_SIZE = 1000
+
+    # The sequence number, the cursor of the feed
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="document_changes",
+        db_index=False,  # Leading column of the feed index
+        # The changes of the documents cascaded with a deleted user are
+        # recorded for it too, left to the purge of the old changes
+        db_constraint=False,
+    )
+    # No foreign key, the tombstones outlive the documents
+    document_id = models.CharField(max_length=12)  # As BaseModel.id
+    operation = models.CharField(max_length=16, choices=Operation.choices)
+
+    class Meta:
+        indexes = [
+            # The feed of a user, since a sequence number
+            models.Index(fields=["user", "id"], name="document_change_idx"),
+            # The purge of the old changes
+            models.Index(
+                fields=["created_at"], name="document_change_created_idx"
+            ),
+        ]
+
+    @classmethod
+    def record(
+        cls, operation: AnyStr, pairs: Iterable[Tuple[AnyStr, AnyStr]]
+    ) -> NoReturn:
+        """
+        Record the change for each (user id, document id), in bulk, once
+        the transaction commits: numbered and timestamped then, so that a
+        long transaction does not commit a number older than the settle
+        window of the feed.
+        """
+        database = router.db_for_write(cls)
+
+        def insert():
+            changes = (
+                cls(
+                    user_id=user_id,
+                    document_id=document_id,
+                    operation=operation,
+                )
+                for user_id, document_id in pairs
+            )
+            while True:
+                batch = list(islice(changes, cls.BATCH_SIZE))
+                if not batch:
+                    break
+                cls.objects.using(database).bulk_create(batch)
+
+        transaction.on_commit(insert, using=database)
+
+    @staticmethod
+    def get_recipient_ids(document: Document) -> List[AnyStr]:
+        """The users the document is visible to: its owner and collaborators."""
+        return [
+            document.owner_id,
+            *UserDocument.objects.filter(document_id=document.id)
+            .exclude(user_id=document.owner_id)
+            .values_list("user_id", flat=True),
+        ]
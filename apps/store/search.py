@@ -0,0 +1,372 @@
+"""
+Full-text search of the document files, their activity log lines included.
+
+Each document has a SearchEntry. Its terms are indexed by the backend of
+SEARCH["BACKEND"]:
+
+    sqlite: an FTS5 table, ranked by BM25
+    postgresql: a tsvector column with a GIN index, ranked by ts_rank
+    python: SearchTerm rows, an inverted index on any database, ranked by
+    TF-IDF in Python. A fallback, for the small deployments
+
+A file is indexed when its content is replaced (create, truncate, restore,
+upload) and its appended lines are added to its entry, in batches, by the
+flushes of the activity log writer. At most SEARCH["MAX_CONTENT_SIZE"]
+characters of a file are indexed.
+"""
+
+import math
+import re
+import threading
+from collections import Counter
+from typing import AnyStr, Dict, List, NoReturn, Tuple, Union
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, models, router, transaction
+from django.utils import timezone
+
+from .models import SearchEntry, SearchTerm
+
+TOKEN_RE = re.compile(r"\w+")
+
+# (document id, score), the best first
+Results = List[Tuple[AnyStr, float]]
+
+
+def tokenize(text: AnyStr) -> List[AnyStr]:
+    """The terms of the text, as the python backend and the queries see them."""
+    return [
+        token[: SearchTerm.MAX_LENGTH]
+        for token in TOKEN_RE.findall(text.lower())
+    ]
+
+
+class SearchBackend:
+    """
+    Keeps the SearchEntry of the documents, the subclasses index the terms.
+    Run in the task group of the document, one write at a time.
+    """
+
+    def replace(self, document_id: AnyStr, text: AnyStr) -> NoReturn:
+        """Index the text as the whole content of the document."""
+        text = text[: settings.SEARCH["MAX_CONTENT_SIZE"]]
+        database = router.db_for_write(SearchEntry)
+        entries = SearchEntry.objects.using(database)
+        with transaction.atomic(using=database):
+            # A write first: on SQLite the transaction then holds the write
+            # lock, waited for. A read first could not take it while another
+            # transaction writes, and would fail at once
+            if entries.filter(document_id=document_id).update(
+                size=len(text), updated_at=timezone.now()
+            ):
+                entry_id = entries.values_list("id", flat=True).get(
+                    document_id=document_id
+                )
+                self.remove([entry_id])
+            else:
+                entry_id = entries.create(
+                    document_id=document_id, size=len(text)
+                ).id
+            self.add(entry_id, text, created=True)
+
+    def create(self, texts: Dict[AnyStr, AnyStr]) -> NoReturn:
+        """
+        Index the texts as the contents of the new documents, by document
+        id, eg: of a bulk create. The entries and their terms are inserted
+        in bulk.
+        """
+        max_size = settings.SEARCH["MAX_CONTENT_SIZE"]
+        texts = {key: text[:max_size] for key, text in texts.items()}
+        database = router.db_for_write(SearchEntry)
+        entries = SearchEntry.objects.using(database)
+        with transaction.atomic(using=database):
+            created = entries.bulk_create(
+                SearchEntry(document_id=document_id, size=len(text))
+                for document_id, text in texts.items()
+            )
+            if any(entry.id is None for entry in created):  # No RETURNING
+                ids = dict(
+                    entries.filter(document_id__in=texts).values_list(
+                        "document_id", "id"
+                    )
+                )
+                for entry in created:
+                    entry.id = ids[entry.document_id]
+            self.add_many(
+                {entry.id: texts[entry.document_id] for entry in created}
+            )
+
+    def append(self, texts: Dict[AnyStr, AnyStr]) -> NoReturn:
+        """
+        Index the texts appended to the contents, by document id, eg: the
+        batch of a flush. Skipped past the max size, or when the document
+        was not indexed yet: its next replace will.
+        """
+        max_size = settings.SEARCH["MAX_CONTENT_SIZE"]
+        database = router.db_for_write(SearchEntry)
+        # Read before the transaction, which writes first, see replace()
+        entries = list(
+            SearchEntry.objects.using(database).filter(document_id__in=texts)
+        )
+        with transaction.atomic(using=database):
+            for entry in entries:
+                text = texts[entry.document_id]
+                if entry.size + len(text) > max_size:
+                    continue
+                SearchEntry.objects.using(database).filter(id=entry.id).update(
+                    size=models.F("size") + len(text)
+                )
+                self.add(entry.id, text, created=False)
+
+    def search(
+        self, query: AnyStr, queryset: models.QuerySet, limit: int, offset: int
+    ) -> Results:
+        """
+        The documents of the queryset, eg: the accessible ones, having all
+        the terms of the query, ranked.
+        """
+        raise NotImplementedError
+
+    def add(self, entry_id: int, text: AnyStr, created: bool) -> NoReturn:
+        raise NotImplementedError
+
+    def add_many(self, texts: Dict[int, AnyStr]) -> NoReturn:
+        """Index the texts of the new entries, by entry id."""
+        for entry_id, text in texts.items():
+            self.add(entry_id, text, created=True)
+
+    def remove(self, entry_ids: List[int]) -> NoReturn:
+        """Unindex the entries, eg: once deleted, see signals.py."""
+        raise NotImplementedError
+
+    @staticmethod
+    def get_subquery(queryset: models.QuerySet) -> Tuple[AnyStr, tuple]:
+        """The SQL of the ids of the documents of the queryset."""
+        return queryset.order_by().values("id").query.sql_with_params()
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """
+    FTS5 table `store_search`, its rowid is the id of the entry. FTS5
+    updates a row as a whole: appended lines tokenize the content again,
+    once per batch, bounded by the max size.
+    """
+
+    def add(self, entry_id: int, text: AnyStr, created: bool) -> NoReturn:
+        with connections[router.db_for_write(SearchEntry)].cursor() as cursor:
+            if created:
+                cursor.execute(
+                    "INSERT INTO store_search (rowid, content) VALUES (%s, %s)",
+                    [entry_id, text],
+                )
+            else:
+                cursor.execute(
+                    "UPDATE store_search SET content = content || %s "
+                    "WHERE rowid = %s",
+                    [text, entry_id],
+                )
+
+    def add_many(self, texts: Dict[int, AnyStr]) -> NoReturn:
+        with connections[router.db_for_write(SearchEntry)].cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO store_search (rowid, content) VALUES (%s, %s)",
+                list(texts.items()),
+            )
+
+    def remove(self, entry_ids: List[int]) -> NoReturn:
+        with connections[router.db_for_write(SearchEntry)].cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM store_search WHERE rowid IN (%s)"
+                % ", ".join(["%s"] * len(entry_ids)),
+                entry_ids,
+            )
+
+    def search(
+        self, query: AnyStr, queryset: models.QuerySet, limit: int, offset: int
+    ) -> Results:
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        # Quoted, the terms are never read as the FTS5 query syntax
+        match = " ".join(f'"{term}"' for term in terms)
+        subquery, params = self.get_subquery(queryset)
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute(
+                "SELECT entry.document_id, bm25(store_search) AS score "
+                "FROM store_search "
+                "JOIN store_searchentry AS entry "
+                "ON entry.id = store_search.rowid "
+                "WHERE store_search MATCH %s "
+                f"AND entry.document_id IN ({subquery}) "
+                "ORDER BY score, entry.document_id LIMIT %s OFFSET %s",
+                [match, *params, limit, offset],
+            )
+            # BM25 of FTS5 is negative, the lower the better
+            return [(document_id, -score) for document_id, score in cursor]
+
+
+class PostgreSQLSearchBackend(SearchBackend):
+    """
+    tsvector column `vector` of the entries, with a GIN index. An appended
+    line is concatenated to the vector, the content is not parsed again.
+    """
+
+    config = "simple"  # No stemming, the logs are not prose
+
+    def add(self, entry_id: int, text: AnyStr, created: bool) -> NoReturn:
+        with connections[router.db_for_write(SearchEntry)].cursor() as cursor:
+            cursor.execute(
+                "UPDATE store_searchentry SET vector = "
+                "coalesce(vector, ''::tsvector) || to_tsvector(%s, %s) "
+                "WHERE id = %s",
+                [self.config, text, entry_id],
+            )
+
+    def add_many(self, texts: Dict[int, AnyStr]) -> NoReturn:
+        with connections[router.db_for_write(SearchEntry)].cursor() as cursor:
+            cursor.executemany(
+                "UPDATE store_searchentry SET vector = to_tsvector(%s, %s) "
+                "WHERE id = %s",
+                [
+                    (self.config, text, entry_id)
+                    for entry_id, text in texts.items()
+                ],
+            )
+
+    def remove(self, entry_ids: List[int]) -> NoReturn:
+        with connections[router.db_for_write(SearchEntry)].cursor() as cursor:
+            cursor.execute(
+                "UPDATE store_searchentry SET vector = NULL WHERE id = ANY(%s)",
+                [list(entry_ids)],
+            )
+
+    def search(
+        self, query: AnyStr, queryset: models.QuerySet, limit: int, offset: int
+    ) -> Results:
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        subquery, params = self.get_subquery(queryset)
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute(
+                "SELECT document_id, ts_rank(vector, query) AS score "
+                "FROM store_searchentry, plainto_tsquery(%s, %s) AS query "
+                "WHERE vector @@ query "
+                f"AND document_id IN ({subquery}) "
+                "ORDER BY score DESC, document_id LIMIT %s OFFSET %s",
+                [self.config, " ".join(terms), *params, limit, offset],
+            )
+            return list(cursor)
+
+
+class PythonSearchBackend(SearchBackend):
+    """
+    Inverted index of SearchTerm rows: (entry, term, frequency), by term.
+    An appended line only adds to the frequencies of its terms.
+    """
+
+    def add(self, entry_id: int, text: AnyStr, created: bool) -> NoReturn:
+        counts = Counter(tokenize(text))
+        if not counts:
+            return
+
+        existing: Dict[AnyStr, int] = {}
+        if not created:
+            existing = dict(
+                SearchTerm.objects.filter(
+                    entry_id=entry_id, term__in=counts
+                ).values_list("term", "id")
+            )
+        for term, term_id in existing.items():
+            SearchTerm.objects.filter(id=term_id).update(
+                frequency=models.F("frequency") + counts[term]
+            )
+        SearchTerm.objects.bulk_create(
+            SearchTerm(entry_id=entry_id, term=term, frequency=count)
+            for term, count in counts.items()
+            if term not in existing
+        )
+
+    def add_many(self, texts: Dict[int, AnyStr]) -> NoReturn:
+        SearchTerm.objects.bulk_create(
+            SearchTerm(entry_id=entry_id, term=term, frequency=count)
+            for entry_id, text in texts.items()
+            for term, count in Counter(tokenize(text)).items()
+        )
+
+    def remove(self, entry_ids: List[int]) -> NoReturn:
+        SearchTerm.objects.filter(entry_id__in=entry_ids).delete()
+
+    def search(
+        self, query: AnyStr, queryset: models.QuerySet, limit: int, offset: int
+    ) -> Results:
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        rows = SearchTerm.objects.using(queryset.db).filter(term__in=terms)
+        total = SearchEntry.objects.using(queryset.db).count()
+        # Inverse document frequency of each term
+        weights = {
+            term: math.log(1 + total / count)
+            for term, count in rows.values("term")
+            .annotate(count=models.Count("id"))
+            .values_list("term", "count")
+        }
+        if len(weights) < len(terms):  # A term is in no document
+            return []
+
+        scores: Dict[AnyStr, float] = {}
+        matched: Counter = Counter()
+        for document_id, term, frequency in rows.filter(
+            entry__document__in=queryset.order_by().values("id")
+        ).values_list("entry__document_id", "term", "frequency"):
+            scores[document_id] = (
+                scores.get(document_id, 0.0)
+                + (1 + math.log(frequency)) * weights[term]
+            )
+            matched[document_id] += 1
+
+        results = sorted(
+            (
+                (document_id, score)
+                for document_id, score in scores.items()
+                if matched[document_id] == len(terms)
+            ),
+            key=lambda result: (-result[1], result[0]),
+        )
+        return results[offset : offset + limit]
+
+
+BACKENDS = {
+    "sqlite": SQLiteSearchBackend,
+    "postgresql": PostgreSQLSearchBackend,
+    "python": PythonSearchBackend,
+}
+
+_backends: Dict[AnyStr, SearchBackend] = {}
+_backends_lock = threading.Lock()
+
+
+def get_search_backend() -> Union[SearchBackend, None]:
+    """
+    The backend of SEARCH["BACKEND"], auto: the one of the database.
+    None when the search is disabled.
+    """
+    name = settings.SEARCH["BACKEND"]
+    if not name:
+        return None
+    if name == "auto":
+        vendor = connections[router.db_for_write(SearchEntry)].vendor
+        name = vendor if vendor in BACKENDS else "python"
+    if name not in BACKENDS:
+        raise ImproperlyConfigured(f"Unknown search backend: {name}")
+
+    if name not in _backends:
+        with _backends_lock:
+            if name not in _backends:
+                _backends[name] = BACKENDS[name]()
+    return _backends[name]
@@ -0,0 +1,145 @@
+import os
+
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from apps.utils.locks import get_lock_manager
+from apps.utils.tasks import has_pending
+
+from .access import invalidate_accessible_documents
+from .models import (
+    Document,
+    DocumentChange,
+    DocumentVersion,
+    SearchEntry,
+    UploadSession,
+    UserDocument,
+)
+from .search import get_search_backend
+
+
+@receiver(post_delete, sender=Document)
+def release_document_file(sender, instance, **kwargs):
+    """
+    Delete the file of the deleted document, unless it is shared, and its
+    activity lines.
+    """
+    if instance.file:
+        instance.file.storage.release(instance.file.name)
+        with get_lock_manager().lock(instance.get_log_path()):
+            instance.clear_log()
+        if has_pending(instance.get_task_group()):
+            # Again, after the lines of the queued tasks
+            instance.enqueue_file_operation(
+                "store.delete_document_log", instance.get_log_path()
+            )
+
+
+@receiver(post_save, sender=Document)
+@receiver(post_delete, sender=Document)
+def invalidate_owner_access(sender, instance, **kwargs):
+    """
+    A document was created or deleted. Its collaborators are invalidated by
+    the deletes of their UserDocument rows, cascaded with signals.
+    """
+    if kwargs.get("created", True):  # Always on delete
+        invalidate_accessible_documents([instance.owner_id])
+
+
+@receiver(post_save, sender=UserDocument)
+@receiver(post_delete, sender=UserDocument)
+def invalidate_collaborator_access(sender, instance, **kwargs):
+    """A document was shared with or unshared from the user."""
+    if kwargs.get("created", True):  # Always on delete
+        invalidate_accessible_documents([instance.user_id])
+
+
+@receiver(pre_delete, sender=DocumentVersion)
+def collect_version_blobs(sender, instance, **kwargs):
+    """Before its chunk rows are deleted along with it."""
+    instance.blob_names = instance.get_blob_names()
+
+
+@receiver(post_delete, sender=DocumentVersion)
+def release_version_blobs(sender, instance, **kwargs):
+    """Delete the chunks of the deleted version, unless shared."""
+    DocumentVersion.release_blobs(getattr(instance, "blob_names", []))
+
+
+@receiver(post_delete, sender=UploadSession)
+def delete_upload_file(sender, instance, **kwargs):
+    """The part file of an expired or aborted upload, if not committed."""
+    try:
+        os.remove(instance.get_path())
+    except FileNotFoundError:
+        pass
+
+
+@receiver(post_delete, sender=SearchEntry)
+def unindex_search_entry(sender, instance, **kwargs):
+    """Deleted along with its document, the index is no foreign key."""
+    backend = get_search_backend()
+    if backend is not None:
+        backend.remove([instance.id])
+
+
+@receiver(post_save, sender=Document)
+def record_document_change(sender, instance, created, **kwargs):
+    """
+    Created: for the owner. Updated: for the collaborators too, unless only
+    touched, eg: at the start of a truncate, whose file save follows.
+    """
+    update_fields = kwargs.get("update_fields")
+    if update_fields is not None and update_fields <= {"updated_at"}:
+        return
+    if created:
+        DocumentChange.record(
+            DocumentChange.Operation.CREATE, [(instance.owner_id, instance.id)]
+        )
+    else:
+        DocumentChange.record(
+            DocumentChange.Operation.UPDATE,
+            [
+                (user_id, instance.id)
+                for user_id in DocumentChange.get_recipient_ids(instance)
+            ],
+        )
+
+
+@receiver(pre_delete, sender=Document)
+def collect_document_recipients(sender, instance, **kwargs):
+    """Before its UserDocument rows are deleted along with it."""
+    instance.recipient_ids = DocumentChange.get_recipient_ids(instance)
+
+
+@receiver(post_delete, sender=Document)
+def record_document_deletion(sender, instance, **kwargs):
+    """The tombstones, the collaborators also get the unshares."""
+    # Recorded on commit, once the instance lost its id
+    document_id = instance.id
+    DocumentChange.record(
+        DocumentChange.Operation.DELETE,
+        (
+            (user_id, document_id)
+            for user_id in getattr(
+                instance, "recipient_ids", [instance.owner_id]
+            )
+        ),
+    )
+
+
+@receiver(post_save, sender=UserDocument)
+@receiver(post_delete, sender=UserDocument)
+def record_share_change(sender, instance, **kwargs):
+    """The bulk shares record theirs, see Document.share_documents."""
+    created = kwargs.get("created")
+    if created is False:  # Saved again, nothing changed
+        return
+    DocumentChange.record(
+        (
+            DocumentChange.Operation.SHARE
+            if created
+            else DocumentChange.Operation.UNSHARE
+        ),
+        [(instance.user_id, instance.document_id)],
+    )
@@ -0,0 +1,77 @@
+from typing import AnyStr, NoReturn, Optional
+
+from apps.utils.locks import get_lock_manager
+from apps.utils.tasks import task
+
+from .models import Activity, Document, UploadSession, User
+
+# The file operations of a document, enqueued by
+# Document.enqueue_file_operation in its group
+
+
+@task("store.create_document_file")
+def create_document_file(document_id: AnyStr) -> NoReturn:
+    """Index the new document and log its upload line."""
+    document = Document.objects.filter(id=document_id).first()
+    if document is not None:  # Else deleted meanwhile
+        document.create_document()
+
+
+@task("store.truncate_document_file")
+def truncate_document_file(document_id: AnyStr) -> NoReturn:
+    document = Document.objects.filter(id=document_id).first()
+    if document is not None:
+        document.truncate_the_file_content()
+
+
+@task("store.append_document_file")
+def append_document_file(
+    document_id: AnyStr, line: AnyStr, log_path: Optional[AnyStr] = None
+) -> NoReturn:
+    """
+    Written by the path of the log, with no query. The log of a document
+    deleted meanwhile is deleted again after it, see delete_document_log.
+    """
+    if log_path is not None:
+        Document.write_line(document_id, log_path, line)
+        return
+
+    # Enqueued with no file, or before the path was
+    document = Document.objects.filter(id=document_id).first()
+    if document is not None:
+        document.write_to_file(line)
+
+
+@task("store.delete_document_log")
+def delete_document_log(document_id: AnyStr, log_path: AnyStr) -> NoReturn:
+    """The lines of the tasks queued before the document was deleted."""
+    with get_lock_manager().lock(log_path):
+        Document.delete_log(log_path)
+
+
+@task("store.restore_document_version")
+def restore_document_version(document_id: AnyStr, number: int) -> NoReturn:
+    document = Document.objects.filter(id=document_id).first()
+    if document is not None:
+        version = document.versions.filter(number=number).first()
+        if version is not None:  # Else deleted meanwhile
+            document.restore_version(version)
+
+
+@task("store.commit_document_upload")
+def commit_document_upload(
+    document_id: AnyStr, upload_id: AnyStr, actor_id: Optional[AnyStr] = None
+) -> NoReturn:
+    """Commit the upload, then log it: unless it failed its checksum."""
+    upload = (
+        UploadSession.objects.filter(id=upload_id, document_id=document_id)
+        .select_related("document")
+        .first()
+    )
+    if upload is None:  # Else committed or deleted meanwhile
+        return
+    document = upload.document
+    # Enqueued without one by the older releases: logged by the request
+    actor = User.objects.filter(id=actor_id).first() if actor_id else None
+    if document.commit_upload(upload) and actor is not None:
+        document.log_activity(actor, Activity.Operation.UPLOAD, queued=False)
@@ -0,0 +1,126 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+
+from apps.store.activity import ActivityLogWriter
+from apps.utils.locks import FileLockBackend, LockManager
+
+
+@override_settings(
+    ACTIVITY_LOG={**settings.ACTIVITY_LOG, "SYNCHRONOUS": False}
+)
+class ActivityLogWriterTest(SimpleTestCase):
+    def setUp(self):
+        """Setup a writer and files to write into."""
+        super().setUp()
+        self.writer = ActivityLogWriter(flush_interval=60, max_batch_size=3)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path1 = os.path.join(self.directory.name, "1.txt")
+        self.path2 = os.path.join(self.directory.name, "2.txt")
+
+    def tearDown(self):
+        self.writer.stop()
+        self.directory.cleanup()
+        super().tearDown()
+
+    @staticmethod
+    def read(path):
+        if not os.path.exists(path):
+            return ""
+        with open(path) as file:
+            return file.read()
+
+    def test_flush(self):
+        # Arrange
+        self.writer.append(self.path1, "a\n")
+        self.writer.append(self.path2, "b\n")
+
+        # Assert: Nothing is written before the flush
+        self.assertEqual(self.read(self.path1), "")
+
+        # Act
+        self.writer.flush()
+
+        # Assert
+        self.assertEqual(self.read(self.path1), "a\n")
+        self.assertEqual(self.read(self.path2), "b\n")
+
+    def test_discard(self):
+        # Arrange
+        self.writer.append(self.path1, "a\n")
+        self.writer.append(self.path2, "b\n")
+
+        # Act
+        self.writer.discard(self.path1)
+        self.writer.flush()
+
+        # Assert
+        self.assertEqual(self.read(self.path1), "")
+        self.assertEqual(self.read(self.path2), "b\n")
+
+    def test_stop(self):
+        # Arrange
+        self.writer.append(self.path1, "a\n")
+        self.writer.append(self.path1, "b\n")
+
+        # Act
+        self.writer.stop()
+
+        # Assert: Flushed on shutdown, in the queued order
+        self.assertEqual(self.read(self.path1), "a\nb\n")
+
+    def test_size_limit(self):
+        # Act: Size limit reached, the worker doesn't wait for the interval
+        for line in ("a\n", "b\n", "c\n"):
+            self.writer.append(self.path1, line)
+        for _ in range(100):
+            if self.read(self.path1):
+                break
+            self.writer._stopped.wait(0.05)
+
+        # Assert
+        self.assertEqual(self.read(self.path1), "a\nb\nc\n")
+
+    def test_locked(self):
+        # Arrange
+        self.writer.append(self.path1, "a\n")
+        lock_manager = LockManager(
+            FileLockBackend(self.directory.name), timeout=0
+        )
+
+        # Act: Eg: a truncate of another process holds the lock
+        with mock.patch(
+            "apps.store.activity.get_lock_manager", return_value=lock_manager
+        ):
+            with lock_manager.lock(self.path1):
+                self.writer.flush()
+
+            # Assert: Left in the queue
+            self.assertEqual(self.read(self.path1), "")
+
+            # Act
+            self.writer.flush()
+
+        # Assert
+        self.assertEqual(self.read(self.path1), "a\n")
+
+    def test_index(self):
+        # Arrange: Below the size limit, flushed by the test only
+        backend = mock.Mock()
+        self.writer.max_batch_size = 10
+        self.writer.index("A", "a\n")
+        self.writer.index("B", "b\n")
+        self.writer.index("A", "c\n")
+
+        # Act
+        with mock.patch(
+            "apps.store.search.get_search_backend", return_value=backend
+        ):
+            self.writer.discard_index("B")
+            self.writer.flush()
+
+        # Assert: One update per document and flush
+        backend.append.assert_called_once_with({"A": "a\nc\n"})
@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.utils.module_loading import autodiscover_modules
 
 
 class UtilsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "apps.utils"
+
+    def ready(self):
+        # Connect the signal receivers
+        from . import authentication, db  # noqa: F401
+
+        # Register the tasks of the apps, see tasks.py
+        autodiscover_modules("tasks")
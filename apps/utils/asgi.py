@@ -0,0 +1,59 @@
+"""
+The ASGI handler of the project, see doclib/asgi.py.
+
+Django 4.0 iterates the streamed responses on the event loop: a file read
+blocks all its requests. The responses with an async iterator, eg: the
+downloads, are sent by it instead, their reads run in the threads.
+"""
+
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler as BaseASGIHandler
+from django.http.response import HttpResponseBase
+
+
+class ASGIHandler(BaseASGIHandler):
+    async def send_response(self, response: HttpResponseBase, send):
+        if not getattr(response, "is_async", False):
+            return await super().send_response(response, send)
+
+        # The headers, as sent by Django
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode("ascii")
+            if isinstance(value, str):
+                value = value.encode("latin1")
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append(
+                (
+                    b"Set-Cookie",
+                    cookie.output(header="").encode("ascii").strip(),
+                )
+            )
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": headers,
+            }
+        )
+
+        async for part in response:
+            for chunk, _ in self.chunk_bytes(part):
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": True,
+                    }
+                )
+        await send({"type": "http.response.body"})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+
+def get_asgi_application() -> ASGIHandler:
+    """As the one of Django, with the handler of the project."""
+    django.setup(set_prefix=False)
+    return ASGIHandler()
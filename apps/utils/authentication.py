@@ -0,0 +1,191 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AnyStr, NoReturn, Tuple, Union
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core import checks
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import DEFERRED
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from .profiling import instrument
+
+
+class TokenUserCache:
+    """
+    Token key -> user cache.
+
+    A bounded LRU in the process, or the shared cache when one is configured:
+    then a deleted or rotated token is invalidated for all the processes at
+    once, no local copy outlives it. The entries expire after the TTL: in the
+    LRU, a short one, the staleness bound across the processes.
+    """
+
+    key_prefix = "auth-token"
+
+    def __init__(
+        self, max_size: int, ttl: int, backend: Union[AnyStr, None] = None
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "TokenUserCache":
+        options = settings.TOKEN_AUTH_CACHE
+        return cls(
+            max_size=options["MAX_SIZE"],
+            ttl=options["TTL"] if options["BACKEND"] else options["LOCAL_TTL"],
+            backend=options["BACKEND"],
+        )
+
+    @property
+    def shared(self) -> Any:
+        return caches[self.backend] if self.backend else None
+
+    def get_shared_key(self, key: AnyStr) -> AnyStr:
+        return f"{self.key_prefix}:{key}"
+
+    def get(self, key: AnyStr) -> Any:
+        if self.shared is not None:
+            # Unpickled, not shared by the requests
+            return self.shared.get(self.get_shared_key(key))
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                user, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    # Requests must not share a mutable instance
+                    return copy.copy(user)
+                del self._entries[key]
+        return None
+
+    def set(self, key: AnyStr, user: Any) -> NoReturn:
+        if self.shared is not None:
+            self.shared.set(self.get_shared_key(key), user, self.ttl)
+            return
+
+        with self._lock:
+            self._entries[key] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)  # Least recently used
+
+    def delete(self, key: AnyStr) -> NoReturn:
+        if self.shared is not None:
+            self.shared.delete(self.get_shared_key(key))
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> NoReturn:
+        """Clear the local entries."""
+        with self._lock:
+            self._entries.clear()
+
+
+_token_user_cache: Union[TokenUserCache, None] = None
+
+
+def get_token_user_cache() -> TokenUserCache:
+    """Return the process wide cache, created on the first use."""
+    global _token_user_cache
+
+    if _token_user_cache is None:
+        _token_user_cache = TokenUserCache.from_settings()
+    return _token_user_cache
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Drop-in TokenAuthentication that caches the token -> user resolution,
+    saving the authtoken/user query on every request.
+    """
+
+    @instrument("auth")
+    def authenticate_credentials(self, key: AnyStr) -> Tuple[Any, Token]:
+        cache = get_token_user_cache()
+        user = cache.get(key)
+        if user is None:
+            user, token = super().authenticate_credentials(key)
+            cache.set(key, user)
+            return user, token
+
+        if not user.is_active:
+            raise AuthenticationFailed("User inactive or deleted.")
+
+        # Unsaved instance, request.auth stays a Token
+        return user, Token(key=key, user=user)
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    """A token was deleted or rotated."""
+    get_token_user_cache().delete(instance.key)
+
+
+# The fields of the cached user the authentication and the permissions
+# depend on, the others may be stale for the TTL
+AUTH_USER_FIELDS = ("is_active", "is_staff", "is_superuser")
+
+
+def get_auth_state(user: Any) -> Tuple[Any, ...]:
+    """The auth fields of the user, the deferred ones are not loaded."""
+    return tuple(
+        user.__dict__.get(name, DEFERRED) for name in AUTH_USER_FIELDS
+    )
+
+
+@receiver(post_init, sender=settings.AUTH_USER_MODEL)
+def track_auth_state(sender, instance, **kwargs):
+    instance._auth_state = get_auth_state(instance)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_user_tokens(sender, instance, created, **kwargs):
+    """The cached user is stale, eg: deactivated."""
+    state = get_auth_state(instance)
+    changed = state != instance._auth_state
+    instance._auth_state = state
+    if created or not changed:  # Can't have a token yet, or still valid
+        return
+
+    cache = get_token_user_cache()
+    for key in Token.objects.filter(user=instance).values_list(
+        "key", flat=True
+    ):
+        cache.delete(key)
+
+
+@checks.register(checks.Tags.security, deploy=True)
+def check_token_user_cache(app_configs, **kwargs):
+    """The revoked tokens must be invalidated in every process at once."""
+    backend = settings.TOKEN_AUTH_CACHE["BACKEND"]
+    if backend and not isinstance(caches[backend], (LocMemCache, DummyCache)):
+        return []
+    return [
+        checks.Warning(
+            "The token -> user cache is local to each process: a revoked "
+            "token stays valid in the others for TOKEN_AUTH_CACHE"
+            '["LOCAL_TTL"] seconds.',
+            hint="Set TOKEN_AUTH_CACHE_BACKEND to a cache shared by the "
+            "processes, eg: Redis or Memcached.",
+            id="utils.W001",
+        )
+    ]
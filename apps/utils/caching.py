@@ -0,0 +1,56 @@
+import hashlib
+from datetime import datetime
+from typing import Any, AnyStr, Union
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http.response import HttpResponseBase
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+
+def get_etag(*parts: Any) -> AnyStr:
+    """Quoted ETag of the parts of a version, eg: id and updated_at."""
+    version = "|".join(str(part) for part in parts)
+    return quote_etag(hashlib.md5(version.encode()).hexdigest())
+
+
+def get_not_modified_response(
+    request, etag: AnyStr, last_modified: Union[datetime, None] = None
+) -> Union[HttpResponseBase, None]:
+    """
+    The 304 of a GET / HEAD whose version the client already has, else
+    None. Checked before the serialization, which is then skipped.
+    """
+    if request.method not in ("GET", "HEAD"):
+        return None
+
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=(
+            int(last_modified.timestamp()) if last_modified else None
+        ),
+    )
+    if response is not None:
+        set_version_headers(response, etag, last_modified)
+    return response
+
+
+def set_version_headers(
+    response: HttpResponseBase,
+    etag: AnyStr,
+    last_modified: Union[datetime, None] = None,
+) -> HttpResponseBase:
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified.timestamp())
+    # Per user, revalidated on every use
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def get_response_cache():
+    """The cache of RESPONSE_CACHE, None when it is disabled."""
+    backend = settings.RESPONSE_CACHE["BACKEND"]
+    return caches[backend] if backend else None
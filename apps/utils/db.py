@@ -0,0 +1,58 @@
+import os
+from contextlib import contextmanager
+from typing import AnyStr, Iterator, NoReturn
+
+from django.core.signals import request_started
+from django.db import connections
+from django.dispatch import receiver
+
+
+@receiver(request_started)
+def check_connections(**kwargs):
+    """
+    Close the kept connections that went unusable meanwhile (eg: restarted
+    server, pooler timeout), so that the request opens a new one instead of
+    failing on its first query. Enabled per database by CONN_HEALTH_CHECKS,
+    the setting of the same behavior in Django 4.1+.
+    """
+    for connection in connections.all():
+        if (
+            connection.connection is None
+            or not connection.settings_dict.get("CONN_HEALTH_CHECKS")
+            or connection.in_atomic_block
+        ):
+            continue
+        if not connection.is_usable():
+            connection.close()
+
+
+@contextmanager
+def temporary_databases(directory: AnyStr) -> Iterator[NoReturn]:
+    """
+    Create temporary databases like the test runner, dropped on exit: for
+    the benchmarks, which seed them and commit as in production. The SQLite
+    ones are files in the directory.
+    """
+    # Test utilities, not loaded along with the receivers above
+    from django.test.utils import setup_databases, teardown_databases
+
+    for alias in connections:
+        database = connections[alias]
+        test_settings = database.settings_dict["TEST"]
+        if database.vendor == "sqlite" and not test_settings.get("MIRROR"):
+            # In a file, not in memory: the threads would share it by a
+            # cache locked per table
+            test_settings["NAME"] = os.path.join(directory, f"{alias}.sqlite3")
+
+    old_config = setup_databases(
+        verbosity=0, interactive=False, serialized_aliases=set()
+    )
+    try:
+        for alias in connections:
+            if connections[alias].vendor == "sqlite":
+                # The readers do not block the writer
+                with connections[alias].cursor() as cursor:
+                    cursor.execute("PRAGMA journal_mode=WAL")
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=0)
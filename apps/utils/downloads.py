@@ -0,0 +1,221 @@
+import hashlib
+import mimetypes
+import os
+import re
+from datetime import datetime
+from typing import (
+    AnyStr,
+    AsyncIterator,
+    Iterator,
+    List,
+    NoReturn,
+    Tuple,
+    Union,
+)
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.http.response import HttpResponseBase
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class UnsatisfiableRange(Exception):
+    """The requested range is outside of the file."""
+
+
+class FileRangeIterator:
+    """
+    Reads exactly `length` bytes of the files, one after the other, from
+    `start`, chunk by chunk, so that they are never loaded in memory and
+    bytes appended meanwhile are not sent past the Content-Length.
+
+    The files are opened at once: replaced meanwhile, they are still read.
+    Iterated asynchronously, the chunks are read in the threads.
+    """
+
+    def __init__(
+        self, paths: List[AnyStr], start: int, length: int, chunk_size: int
+    ):
+        self.files = []
+        try:
+            for path in paths:
+                self.files.append(open(path, "rb"))
+        except BaseException:
+            self.close()
+            raise
+        self.start = start
+        self.remaining = length
+        self.chunk_size = chunk_size
+
+    def __iter__(self) -> Iterator[bytes]:
+        offset = self.start
+        for file in self.files:
+            size = os.fstat(file.fileno()).st_size
+            if offset >= size:  # Before the range
+                offset -= size
+                continue
+
+            file.seek(offset)
+            offset = 0
+            while self.remaining > 0:
+                chunk = file.read(min(self.chunk_size, self.remaining))
+                if not chunk:  # Its end, or truncated meanwhile
+                    break
+                self.remaining -= len(chunk)
+                yield chunk
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        chunks = iter(self)
+        read = sync_to_async(next, thread_sensitive=False)
+        while True:
+            chunk = await read(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def close(self) -> NoReturn:
+        for file in self.files:
+            file.close()
+
+
+class FileStreamingHttpResponse(StreamingHttpResponse):
+    """
+    Streams a FileRangeIterator. Sent by the ASGI handler of the project
+    with no read on its event loop, see apps.utils.asgi.
+    """
+
+    # As the async iterators of Django 4.2
+    is_async = True
+
+    def __init__(self, files: FileRangeIterator, *args, **kwargs):
+        super().__init__(files, *args, **kwargs)
+        self.files = files
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.files:
+            yield self.make_bytes(chunk)
+
+
+def parse_range(header: AnyStr, size: int) -> Union[Tuple[int, int], None]:
+    """
+    Return the (start, end) of a single byte range, both inclusive. None when
+    the header is not a single byte range, it is then ignored.
+    """
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:  # Suffix range, the last bytes
+        length = int(last)
+        if length == 0:
+            raise UnsatisfiableRange
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise UnsatisfiableRange
+    return start, end
+
+
+def get_file_version(
+    name: AnyStr, stats: List[os.stat_result], updated_at: datetime
+) -> Tuple[AnyStr, float]:
+    """
+    ETag and Last-Modified timestamp of the files.
+
+    Derived from the updated_at of the row and the name of the file, the
+    hash of its content, along with the sizes of the files: the activity
+    lines are only appended, and a download appends none.
+    """
+    version = "-".join(
+        [str(updated_at.timestamp()), name]
+        + [str(stat.st_size) for stat in stats]
+    )
+    etag = quote_etag(hashlib.md5(version.encode()).hexdigest())
+    return etag, max([updated_at.timestamp()] + [s.st_mtime for s in stats])
+
+
+def serve_file(
+    request, paths: List[AnyStr], name: AnyStr, updated_at: datetime
+) -> HttpResponseBase:
+    """
+    Respond with the files, one after the other, as the file of the name,
+    according to DOCUMENT_DOWNLOAD["MODE"]:
+
+    stream: Streamed by the worker, with Range and conditional GET support.
+    x-accel-redirect / x-sendfile: Headers only, the web server sends the
+    file (it then handles the ranges). Only for a single file, several
+    files are streamed.
+    """
+    options = settings.DOCUMENT_DOWNLOAD
+    stats = [os.stat(path) for path in paths]
+    etag, last_modified = get_file_version(name, stats, updated_at)
+
+    # 304 / 412, the file is not opened
+    response = get_conditional_response(
+        request, etag=etag, last_modified=int(last_modified)
+    )
+    if response is not None:
+        return response
+
+    mode = options["MODE"] if len(paths) == 1 else "stream"
+    if mode == "x-accel-redirect":
+        response = HttpResponse()
+        response["X-Accel-Redirect"] = (
+            options["X_ACCEL_REDIRECT_PREFIX"] + name
+        )
+    elif mode == "x-sendfile":
+        response = HttpResponse()
+        response["X-Sendfile"] = paths[0]
+    else:
+        size = sum(stat.st_size for stat in stats)
+        response = stream_file(
+            request, paths, size, etag, options["CHUNK_SIZE"]
+        )
+
+    content_type, _ = mimetypes.guess_type(name)
+    response["Content-Type"] = content_type or "application/octet-stream"
+    response["Content-Disposition"] = (
+        f'attachment; filename="{os.path.basename(name)}"'
+    )
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+def stream_file(
+    request, paths: List[AnyStr], size: int, etag: AnyStr, chunk_size: int
+) -> HttpResponseBase:
+    byte_range = None
+    header = request.META.get("HTTP_RANGE")
+    # A range only applies to the same version of the file
+    if header and request.META.get("HTTP_IF_RANGE", etag) == etag:
+        try:
+            byte_range = parse_range(header, size)
+        except UnsatisfiableRange:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+    if byte_range is None:
+        start, end, status = 0, size - 1, 200
+    else:
+        (start, end), status = byte_range, 206
+
+    length = end - start + 1 if size else 0
+    response = FileStreamingHttpResponse(
+        FileRangeIterator(paths, start, length, chunk_size), status=status
+    )
+    response["Content-Length"] = str(length)
+    response["Accept-Ranges"] = "bytes"
+    if status == 206:
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return response
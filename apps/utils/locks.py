@@ -0,0 +1,222 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import AnyStr, Dict, Iterator, NoReturn, Union
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows
+    fcntl = None
+
+
+class LockTimeout(Exception):
+    """The lock could not be acquired in time."""
+
+
+class LockMetrics:
+    """Counters of the lock acquisitions, the wait times in seconds."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> NoReturn:
+        with self._lock:
+            self.acquired = 0
+            self.contended = 0
+            self.timeouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+
+    def observe(self, wait: float, acquired: bool) -> NoReturn:
+        with self._lock:
+            if acquired:
+                self.acquired += 1
+            else:
+                self.timeouts += 1
+            if wait > 0:
+                self.contended += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def snapshot(self) -> Dict[AnyStr, Union[int, float]]:
+        with self._lock:
+            return {
+                "acquired": self.acquired,
+                "contended": self.contended,
+                "timeouts": self.timeouts,
+                "wait_seconds": self.wait_seconds,
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+
+class FileLockBackend:
+    """
+    Advisory fcntl locks on lock files, for the processes of a single host.
+
+    A lock file is removed by its holder on release. A process that locked
+    a removed file (it opened it before the removal) sees another inode at
+    the path, and tries again on the new file.
+    """
+
+    def __init__(self, directory: AnyStr):
+        if fcntl is None:
+            raise ImproperlyConfigured("fcntl locks need a POSIX system.")
+        self.directory = directory
+
+    def get_path(self, name: AnyStr) -> AnyStr:
+        digest = hashlib.sha1(name.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.lock")
+
+    def try_acquire(self, name: AnyStr) -> Union[object, None]:
+        path = self.get_path(name)
+        while True:
+            try:
+                descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            except FileNotFoundError:  # The first lock of the directory
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                continue
+            try:
+                fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(descriptor)
+                return None
+
+            try:
+                current = os.stat(path).st_ino
+            except FileNotFoundError:
+                current = None
+            if current == os.fstat(descriptor).st_ino:
+                return descriptor
+            # Removed by its previous holder meanwhile
+            os.close(descriptor)
+
+    def release(self, name: AnyStr, handle: object) -> NoReturn:
+        # Removed while locked, no lock file is left behind
+        try:
+            os.unlink(self.get_path(name))
+        except FileNotFoundError:
+            pass
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        os.close(handle)
+
+
+class DatabaseLeaseBackend:
+    """
+    Leases stored as rows, for the processes of several hosts.
+
+    A lease expires after `lease_timeout` seconds, so a crashed holder does
+    not block the others forever. The critical sections must be shorter.
+
+    The leases are written on the connection of the `database` alias, in
+    autocommit: a lease taken in a transaction is seen by the other hosts
+    at once, they wait for it up to their timeout.
+    """
+
+    def __init__(self, lease_timeout: float, database: AnyStr):
+        self.lease_timeout = lease_timeout
+        self.database = database
+
+    def try_acquire(self, name: AnyStr) -> Union[object, None]:
+        from .models import Lease
+
+        owner = uuid.uuid4().hex
+        now = timezone.now()
+        expires_at = now + timedelta(seconds=self.lease_timeout)
+        leases = Lease.objects.using(self.database)
+        try:
+            with transaction.atomic(using=self.database):
+                leases.create(name=name, owner=owner, expires_at=expires_at)
+            return owner
+        except IntegrityError:
+            pass
+
+        # Take it over, if it has expired
+        taken = leases.filter(name=name, expires_at__lt=now).update(
+            owner=owner, expires_at=expires_at
+        )
+        return owner if taken else None
+
+    def release(self, name: AnyStr, handle: object) -> NoReturn:
+        from .models import Lease
+
+        Lease.objects.using(self.database).filter(
+            name=name, owner=handle
+        ).delete()
+
+
+class LockManager:
+    """
+    Named exclusive locks, with the wait times recorded in `metrics`.
+
+        with get_lock_manager().lock("documents/AB/CD/ABCD123456.txt"):
+            ...
+    """
+
+    def __init__(
+        self,
+        backend: Union[FileLockBackend, DatabaseLeaseBackend],
+        timeout: float,
+    ):
+        self.backend = backend
+        self.timeout = timeout
+        self.metrics = LockMetrics()
+
+    @classmethod
+    def from_settings(cls) -> "LockManager":
+        options = settings.LOCKS
+        if options["BACKEND"] == "file":
+            backend = FileLockBackend(options["DIRECTORY"])
+        elif options["BACKEND"] == "database":
+            backend = DatabaseLeaseBackend(
+                options["LEASE_TIMEOUT"], options["DATABASE"]
+            )
+        else:
+            raise ImproperlyConfigured(
+                f"Unknown lock backend: {options['BACKEND']}"
+            )
+        return cls(backend, timeout=options["TIMEOUT"])
+
+    @contextmanager
+    def lock(self, name: AnyStr) -> Iterator[NoReturn]:
+        started = time.monotonic()
+        delay = 0.001
+        handle = self.backend.try_acquire(name)
+        while handle is None:
+            if time.monotonic() - started >= self.timeout:
+                self.metrics.observe(time.monotonic() - started, False)
+                raise LockTimeout(name)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)  # Back off, up to 50ms
+            handle = self.backend.try_acquire(name)
+
+        wait = time.monotonic() - started if delay > 0.001 else 0.0
+        self.metrics.observe(wait, True)
+        try:
+            yield
+        finally:
+            self.backend.release(name, handle)
+
+
+_lock_manager: Union[LockManager, None] = None
+_lock_manager_lock = threading.Lock()
+
+
+def get_lock_manager() -> LockManager:
+    """Return the process wide lock manager, created on the first use."""
+    global _lock_manager
+
+    if _lock_manager is None:
+        with _lock_manager_lock:
+            if _lock_manager is None:
+                _lock_manager = LockManager.from_settings()
+    return _lock_manager
@@ -0,0 +1,73 @@
+import signal
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from apps.utils.models import QueuedTask
+from apps.utils.tasks import DatabaseBackend
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the tasks of the database task queue (TASKS_BACKEND=database). "
+        "Several workers can run at once, on several hosts."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=10, help="Tasks per claim"
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Run the runnable tasks, then exit",
+        )
+        parser.add_argument(
+            "--purge-after",
+            type=int,
+            default=7,
+            help="Days the done tasks are kept, for their idempotency keys",
+        )
+
+    def handle(self, *args, **options):
+        backend = DatabaseBackend(settings.TASKS["LEASE"])
+        self.stopping = False
+        if not options["once"]:
+            # Finish the current batch on shutdown
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+        self.purge(options["purge_after"])
+        done = failed = 0
+        while not self.stopping:
+            close_old_connections()
+            tasks = backend.claim(options["batch_size"])
+            for task in tasks:
+                if backend.run(task):
+                    done += 1
+                else:
+                    failed += 1
+
+            if not tasks:
+                if options["once"]:
+                    break
+                time.sleep(settings.TASKS["POLL_INTERVAL"])
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Done, {done} tasks run, {failed} failed")
+        )
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def purge(self, days: int):
+        deleted, _ = QueuedTask.objects.filter(
+            status=QueuedTask.Status.DONE,
+            updated_at__lt=timezone.now() - timedelta(days=days),
+        ).delete()
+        if deleted:
+            self.stdout.write(f"{deleted} done tasks purged")
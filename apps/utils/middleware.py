@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+from contextlib import ExitStack
+from typing import AnyStr, NoReturn, Union
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http.response import HttpResponseBase
+from django.utils.deprecation import MiddlewareMixin
+
+from rest_framework.permissions import SAFE_METHODS
+
+from .profiling import (
+    Profile,
+    get_current_profile,
+    profile,
+    record_queries,
+)
+from .routers import read_from_replica
+
+
+class ReplicaRoutingMiddleware(MiddlewareMixin):
+    """
+    Runs the safe-method requests of the viewsets having `replica_reads` on
+    a read replica, see ReplicaRouter.
+
+    Read your writes: after a successful write, the requests with the same
+    credentials (one token per user) stay on the primary for
+    READ_YOUR_WRITES["SECONDS"], the bound of the replication lag.
+    """
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        with ExitStack() as stack:
+            request.replica_stack = stack
+            response = self.get_response(request)
+
+        if self.must_pin(request, response):
+            self.pin(request)
+        return response
+
+    async def __acall__(self, request):
+        """Under ASGI, with no thread held by the request in between."""
+        with ExitStack() as stack:
+            request.replica_stack = stack
+            response = await self.get_response(request)
+
+        if self.must_pin(request, response):
+            await sync_to_async(self.pin, thread_sensitive=False)(request)
+        return response
+
+    @staticmethod
+    def must_pin(request, response: HttpResponseBase) -> bool:
+        """A successful write, read from the primary for a while after."""
+        return bool(
+            settings.DATABASE_REPLICAS
+            and request.method not in SAFE_METHODS
+            and response.status_code < 400
+        )
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # The DRF viewsets, as routed
+        view_class = getattr(view_func, "cls", None)
+        if (
+            getattr(view_class, "replica_reads", False)
+            and request.method in SAFE_METHODS
+            and not self.is_pinned(request)
+        ):
+            request.replica_stack.enter_context(read_from_replica())
+        return None
+
+    @staticmethod
+    def get_pin_key(request) -> Union[AnyStr, None]:
+        credentials = request.META.get("HTTP_AUTHORIZATION")
+        if not credentials:
+            return None
+        digest = hashlib.sha256(credentials.encode()).hexdigest()
+        return f"replica-pin:{digest}"
+
+    def pin(self, request) -> NoReturn:
+        key = self.get_pin_key(request)
+        if key is not None:
+            options = settings.READ_YOUR_WRITES
+            caches[options["CACHE"]].set(key, True, options["SECONDS"])
+
+    def is_pinned(self, request) -> bool:
+        key = self.get_pin_key(request)
+        if key is None or not settings.DATABASE_REPLICAS:
+            return False
+        cache = caches[settings.READ_YOUR_WRITES["CACHE"]]
+        return cache.get(key) is not None
+
+
+class ProfilingMiddleware(MiddlewareMixin):
+    """
+    Profiles the sampled requests, see apps.utils.profiling. Their phases
+    are sent in the Server-Timing header. First of the MIDDLEWARE: the
+    total covers the others, not the streaming of a response.
+    """
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        with profile(request.path) as current:
+            response = self.get_response(request)
+        return self.add_server_timing(current, response)
+
+    async def __acall__(self, request):
+        """Under ASGI, the sync views run in the thread of the request."""
+        with profile(request.path) as current:
+            if current is None:
+                response = await self.get_response(request)
+            else:
+                # Its connections are its own
+                stack = ExitStack()
+                await sync_to_async(stack.enter_context)(
+                    record_queries(current)
+                )
+                try:
+                    response = await self.get_response(request)
+                finally:
+                    await sync_to_async(stack.close)()
+        return self.add_server_timing(current, response)
+
+    @staticmethod
+    def add_server_timing(
+        current: Union[Profile, None], response: HttpResponseBase
+    ) -> HttpResponseBase:
+        if current is not None and settings.PROFILING["SERVER_TIMING"]:
+            response["Server-Timing"] = current.get_server_timing()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # The route, not the path: the metrics stay bounded
+        current = get_current_profile()
+        if current is not None:
+            current.view = request.resolver_match.view_name
+        return None
@@ -1,6 +1,7 @@
 import uuid
 
 from django.db import models
+from django.utils import timezone
 
 
 def get_short_uuid():
@@ -22,3 +23,61 @@ class BaseModel(models.Model):
 
     class Meta:
         abstract = True
+
+
+class Lease(BaseModel):
+    """A named lock held until it is released or it expires."""
+
+    name = models.CharField(max_length=255, unique=True)
+    # Random token of the holder, only the holder releases it
+    owner = models.CharField(max_length=32)
+    expires_at = models.DateTimeField()
+
+
+class Blob(BaseModel):
+    """
+    A content-addressed file of the storage and the number of the rows
+    referring to it, see ContentAddressedStorage.
+    """
+
+    name = models.CharField(max_length=255, unique=True)
+    # Counted in the transactions of the referring rows
+    references = models.BigIntegerField(default=0)
+
+
+class QueuedTask(BaseModel):
+    """A task of the database backend of the task queue, see tasks.py."""
+
+    class Status(models.TextChoices):
+        PENDING = "Pending"
+        RUNNING = "Running"
+        DONE = "Done"
+        FAILED = "Failed"
+
+    # The enqueue order, the tasks of a group run in it
+    id = models.BigAutoField(primary_key=True)
+    name = models.CharField(max_length=255)
+    arguments = models.JSONField(default=dict)  # {"args": [], "kwargs": {}}
+    group = models.CharField(max_length=255, null=True, blank=True)
+    # A task enqueued again with the same key is skipped
+    idempotency_key = models.CharField(
+        max_length=255, null=True, blank=True, unique=True
+    )
+    status = models.CharField(
+        max_length=16, choices=Status.choices, default=Status.PENDING
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField()
+    run_after = models.DateTimeField(default=timezone.now)
+    # Lease of the worker running it
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        verbose_name_plural = "Queued Tasks"
+        indexes = [
+            # Runnable tasks, and the first unfinished task of each group
+            models.Index(
+                fields=["status", "group", "id"], name="task_status_group_idx"
+            ),
+        ]
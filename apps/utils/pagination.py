@@ -1,9 +1,292 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from typing import Any, AnyStr, List, Tuple, Union
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q, QuerySet
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import (
+    BasePagination,
+    PageNumberPagination,
+    _positive_int,
+)
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 
 class CustomPageNumberPagination(PageNumberPagination):
-    """Custom Pagination Class."""
+    """
+    Custom Pagination Class.
+
+    With ?count=false the COUNT query is skipped: one extra row is fetched to
+    tell whether there is a next page and the count is returned as null.
+    """
 
     page_size = 50
     page_size_query_param = "limit"
     max_page_size = 1000
+    count_query_param = "count"
+
+    def paginate_queryset(
+        self, queryset: QuerySet, request: Any, view: Any = None
+    ) -> Union[List[Any], None]:
+        self.is_counted = self.is_count_requested(request)
+        if self.is_counted:
+            return super().paginate_queryset(queryset, request, view)
+
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        self.request = request
+        try:
+            self.page_number = _positive_int(
+                request.query_params.get(self.page_query_param, 1),
+                strict=True,
+            )
+        except ValueError:
+            raise NotFound(
+                self.invalid_page_message.format(
+                    page_number=request.query_params.get(
+                        self.page_query_param
+                    ),
+                    message="That page number is not an integer",
+                )
+            )
+
+        offset = (self.page_number - 1) * page_size
+        # One extra row tells whether there is a next page
+        results = list(queryset[offset : offset + page_size + 1])
+        if not results and self.page_number > 1:
+            raise NotFound(
+                self.invalid_page_message.format(
+                    page_number=self.page_number,
+                    message="That page contains no results",
+                )
+            )
+
+        self.has_next = len(results) > page_size
+        return results[:page_size]
+
+    def get_paginated_response(self, data: List[Any]) -> Response:
+        if self.is_counted:
+            return super().get_paginated_response(data)
+
+        return Response(
+            OrderedDict(
+                [
+                    ("count", None),
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data),
+                ]
+            )
+        )
+
+    def is_count_requested(self, request: Any) -> bool:
+        value = request.query_params.get(self.count_query_param, "true")
+        return value.lower() not in ("false", "0")
+
+    def get_next_link(self) -> Union[AnyStr, None]:
+        if self.is_counted:
+            return super().get_next_link()
+
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.page_query_param, self.page_number + 1
+        )
+
+    def get_previous_link(self) -> Union[AnyStr, None]:
+        if self.is_counted:
+            return super().get_previous_link()
+
+        if self.page_number == 1:
+            return None
+        url = self.request.build_absolute_uri()
+        if self.page_number == 2:
+            return remove_query_param(url, self.page_query_param)
+        return replace_query_param(
+            url, self.page_query_param, self.page_number - 1
+        )
+
+
+class RankedPagination(CustomPageNumberPagination):
+    """
+    Page numbers over ranked results, eg: of a search. Never counted: the
+    results are a sliceable sequence, fetched one page at a time.
+    """
+
+    def is_count_requested(self, request: Any) -> bool:
+        return False
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) Pagination Class.
+
+    Pages follow the ordering of the queryset, with the primary key appended
+    as the tie breaker. The cursor holds the ordering values of the last row,
+    so every page is a single range query on them: no COUNT and no OFFSET.
+    """
+
+    page_size = 50
+    page_size_query_param = "limit"
+    max_page_size = 1000
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(
+        self, queryset: QuerySet, request: Any, view: Any = None
+    ) -> List[Any]:
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(queryset)
+        queryset = queryset.order_by(*self.ordering)
+
+        position = self.decode_cursor(request, queryset)
+        if position is not None:
+            queryset = queryset.filter(self.get_position_filter(position))
+
+        # One extra row tells whether there is a next page
+        results = list(queryset[: self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        results = results[: self.page_size]
+
+        self.next_position = None
+        if self.has_next:
+            self.next_position = self.get_position(results[-1])
+        return results
+
+    def get_paginated_response(self, data: List[Any]) -> Response:
+        return Response(
+            OrderedDict([("next", self.get_next_link()), ("results", data)])
+        )
+
+    def get_paginated_response_schema(self, schema: dict) -> dict:
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True},
+                "results": schema,
+            },
+        }
+
+    def get_page_size(self, request: Any) -> int:
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size,
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    @staticmethod
+    def get_ordering(queryset: QuerySet) -> Tuple[AnyStr, ...]:
+        """Ordering of the queryset, made unique with the primary key."""
+        pk_name = queryset.model._meta.pk.name
+        ordering = []
+        for field in queryset.query.order_by or queryset.model._meta.ordering:
+            if field.lstrip("-") == "pk":
+                field = field.replace("pk", pk_name)
+            ordering.append(field)
+
+        if not any(field.lstrip("-") == pk_name for field in ordering):
+            # Same direction as the last field
+            descending = bool(ordering) and ordering[-1].startswith("-")
+            ordering.append(f"-{pk_name}" if descending else pk_name)
+        return tuple(ordering)
+
+    def get_position(self, instance: Any) -> List[Any]:
+        position = []
+        for field in self.ordering:
+            value = getattr(instance, field.lstrip("-"))
+            if hasattr(value, "isoformat"):
+                value = value.isoformat()
+            position.append(value)
+        return position
+
+    def get_position_filter(self, position: List[Any]) -> Q:
+        """
+        Rows after the position, eg: for ("-created_at", "-id")
+        created_at < x OR (created_at = x AND id < y).
+        """
+        position_filter = Q()
+        equal_filter = Q()
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            position_filter |= equal_filter & Q(**{f"{name}__{lookup}": value})
+            equal_filter &= Q(**{name: value})
+        return position_filter
+
+    def decode_cursor(
+        self, request: Any, queryset: QuerySet
+    ) -> Union[List[Any], None]:
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            position = json.loads(b64decode(encoded.encode("ascii")))
+            if len(position) != len(self.ordering):
+                raise ValueError
+            # Back to the python values of the fields
+            opts = queryset.model._meta
+            return [
+                opts.get_field(field.lstrip("-")).to_python(value)
+                for field, value in zip(self.ordering, position)
+            ]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position: List[Any]) -> AnyStr:
+        return b64encode(json.dumps(position).encode("utf-8")).decode("ascii")
+
+    def get_next_link(self) -> Union[AnyStr, None]:
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url,
+            self.cursor_query_param,
+            self.encode_cursor(self.next_position),
+        )
+
+
+class SelectablePagination(BasePagination):
+    """
+    Page number pagination, or keyset pagination on opt-in.
+
+    The mode comes from ?pagination=page|cursor, and defaults to the
+    PAGINATION_MODE setting.
+    """
+
+    mode_query_param = "pagination"
+    pagination_classes = {
+        "page": CustomPageNumberPagination,
+        "cursor": KeysetPagination,
+    }
+
+    def get_pagination_class(self, request: Any) -> type:
+        mode = request.query_params.get(
+            self.mode_query_param, settings.PAGINATION_MODE
+        )
+        try:
+            return self.pagination_classes[mode]
+        except KeyError:
+            raise NotFound(f"Invalid pagination mode: {mode}")
+
+    def paginate_queryset(
+        self, queryset: QuerySet, request: Any, view: Any = None
+    ) -> Union[List[Any], None]:
+        self.paginator = self.get_pagination_class(request)()
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data: List[Any]) -> Response:
+        return self.paginator.get_paginated_response(data)
@@ -0,0 +1,289 @@
+"""
+Sampled profiling of the requests and the background tasks.
+
+A sampled request (PROFILING["SAMPLE_RATE"]) records the time, the queries
+and the bytes written of the instrumented phases, eg:
+
+    @instrument("file-append")
+    def append_content_to_file(self, content):
+        ...
+
+They are sent in its Server-Timing header and added to the metrics of the
+process, served in the Prometheus text format by the /metrics/ endpoint.
+Out of a sampled request, a phase costs a context variable lookup.
+"""
+
+import random
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, AnyStr, Callable, Dict, Iterator, List, NoReturn, Union
+
+from django.conf import settings
+from django.db import connections
+
+from .locks import get_lock_manager
+
+_current: ContextVar[Union["Profile", None]] = ContextVar(
+    "profile", default=None
+)
+
+
+class Profile:
+    """The phases of a request or a task: calls, seconds, queries, bytes."""
+
+    def __init__(self, view: AnyStr):
+        self.view = view
+        self.phases: Dict[AnyStr, Dict[AnyStr, Union[int, float]]] = {}
+        # Names of the running phases, the outermost first
+        self.stack: List[AnyStr] = []
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.bytes_written = 0
+        self.started = time.perf_counter()
+        self.seconds = None
+
+    def get_phase(self, name: AnyStr) -> Dict[AnyStr, Union[int, float]]:
+        if name not in self.phases:
+            self.phases[name] = {
+                "calls": 0,
+                "seconds": 0.0,
+                "queries": 0,
+                "bytes": 0,
+            }
+        return self.phases[name]
+
+    def execute(self, execute, sql, params, many, context) -> Any:
+        """Database execute wrapper, counts the queries of the phases."""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_seconds += time.perf_counter() - started
+            self.queries += 1
+            for name in self.stack:
+                self.phases[name]["queries"] += 1
+
+    def add_bytes(self, count: int) -> NoReturn:
+        self.bytes_written += count
+        for name in self.stack:
+            self.phases[name]["bytes"] += count
+
+    def finish(self) -> NoReturn:
+        self.seconds = time.perf_counter() - self.started
+
+    def get_totals(self) -> Dict[AnyStr, Dict[AnyStr, Union[int, float]]]:
+        """The phases, along with the whole request and its queries."""
+        return {
+            "total": {
+                "calls": 1,
+                "seconds": self.seconds,
+                "queries": self.queries,
+                "bytes": self.bytes_written,
+            },
+            "db": {
+                "calls": 1,
+                "seconds": self.query_seconds,
+                "queries": self.queries,
+                "bytes": 0,
+            },
+            **self.phases,
+        }
+
+    def get_server_timing(self) -> AnyStr:
+        """Value of the Server-Timing header, the durations in ms."""
+        entries = []
+        for name, phase in self.get_totals().items():
+            description = f"{phase['queries']} queries"
+            if phase["bytes"]:
+                description += f" {phase['bytes']} bytes"
+            entries.append(
+                f'{name};dur={phase["seconds"] * 1000:.2f};'
+                f'desc="{description}"'
+            )
+        return ", ".join(entries)
+
+
+def get_current_profile() -> Union[Profile, None]:
+    return _current.get()
+
+
+def is_sampled() -> bool:
+    rate = settings.PROFILING["SAMPLE_RATE"]
+    return rate > 0 and (rate >= 1 or random.random() < rate)
+
+
+@contextmanager
+def profile(view: AnyStr) -> Iterator[Union[Profile, None]]:
+    """
+    Profile the block when it is sampled, the profile is added to the
+    metrics at the end. Yields None when not sampled, or when in a profiled
+    block already: the phases then go to the enclosing profile.
+    """
+    if _current.get() is not None or not is_sampled():
+        yield None
+        return
+
+    current = Profile(view)
+    token = _current.set(current)
+    try:
+        with record_queries(current):
+            yield current
+    finally:
+        _current.reset(token)
+        current.finish()
+        metrics.observe(current)
+
+
+@contextmanager
+def record_queries(current: Profile) -> Iterator[NoReturn]:
+    """Record the queries of the block in the profile."""
+    with ExitStack() as stack:
+        # The connections of the thread
+        for alias in connections:
+            stack.enter_context(
+                connections[alias].execute_wrapper(current.execute)
+            )
+        yield
+
+
+@contextmanager
+def phase(name: AnyStr) -> Iterator[NoReturn]:
+    """Time the block as the phase, once: a nested same phase is a no-op."""
+    current = _current.get()
+    if current is None or name in current.stack:
+        yield
+        return
+
+    data = current.get_phase(name)
+    current.stack.append(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        data["seconds"] += time.perf_counter() - started
+        data["calls"] += 1
+        current.stack.pop()
+
+
+def instrument(name: AnyStr) -> Callable:
+    """Decorator, run the function as the phase."""
+
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def add_bytes_written(count: int) -> NoReturn:
+    """Count the bytes in the running phases."""
+    current = _current.get()
+    if current is not None:
+        current.add_bytes(count)
+
+
+class ProfileMetrics:
+    """
+    Aggregates of the profiles of the process, by view and phase: a
+    histogram of the seconds, the queries and the bytes written.
+    """
+
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> NoReturn:
+        with self._lock:
+            self.phases: Dict[tuple, Dict[AnyStr, Any]] = {}
+
+    def observe(self, current: Profile) -> NoReturn:
+        with self._lock:
+            for name, data in current.get_totals().items():
+                key = (current.view, name)
+                if key not in self.phases:
+                    self.phases[key] = {
+                        "count": 0,
+                        "seconds": 0.0,
+                        "queries": 0,
+                        "bytes": 0,
+                        "buckets": [0] * len(self.buckets),
+                    }
+                aggregate = self.phases[key]
+                aggregate["count"] += 1
+                aggregate["seconds"] += data["seconds"]
+                aggregate["queries"] += data["queries"]
+                aggregate["bytes"] += data["bytes"]
+                for index, bound in enumerate(self.buckets):
+                    if data["seconds"] <= bound:
+                        aggregate["buckets"][index] += 1
+
+    def snapshot(self) -> Dict[tuple, Dict[AnyStr, Any]]:
+        with self._lock:
+            return {
+                key: {**data, "buckets": list(data["buckets"])}
+                for key, data in self.phases.items()
+            }
+
+
+metrics = ProfileMetrics()
+
+
+def escape_label(value: AnyStr) -> AnyStr:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics() -> AnyStr:
+    """The metrics of the process, in the Prometheus text format."""
+    lines = [
+        "# HELP doclib_phase_seconds Seconds of the profiled phases.",
+        "# TYPE doclib_phase_seconds histogram",
+    ]
+    phases = sorted(metrics.snapshot().items())
+    for (view, name), data in phases:
+        labels = f'view="{escape_label(view)}",phase="{escape_label(name)}"'
+        for bound, count in zip(ProfileMetrics.buckets, data["buckets"]):
+            lines.append(
+                f'doclib_phase_seconds_bucket{{{labels},le="{bound}"}} '
+                f"{count}"
+            )
+        lines += [
+            f'doclib_phase_seconds_bucket{{{labels},le="+Inf"}} '
+            f"{data['count']}",
+            f"doclib_phase_seconds_sum{{{labels}}} {data['seconds']}",
+            f"doclib_phase_seconds_count{{{labels}}} {data['count']}",
+        ]
+
+    for metric, key, description in (
+        ("doclib_phase_queries_total", "queries", "SQL queries"),
+        ("doclib_phase_bytes_written_total", "bytes", "Bytes written"),
+    ):
+        lines += [
+            f"# HELP {metric} {description} of the profiled phases.",
+            f"# TYPE {metric} counter",
+        ]
+        for (view, name), data in phases:
+            labels = (
+                f'view="{escape_label(view)}",phase="{escape_label(name)}"'
+            )
+            lines.append(f"{metric}{{{labels}}} {data[key]}")
+
+    # The locks of the document files, all their acquisitions
+    lock_metrics = get_lock_manager().metrics.snapshot()
+    for metric, key, kind in (
+        ("doclib_lock_acquired_total", "acquired", "counter"),
+        ("doclib_lock_contended_total", "contended", "counter"),
+        ("doclib_lock_timeouts_total", "timeouts", "counter"),
+        ("doclib_lock_wait_seconds_total", "wait_seconds", "counter"),
+        ("doclib_lock_max_wait_seconds", "max_wait_seconds", "gauge"),
+    ):
+        lines += [f"# TYPE {metric} {kind}", f"{metric} {lock_metrics[key]}"]
+    return "\n".join(lines) + "\n"
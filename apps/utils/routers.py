@@ -0,0 +1,59 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AnyStr, Iterator, Union
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Replica the reads of the current request go to, None: the primary
+_read_database: ContextVar[Union[AnyStr, None]] = ContextVar(
+    "read_database", default=None
+)
+
+
+@contextmanager
+def read_from_replica() -> Iterator[Union[AnyStr, None]]:
+    """
+    Send the reads of the block to one of the DATABASE_REPLICAS, the same
+    one for all of them. A no-op when there is no replica.
+    """
+    replicas = settings.DATABASE_REPLICAS
+    previous = _read_database.get()
+    _read_database.set(random.choice(replicas) if replicas else None)
+    try:
+        yield _read_database.get()
+    finally:
+        # Not reset by its token: under ASGI, entered by the view middleware
+        # in a thread, in a copy of the context of the request
+        _read_database.set(previous)
+
+
+class ReplicaRouter:
+    """
+    Reads go to the replica chosen by `read_from_replica`, else to the
+    primary. Writes always go to the primary, including the saves of the
+    instances read from a replica.
+    """
+
+    def db_for_read(self, model, **hints) -> AnyStr:
+        alias = _read_database.get()
+        # The reads in a transaction of the primary see its writes
+        if alias is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints) -> AnyStr:
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints) -> bool:
+        # Same data on all the databases
+        return True
+
+    def allow_migrate(self, db, app_label, **hints) -> bool:
+        # The replicas and the lock connection follow the migrations of
+        # the primary
+        return (
+            db not in settings.DATABASE_REPLICAS
+            and db != settings.LOCKS["DATABASE"]
+        )
@@ -0,0 +1,247 @@
+import hashlib
+import os
+import posixpath
+import tempfile
+from typing import AnyStr, ContextManager, Iterable, NoReturn, Tuple
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, models, router, transaction
+from django.utils.module_loading import import_string
+
+from .locks import get_lock_manager
+from .models import Blob
+
+
+class ChecksumMismatch(Exception):
+    """The content does not have the expected SHA-256."""
+
+
+def shard(key: AnyStr, levels: int = 2, width: int = 2) -> Tuple[AnyStr, ...]:
+    """Directories of the key, eg: ABCDEF -> (AB, CD)."""
+    return tuple(key[i * width : (i + 1) * width] for i in range(levels))
+
+
+def get_sharded_name(directory: AnyStr, filename: AnyStr) -> AnyStr:
+    """
+    Spread the files over nested directories, eg: documents/AB/CD/ABCD12.txt,
+    so that no single directory holds millions of entries.
+    """
+    return posixpath.join(directory, *shard(filename), filename)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that can also save content under its SHA-256.
+
+    The regular saves behave as in FileSystemStorage. The content-addressed
+    saves store identical content once, under `blob_directory`, in a sharded
+    layout. Such files are shared, they must never be modified in place.
+
+    A content-addressed file is reference counted by a Blob row: a save
+    counts its reference before the file is stored, in the transaction of
+    the caller, and release() uncounts it. Once committed, the file is
+    deleted along with the row, if no reference is left: the row is locked
+    meanwhile, a reference being counted waits for the delete, then stores
+    the file again.
+    """
+
+    blob_directory = "blobs"
+    # Bytes read per call, to hash the saved files
+    read_size = 1024 * 1024
+
+    def save_content_addressed(
+        self, content: File, directory: AnyStr, extension: AnyStr = ""
+    ) -> AnyStr:
+        """Save the content, deduplicated. Return its name, referenced."""
+        return self.save_chunks_content_addressed(
+            content.chunks(), directory, extension
+        )
+
+    def save_chunks_content_addressed(
+        self,
+        chunks: Iterable[AnyStr],
+        directory: AnyStr,
+        extension: AnyStr = "",
+    ) -> AnyStr:
+        """
+        Save the content of the chunks, deduplicated. Return its name,
+        referenced.
+        """
+        os.makedirs(self.location, exist_ok=True)
+        digest = hashlib.sha256()
+
+        # Hashed while written, a single pass over the content
+        with tempfile.NamedTemporaryFile(
+            dir=self.location, delete=False
+        ) as temporary:
+            try:
+                for chunk in chunks:
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    temporary.write(chunk)
+            except BaseException:
+                os.unlink(temporary.name)
+                raise
+
+        name = self.get_content_addressed_name(
+            digest.hexdigest(), directory, extension
+        )
+        self.reference(name)
+        self._store(temporary.name, name)
+        return name
+
+    def save_file_content_addressed(
+        self,
+        path: AnyStr,
+        directory: AnyStr,
+        extension: AnyStr = "",
+        checksum: AnyStr = "",
+    ) -> AnyStr:
+        """
+        Move the file at the path into the storage, deduplicated: it is
+        read once to be hashed, never copied. Return its name, referenced.
+
+        checksum: The expected SHA-256 hex digest, if any. Checked by the
+        same read, ChecksumMismatch is raised before anything is stored.
+        """
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(self.read_size), b""):
+                digest.update(chunk)
+        if checksum and digest.hexdigest() != checksum:
+            raise ChecksumMismatch
+
+        name = self.get_content_addressed_name(
+            digest.hexdigest(), directory, extension
+        )
+        self.reference(name)
+        self._store(path, name)
+        return name
+
+    def save_bytes_content_addressed(
+        self,
+        data: bytes,
+        directory: AnyStr,
+        extension: AnyStr = "",
+        references: int = 1,
+    ) -> AnyStr:
+        """
+        Save the bytes, deduplicated. Hashed before any write: stored bytes
+        are not written again. Return their name, referenced `references`
+        times, eg: by each of the rows created with it.
+        """
+        name = self.get_content_addressed_name(
+            hashlib.sha256(data).hexdigest(), directory, extension
+        )
+        self.reference(name, references)
+        path = self.path(name)
+        with self.lock(name):
+            if os.path.exists(path):  # Already stored
+                return name
+
+            os.makedirs(self.location, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                dir=self.location, delete=False
+            ) as temporary:
+                try:
+                    temporary.write(data)
+                except BaseException:
+                    os.unlink(temporary.name)
+                    raise
+            self._move_into_place(temporary.name, path)
+        return name
+
+    def get_content_addressed_name(
+        self, digest: AnyStr, directory: AnyStr, extension: AnyStr = ""
+    ) -> AnyStr:
+        return get_sharded_name(
+            posixpath.join(directory, self.blob_directory),
+            f"{digest}{extension}",
+        )
+
+    @staticmethod
+    def reference(name: AnyStr, count: int = 1) -> NoReturn:
+        """
+        Count the references to the content-addressed file, in the current
+        transaction. Before the file is stored: a release committed
+        meanwhile deletes the row first, along with the file.
+        """
+        database = router.db_for_write(Blob)
+        blobs = Blob.objects.using(database)
+        # Waits for the row locked by a release
+        if blobs.filter(name=name).update(
+            references=models.F("references") + count
+        ):
+            return
+        try:
+            # Savepoint, the caller transaction survives a concurrent insert
+            with transaction.atomic(using=database):
+                blobs.create(name=name, references=count)
+        except IntegrityError:
+            blobs.filter(name=name).update(
+                references=models.F("references") + count
+            )
+
+    def release(self, name: AnyStr, count: int = 1) -> NoReturn:
+        """
+        Uncount the references to the file, in the current transaction. Once
+        committed, the file is deleted unless referenced. A private file,
+        not content-addressed, is deleted then anyway.
+        """
+        database = router.db_for_write(Blob)
+        if not self.is_content_addressed(name):
+            transaction.on_commit(lambda: self.delete(name), using=database)
+            return
+
+        Blob.objects.using(database).filter(name=name).update(
+            references=models.F("references") - count
+        )
+        transaction.on_commit(
+            lambda: self.delete_unreferenced(name), using=database
+        )
+
+    def delete_unreferenced(self, name: AnyStr) -> NoReturn:
+        """Delete the file and its row, if no reference is left."""
+        database = router.db_for_write(Blob)
+        with transaction.atomic(using=database):
+            # Locks the row: a reference counted meanwhile is waited for,
+            # then the row is kept along with the file
+            deleted, _ = (
+                Blob.objects.using(database)
+                .filter(name=name, references__lte=0)
+                .delete()
+            )
+            if deleted:
+                with self.lock(name):
+                    self.delete(name)
+
+    def lock(self, name: AnyStr) -> ContextManager:
+        """The lock of the content-addressed file, held to store or delete it."""
+        return get_lock_manager().lock(self.path(name))
+
+    def _store(self, source: AnyStr, name: AnyStr) -> NoReturn:
+        """Move the file into place, unless the content is stored already."""
+        path = self.path(name)
+        with self.lock(name):
+            if os.path.exists(path):  # Already stored
+                os.unlink(source)
+                return
+            self._move_into_place(source, path)
+
+    def _move_into_place(self, temporary: AnyStr, path: AnyStr) -> NoReturn:
+        """Atomic, a reader never sees a partial file."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temporary, path)
+        if self.file_permissions_mode is not None:
+            os.chmod(path, self.file_permissions_mode)
+
+    def is_content_addressed(self, name: AnyStr) -> bool:
+        return f"/{self.blob_directory}/" in f"/{name}"
+
+
+def get_document_storage() -> FileSystemStorage:
+    """The storage of the document files, the DOCUMENT_STORAGE setting."""
+    return import_string(settings.DOCUMENT_STORAGE)()
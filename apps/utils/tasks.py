@@ -0,0 +1,368 @@
+import logging
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, AnyStr, Callable, Dict, List, NoReturn, Union
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import (
+    IntegrityError,
+    close_old_connections,
+    models,
+    transaction,
+)
+from django.utils import timezone
+
+from .models import QueuedTask
+from .profiling import profile
+
+logger = logging.getLogger(__name__)
+
+# The statuses of the tasks not run yet, or running
+UNFINISHED = [QueuedTask.Status.PENDING, QueuedTask.Status.RUNNING]
+
+# Registered tasks, by name
+_registry: Dict[AnyStr, "Task"] = {}
+
+
+class Task:
+    """A function the backends run by its name, with retries."""
+
+    def __init__(self, function: Callable, name: AnyStr, max_attempts: int):
+        self.function = function
+        self.name = name
+        self.max_attempts = max_attempts
+
+    def __call__(self, *args, **kwargs) -> Any:
+        # Sampled, unless run by a profiled request
+        with profile(f"task:{self.name}"):
+            return self.function(*args, **kwargs)
+
+
+def task(name: AnyStr, max_attempts: Union[int, None] = None) -> Callable:
+    """
+    Register the function as a task, eg:
+
+        @task("store.append_document_file")
+        def append_document_file(document_id, line):
+            ...
+
+    The arguments must be JSON serializable, for the database backend.
+    """
+
+    def register(function: Callable) -> Task:
+        _registry[name] = Task(
+            function,
+            name,
+            max_attempts or settings.TASKS["MAX_ATTEMPTS"],
+        )
+        return _registry[name]
+
+    return register
+
+
+def get_task(name: AnyStr) -> Task:
+    try:
+        return _registry[name]
+    except KeyError:
+        raise ImproperlyConfigured(f"Unknown task: {name}")
+
+
+def get_retry_delay(attempts: int) -> float:
+    """Seconds before the next attempt, doubled on each failure."""
+    return settings.TASKS["RETRY_DELAY"] * 2 ** (attempts - 1)
+
+
+class SyncBackend:
+    """Runs the tasks at once, in the caller, eg: for the tests."""
+
+    def enqueue(
+        self,
+        name: AnyStr,
+        args: List[Any],
+        kwargs: Dict[AnyStr, Any],
+        group: Union[AnyStr, None],
+        idempotency_key: Union[AnyStr, None],
+    ) -> NoReturn:
+        get_task(name)(*args, **kwargs)
+
+    def has_pending(self, group: AnyStr) -> bool:
+        return False
+
+
+class Submission:
+    """The submit of a task to the pool, once the transaction commits."""
+
+    def __init__(
+        self,
+        backend: "ThreadPoolBackend",
+        group: Union[AnyStr, None],
+        entry: tuple,
+        idempotency_key: Union[AnyStr, None],
+    ):
+        self.backend = backend
+        self.group = group
+        self.entry = entry
+        self.idempotency_key = idempotency_key
+
+    def __call__(self) -> NoReturn:
+        self.backend.submit(self.group, self.entry, self.idempotency_key)
+
+
+class ThreadPoolBackend:
+    """
+    Runs the tasks in a pool of threads of the process, once the enqueuing
+    transaction commits. Lost on a crash, like the activity log writer.
+
+    The tasks of a group run one at a time, in the enqueue order. The keys
+    of the recent committed tasks are kept to skip their duplicates.
+    """
+
+    max_keys = 10000
+
+    def __init__(self, workers: int):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="tasks"
+        )
+        self._groups: Dict[AnyStr, deque] = {}
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def enqueue(
+        self,
+        name: AnyStr,
+        args: List[Any],
+        kwargs: Dict[AnyStr, Any],
+        group: Union[AnyStr, None],
+        idempotency_key: Union[AnyStr, None],
+    ) -> NoReturn:
+        entry = (get_task(name), args, kwargs)
+        # Rolled back, the task is neither submitted nor its key kept
+        transaction.on_commit(Submission(self, group, entry, idempotency_key))
+
+    def has_pending(self, group: AnyStr) -> bool:
+        """
+        Whether a task of the group is submitted and not done, or enqueued
+        in the open transaction of the caller: as the rows of the database
+        backend, the ones of the other transactions are not visible.
+        """
+        with self._lock:
+            if group in self._groups:
+                return True
+        return any(
+            getattr(callback[1], "group", None) == group
+            for callback in transaction.get_connection().run_on_commit
+        )
+
+    def submit(
+        self,
+        group: Union[AnyStr, None],
+        entry: tuple,
+        idempotency_key: Union[AnyStr, None] = None,
+    ) -> NoReturn:
+        """Submit the task, unless a task of the same key was already."""
+        with self._lock:
+            if idempotency_key is not None:
+                if idempotency_key in self._keys:
+                    return
+                self._keys[idempotency_key] = True
+                while len(self._keys) > self.max_keys:
+                    self._keys.popitem(last=False)
+
+            if group is not None:
+                queue = self._groups.get(group)
+                if queue is not None:  # Drained by the running thread
+                    queue.append(entry)
+                    return
+                self._groups[group] = deque([entry])
+
+        if group is None:
+            self.executor.submit(self._run, *entry)
+        else:
+            self.executor.submit(self._drain, group)
+
+    def _drain(self, group: AnyStr) -> NoReturn:
+        while True:
+            with self._lock:
+                queue = self._groups[group]
+                if not queue:
+                    del self._groups[group]
+                    return
+                entry = queue.popleft()
+            self._run(*entry)
+
+    @staticmethod
+    def _run(task: Task, args: List[Any], kwargs: Dict[AnyStr, Any]):
+        for attempt in range(1, task.max_attempts + 1):
+            try:
+                task(*args, **kwargs)
+                return
+            except Exception:
+                logger.exception("Task %s failed", task.name)
+                if attempt < task.max_attempts:
+                    time.sleep(get_retry_delay(attempt))
+            finally:
+                close_old_connections()
+
+
+class DatabaseBackend:
+    """
+    Durable queue of QueuedTask rows, run by the `run_tasks` workers.
+
+    The tasks of a group run one at a time, in the enqueue order: only the
+    first unfinished task of a group can be claimed. A claimed task is
+    leased, the task of a crashed worker is claimed again once expired.
+    """
+
+    def __init__(self, lease: float):
+        self.lease = lease
+
+    def enqueue(
+        self,
+        name: AnyStr,
+        args: List[Any],
+        kwargs: Dict[AnyStr, Any],
+        group: Union[AnyStr, None],
+        idempotency_key: Union[AnyStr, None],
+    ) -> NoReturn:
+        try:
+            # Savepoint, the caller transaction survives a duplicate
+            with transaction.atomic():
+                QueuedTask.objects.create(
+                    name=name,
+                    arguments={"args": list(args), "kwargs": kwargs},
+                    group=group,
+                    idempotency_key=idempotency_key,
+                    max_attempts=get_task(name).max_attempts,
+                )
+        except IntegrityError:
+            if idempotency_key is None:
+                raise
+            # Already enqueued
+
+    def has_pending(self, group: AnyStr) -> bool:
+        """Whether an unfinished task of the group is enqueued."""
+        return QueuedTask.objects.filter(
+            status__in=UNFINISHED, group=group
+        ).exists()
+
+    def claim(self, limit: int) -> List[QueuedTask]:
+        """Lease the runnable tasks, at most `limit` of them."""
+        now = timezone.now()
+        # Checked for the candidates only, on the (status, group, id) index
+        earlier = QueuedTask.objects.filter(
+            status__in=UNFINISHED,
+            group=models.OuterRef("group"),
+            id__lt=models.OuterRef("id"),
+        )
+        candidates = (
+            QueuedTask.objects.filter(
+                models.Q(status=QueuedTask.Status.PENDING, run_after__lte=now)
+                | models.Q(
+                    status=QueuedTask.Status.RUNNING, locked_until__lt=now
+                )
+            )
+            .filter(models.Q(group__isnull=True) | ~models.Exists(earlier))
+            .order_by("id")[:limit]
+        )
+
+        claimed = []
+        for row in candidates:
+            # Conditional update, a single worker wins each task
+            updated = QueuedTask.objects.filter(
+                id=row.id, status=row.status, locked_until=row.locked_until
+            ).update(
+                status=QueuedTask.Status.RUNNING,
+                locked_until=now + timedelta(seconds=self.lease),
+                attempts=models.F("attempts") + 1,
+                updated_at=now,
+            )
+            if updated:
+                row.attempts += 1
+                claimed.append(row)
+        return claimed
+
+    def run(self, row: QueuedTask) -> bool:
+        """Run the claimed task, then record its outcome."""
+        try:
+            get_task(row.name)(
+                *row.arguments["args"], **row.arguments["kwargs"]
+            )
+        except Exception:
+            logger.exception("Task %s failed", row.name)
+            if row.attempts < row.max_attempts:
+                status = QueuedTask.Status.PENDING
+            else:
+                status = QueuedTask.Status.FAILED
+            QueuedTask.objects.filter(id=row.id).update(
+                status=status,
+                locked_until=None,
+                run_after=timezone.now()
+                + timedelta(seconds=get_retry_delay(row.attempts)),
+                last_error=traceback.format_exc(),
+                updated_at=timezone.now(),
+            )
+            return False
+
+        QueuedTask.objects.filter(id=row.id).update(
+            status=QueuedTask.Status.DONE,
+            locked_until=None,
+            updated_at=timezone.now(),
+        )
+        return True
+
+
+def get_backend_from_settings() -> (
+    Union[SyncBackend, ThreadPoolBackend, DatabaseBackend]
+):
+    options = settings.TASKS
+    if options["BACKEND"] == "sync":
+        return SyncBackend()
+    if options["BACKEND"] == "thread":
+        return ThreadPoolBackend(options["WORKERS"])
+    if options["BACKEND"] == "database":
+        return DatabaseBackend(options["LEASE"])
+    raise ImproperlyConfigured(f"Unknown task backend: {options['BACKEND']}")
+
+
+_backends: Dict[AnyStr, Any] = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend() -> Union[SyncBackend, ThreadPoolBackend, DatabaseBackend]:
+    """Return the process wide backend of TASKS["BACKEND"]."""
+    name = settings.TASKS["BACKEND"]
+    if name not in _backends:
+        with _backends_lock:
+            if name not in _backends:
+                _backends[name] = get_backend_from_settings()
+    return _backends[name]
+
+
+def enqueue(
+    name: AnyStr,
+    *args,
+    group: Union[AnyStr, None] = None,
+    idempotency_key: Union[AnyStr, None] = None,
+    **kwargs,
+) -> NoReturn:
+    """
+    Run the task in the background, by the TASKS["BACKEND"].
+
+    group: The tasks of the same group run in the enqueue order, eg: the
+    file operations of a document.
+    idempotency_key: A task enqueued again with the same key is skipped.
+    """
+    get_backend().enqueue(name, args, kwargs, group, idempotency_key)
+
+
+def has_pending(group: AnyStr) -> bool:
+    """
+    Whether a task of the group may not have run yet: the work of the group
+    can run at once, in the caller, only when not.
+    """
+    return get_backend().has_pending(group)
@@ -1,18 +1,498 @@
-from django.test import TestCase
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from io import StringIO
+from typing import Any, AnyStr, Dict, List, NoReturn, Tuple, Union
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 from rest_framework.test import APIClient
 
+from apps.store.activity import get_activity_log_writer
+from apps.utils.locks import (
+    DatabaseLeaseBackend,
+    FileLockBackend,
+    LockManager,
+    LockTimeout,
+)
+from apps.utils.models import Lease, QueuedTask
+from apps.utils.routers import ReplicaRouter, read_from_replica
+from apps.utils.tasks import (
+    DatabaseBackend,
+    ThreadPoolBackend,
+    enqueue,
+    task,
+)
+
+# Audit events (PEP 578) of the file system operations
+FILE_EVENTS = {
+    "open",
+    "os.remove",
+    "os.rename",  # Also os.replace
+    "os.truncate",  # Also os.ftruncate
+    "os.mkdir",
+    "os.rmdir",
+    "os.listdir",
+    "os.scandir",
+    "fcntl.flock",
+    "shutil.copyfile",
+    "shutil.rmtree",
+}
+
+# The files of the interpreter and the packages, eg: a lazy import
+IGNORED_PREFIXES = tuple(
+    {sys.prefix, sys.base_prefix, sys.exec_prefix, sys.base_exec_prefix}
+)
+IGNORED_SUFFIXES = (".py", ".pyc", ".so", ".mo")
+
+
+class FileOperationRecorder:
+    """
+    Records the file system operations of all the threads, by an audit
+    hook: an audit hook can't be removed, a single one is installed.
+    """
+
+    _active: List["FileOperationRecorder"] = []
+    _installed = False
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.operations: List[Tuple[AnyStr, Any]] = []
+
+    def __enter__(self) -> "FileOperationRecorder":
+        with self._lock:
+            if not FileOperationRecorder._installed:
+                sys.addaudithook(FileOperationRecorder._hook)
+                FileOperationRecorder._installed = True
+            self._active.append(self)
+        return self
+
+    def __exit__(self, *exc_info) -> NoReturn:
+        with self._lock:
+            self._active.remove(self)
+
+    def __len__(self) -> int:
+        return len(self.operations)
+
+    @classmethod
+    def _hook(cls, event: AnyStr, args: tuple) -> NoReturn:
+        if not cls._active or event not in FILE_EVENTS:
+            return
+        path = args[0] if args else None
+        if isinstance(path, bytes):
+            path = path.decode(errors="replace")
+        if isinstance(path, str) and (
+            path.startswith(IGNORED_PREFIXES)
+            or path.endswith(IGNORED_SUFFIXES)
+        ):
+            return
+        for recorder in list(cls._active):
+            recorder.operations.append((event, path))
+
 
+@override_settings(
+    ACTIVITY_LOG={**settings.ACTIVITY_LOG, "SYNCHRONOUS": True},
+    DOCUMENT_ACCESS_CACHE={
+        **settings.DOCUMENT_ACCESS_CACHE,
+        "BACKEND": "default",
+    },
+    TASKS={**settings.TASKS, "BACKEND": "sync"},
+    DOCUMENT_CHANGES={**settings.DOCUMENT_CHANGES, "SETTLE": 0},
+)
 class APITest(TestCase):
     """Base APITest class."""
 
+    # The budgets of a call to an endpoint, by name, eg:
+    # {"document-list": {"queries": 3, "file_operations": 0}}
+    # queries: SQL queries, query_time: their seconds, file_operations: the
+    # FILE_EVENTS, seconds: wall time, for a coarse latency guard.
+    budgets: Dict[AnyStr, Dict[AnyStr, Union[int, float]]] = {}
+
     def setUp(self):
         """Setup base for tests."""
         super().setUp()
         self.client = APIClient()
+        # The rollbacks of the tests send no signal
+        caches["default"].clear()
+
+    def tearDown(self):
+        # The queued search index lines, indexed before the rollback
+        get_activity_log_writer().flush()
+        super().tearDown()
 
     @staticmethod
     def get_auth_header(user):
         """Get Auth token."""
         token_key = user.get_token()
         return f"Token {token_key}"
+
+    @contextmanager
+    def assertWithinBudget(
+        self, endpoint: Union[AnyStr, None] = None, **budget
+    ) -> Dict[AnyStr, Union[int, float]]:
+        """
+        Fail when the block exceeds the budget of the endpoint, or the given
+        one, eg:
+
+            with self.assertWithinBudget("document-list", queries=3):
+                self.client.get(self.list_url)
+
+        Yields the usage, filled once the block exits.
+        """
+        budget = {**self.budgets.get(endpoint, {}), **budget}
+        if not budget:
+            raise ValueError(f"No budget for the endpoint: {endpoint}")
+
+        usage = {}
+        with CaptureQueriesContext(connection) as queries:
+            with FileOperationRecorder() as files:
+                started = time.perf_counter()
+                yield usage
+                seconds = time.perf_counter() - started
+
+        usage.update(
+            queries=len(queries),
+            query_time=sum(
+                float(query["time"]) for query in queries.captured_queries
+            ),
+            file_operations=len(files),
+            seconds=seconds,
+        )
+        unknown = set(budget) - set(usage)
+        if unknown:
+            raise ValueError(f"Unknown budget: {sorted(unknown)}")
+
+        exceeded = {
+            name: limit
+            for name, limit in budget.items()
+            if usage[name] > limit
+        }
+        if exceeded:
+            details = [
+                f"{name}: {usage[name]} > {limit}"
+                for name, limit in exceeded.items()
+            ]
+            if "queries" in exceeded or "query_time" in exceeded:
+                details += [
+                    f"{number}. {query['sql']}"
+                    for number, query in enumerate(
+                        queries.captured_queries, start=1
+                    )
+                ]
+            if "file_operations" in exceeded:
+                details += [
+                    f"{event} {path}" for event, path in files.operations
+                ]
+            self.fail(
+                f"Budget of {endpoint or 'the block'} exceeded:\n"
+                + "\n".join(details)
+            )
+
+
+class BudgetTest(APITest):
+    def test_budget(self):
+        # Case 1: Within
+        # Act
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertWithinBudget(
+                queries=1, file_operations=2
+            ) as usage:
+                Lease.objects.count()
+                with open(f"{directory}/file", "w"):
+                    pass
+
+        # Assert
+        self.assertEqual(usage["queries"], 1)
+        self.assertEqual(usage["file_operations"], 1)
+
+        # Case 2: Exceeded
+        # Act & Assert
+        with self.assertRaisesMessage(AssertionError, "queries: 1 > 0"):
+            with self.assertWithinBudget(queries=0):
+                Lease.objects.count()
+
+        # Case 3: No budget
+        # Act & Assert
+        with self.assertRaises(ValueError):
+            with self.assertWithinBudget("unknown"):
+                pass
+
+
+class LockManagerTest(SimpleTestCase):
+    def setUp(self):
+        """Setup a lock manager on lock files."""
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend = FileLockBackend(self.directory.name)
+        self.lock_manager = LockManager(self.backend, timeout=0.05)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        super().tearDown()
+
+    def test_lock(self):
+        # Act
+        with self.lock_manager.lock("a"):
+            # Assert: Another name is not blocked
+            with self.lock_manager.lock("b"):
+                pass
+
+            # Assert: The same name times out
+            with self.assertRaises(LockTimeout):
+                with self.lock_manager.lock("a"):
+                    pass
+
+        # Assert: Released, its lock file removed
+        self.assertFalse(os.path.exists(self.backend.get_path("a")))
+        with self.lock_manager.lock("a"):
+            pass
+
+        metrics = self.lock_manager.metrics.snapshot()
+        self.assertEqual(metrics["acquired"], 3)
+        self.assertEqual(metrics["timeouts"], 1)
+        self.assertEqual(metrics["contended"], 1)
+        self.assertGreaterEqual(metrics["max_wait_seconds"], 0.05)
+
+
+class DatabaseLeaseBackendTest(TransactionTestCase):
+    # The leases are committed on a connection of their own
+    databases = {"default", "locks"}
+
+    def setUp(self):
+        """Setup a lock manager on leases."""
+        super().setUp()
+        self.lock_manager = LockManager(
+            DatabaseLeaseBackend(lease_timeout=30, database="locks"),
+            timeout=0.05,
+        )
+
+    def test_lock(self):
+        # Act
+        with self.lock_manager.lock("a"):
+            # Assert
+            self.assertTrue(Lease.objects.filter(name="a").exists())
+            with self.assertRaises(LockTimeout):
+                with self.lock_manager.lock("a"):
+                    pass
+
+        # Assert: Released
+        self.assertFalse(Lease.objects.exists())
+
+        # Case 2: In a transaction, the lease is committed at once
+        # Act
+        with transaction.atomic():
+            with self.lock_manager.lock("a"):
+                # Assert: Out of the transaction of the holder
+                self.assertTrue(connections["locks"].get_autocommit())
+                self.assertTrue(
+                    Lease.objects.using("locks").filter(name="a").exists()
+                )
+
+    def test_expired(self):
+        # Arrange: Left by a crashed holder
+        Lease.objects.create(
+            name="a",
+            owner="crashed",
+            expires_at=timezone.now() - timedelta(seconds=1),
+        )
+
+        # Act
+        with self.lock_manager.lock("a"):
+            # Assert: Taken over
+            self.assertNotEqual(Lease.objects.get(name="a").owner, "crashed")
+
+
+@override_settings(DATABASE_REPLICAS=["replica1"])
+class ReplicaRouterTest(SimpleTestCase):
+    def test_router(self):
+        # Arrange
+        router = ReplicaRouter()
+
+        # Assert: Outside of a replica block, all on the primary
+        self.assertEqual(router.db_for_read(Lease), "default")
+
+        # Act
+        with read_from_replica():
+            # Assert: The writes stay on the primary
+            self.assertEqual(router.db_for_read(Lease), "replica1")
+            self.assertEqual(router.db_for_write(Lease), "default")
+
+        # Assert
+        self.assertEqual(router.db_for_read(Lease), "default")
+        self.assertTrue(router.allow_migrate("default", "utils"))
+        self.assertFalse(router.allow_migrate("replica1", "utils"))
+
+
+# Arguments of the runs of the test tasks
+task_runs = []
+
+
+@task("tests.record")
+def record(value):
+    task_runs.append(value)
+
+
+@task("tests.fail", max_attempts=2)
+def fail():
+    raise ValueError("Failed")
+
+
+# Set by the tests, the tasks waiting on it return
+task_release = threading.Event()
+
+
+@task("tests.wait")
+def wait():
+    task_release.wait(5)
+
+
+@override_settings(
+    TASKS={**settings.TASKS, "BACKEND": "database", "RETRY_DELAY": 0}
+)
+class DatabaseBackendTest(TestCase):
+    def setUp(self):
+        """Setup a backend on the task rows."""
+        super().setUp()
+        self.backend = DatabaseBackend(lease=60)
+        task_runs.clear()
+
+    def test_idempotency(self):
+        # Act
+        enqueue("tests.record", 1, idempotency_key="a")
+        enqueue("tests.record", 1, idempotency_key="a")
+
+        # Assert
+        self.assertEqual(QueuedTask.objects.count(), 1)
+
+    def test_group(self):
+        # Arrange
+        enqueue("tests.record", "a1", group="a")
+        enqueue("tests.record", "a2", group="a")
+        enqueue("tests.record", "b")
+
+        # Act
+        tasks = self.backend.claim(10)
+
+        # Assert: One task of the group at a time, in order
+        self.assertEqual(
+            [task.arguments["args"] for task in tasks], [["a1"], ["b"]]
+        )
+        self.assertEqual(self.backend.claim(10), [])
+
+        # Act
+        for task_row in tasks:
+            self.backend.run(task_row)
+        tasks = self.backend.claim(10)
+
+        # Assert
+        self.assertEqual([task.arguments["args"] for task in tasks], [["a2"]])
+        self.assertEqual(task_runs, ["a1", "b"])
+
+    def test_retry(self):
+        # Arrange
+        enqueue("tests.fail")
+
+        # Act
+        self.backend.run(self.backend.claim(10)[0])
+
+        # Assert: Retried
+        task_row = QueuedTask.objects.get()
+        self.assertEqual(task_row.status, QueuedTask.Status.PENDING)
+
+        # Act
+        self.backend.run(self.backend.claim(10)[0])
+
+        # Assert: No attempt left
+        task_row.refresh_from_db()
+        self.assertEqual(task_row.status, QueuedTask.Status.FAILED)
+        self.assertEqual(task_row.attempts, 2)
+        self.assertIn("Failed", task_row.last_error)
+        self.assertEqual(self.backend.claim(10), [])
+
+    def test_run_tasks(self):
+        # Arrange
+        for value in range(3):
+            enqueue("tests.record", value, group="a")
+
+        # Act
+        call_command("run_tasks", "--once", stdout=StringIO())
+
+        # Assert
+        self.assertEqual(task_runs, [0, 1, 2])
+        self.assertFalse(
+            QueuedTask.objects.exclude(status=QueuedTask.Status.DONE).exists()
+        )
+
+
+class ThreadPoolBackendTest(SimpleTestCase):
+    # The transactions of the enqueues
+    databases = {"default"}
+
+    def setUp(self):
+        super().setUp()
+        self.backend = ThreadPoolBackend(workers=4)
+        task_runs.clear()
+        task_release.clear()
+
+    def test_group(self):
+        # Act
+        for value in range(20):
+            self.backend.enqueue("tests.record", [value], {}, "a", None)
+        self.backend.enqueue("tests.record", [0], {}, "a", "key")
+        self.backend.enqueue("tests.record", [0], {}, "a", "key")
+        self.backend.executor.shutdown(wait=True)
+
+        # Assert: In order, the duplicate skipped
+        self.assertEqual(task_runs, list(range(20)) + [0])
+
+    def test_pending(self):
+        # Case 1: Enqueued in the open transaction
+        with transaction.atomic():
+            # Act
+            self.backend.enqueue("tests.wait", [], {}, "a", None)
+
+            # Assert
+            self.assertTrue(self.backend.has_pending("a"))
+            self.assertFalse(self.backend.has_pending("b"))
+
+        # Case 2: Submitted once committed, running
+        # Assert
+        self.assertTrue(self.backend.has_pending("a"))
+
+        # Case 3: Done
+        # Act
+        task_release.set()
+        self.backend.executor.shutdown(wait=True)
+
+        # Assert
+        self.assertFalse(self.backend.has_pending("a"))
+
+    def test_rolled_back(self):
+        # Act
+        try:
+            with transaction.atomic():
+                self.backend.enqueue("tests.record", [1], {}, "a", "key")
+                raise ValueError("Rolled back")
+        except ValueError:
+            pass
+        self.backend.enqueue("tests.record", [2], {}, "a", "key")
+        self.backend.executor.shutdown(wait=True)
+
+        # Assert: Neither submitted nor its key kept, the retry runs
+        self.assertEqual(task_runs, [2])
+        self.assertFalse(self.backend.has_pending("a"))
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import require_GET
+
+from .profiling import render_metrics
+
+
+@require_GET
+def metrics(request) -> HttpResponse:
+    """
+    The metrics of the process in the Prometheus text format, for the
+    bearer token of PROFILING["METRICS_TOKEN"]. Each process of the server
+    has its own: scrape them one by one.
+    """
+    token = settings.PROFILING["METRICS_TOKEN"]
+    if not token:
+        raise Http404
+
+    credentials = request.headers.get("Authorization", "")
+    if not constant_time_compare(credentials, f"Bearer {token}"):
+        response = HttpResponse("Invalid token.", status=401)
+        response["WWW-Authenticate"] = "Bearer"
+        return response
+
+    return HttpResponse(
+        render_metrics(), content_type="text/plain; version=0.0.4"
+    )
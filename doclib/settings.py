@@ -10,9 +10,13 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
-from decouple import config
+import tempfile
+
+from decouple import Csv, config
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 from rest_framework.settings import api_settings
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -50,6 +54,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "apps.utils.middleware.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -57,6 +62,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "apps.utils.middleware.ReplicaRoutingMiddleware",
 ]
 
 ROOT_URLCONF = "doclib.urls"
@@ -83,11 +89,69 @@ WSGI_APPLICATION = "doclib.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
-DATABASES = {
-    "default": {
+# sqlite3 for the development | postgresql for the production
+DATABASE_ENGINE = config("DATABASE_ENGINE", default="sqlite3")
+
+if DATABASE_ENGINE == "postgresql":
+    PRIMARY_DATABASE = {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": config("DATABASE_NAME", default="doclib"),
+        "USER": config("DATABASE_USER", default="doclib"),
+        "PASSWORD": config("DATABASE_PASSWORD", default=""),
+        "HOST": config("DATABASE_HOST", default="localhost"),
+        "PORT": config("DATABASE_PORT", default="5432"),
+        # Seconds a connection is kept across the requests, 0: per request
+        "CONN_MAX_AGE": config("DATABASE_CONN_MAX_AGE", default=60, cast=int),
+        # Ping the kept connections before the requests reuse them
+        "CONN_HEALTH_CHECKS": config(
+            "DATABASE_CONN_HEALTH_CHECKS", default=True, cast=bool
+        ),
+        # Behind a transaction pooler (eg: pgbouncer), which can't keep the
+        # server side cursors of .iterator() across the transactions
+        "DISABLE_SERVER_SIDE_CURSORS": config(
+            "DATABASE_POOLED", default=False, cast=bool
+        ),
+        "OPTIONS": {
+            "connect_timeout": config(
+                "DATABASE_CONNECT_TIMEOUT", default=5, cast=int
+            ),
+        },
+    }
+elif DATABASE_ENGINE == "sqlite3":
+    PRIMARY_DATABASE = {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "NAME": config("DATABASE_NAME", default=str(BASE_DIR / "db.sqlite3")),
+    }
+else:
+    raise ImproperlyConfigured(f"Unknown database engine: {DATABASE_ENGINE}")
+
+DATABASES = {"default": PRIMARY_DATABASE}
+
+# Read replicas of the primary, by the hosts of their servers
+DATABASE_REPLICAS = []
+for number, host in enumerate(
+    config("DATABASE_REPLICA_HOSTS", default="", cast=Csv()), start=1
+):
+    DATABASES[f"replica{number}"] = {
+        **PRIMARY_DATABASE,
+        "HOST": host,
+        "TEST": {"MIRROR": "default"},
     }
+    DATABASE_REPLICAS.append(f"replica{number}")
+
+# A connection of its own for the leases of the database lock backend, in
+# autocommit whatever the transaction of the lock holder
+DATABASES["locks"] = {**PRIMARY_DATABASE, "TEST": {"MIRROR": "default"}}
+
+# The safe-method reads of the `replica_reads` viewsets go to the replicas
+DATABASE_ROUTERS = ["apps.utils.routers.ReplicaRouter"]
+
+# Read your writes: the requests of a user stay on the primary after a write
+READ_YOUR_WRITES = {
+    # Seconds, above the replication lag
+    "SECONDS": config("READ_YOUR_WRITES_SECONDS", default=5, cast=int),
+    # Alias in CACHES, shared by the processes in production
+    "CACHE": config("READ_YOUR_WRITES_CACHE", default="default"),
 }
 
 
@@ -123,7 +187,7 @@ AUTH_USER_MODEL = "store.User"
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework.authentication.TokenAuthentication",
+        "apps.utils.authentication.CachedTokenAuthentication",
     ],
     "TEST_REQUEST_DEFAULT_FORMAT": "json",
     "DEFAULT_PAGINATION_CLASS": (
@@ -131,8 +195,163 @@ REST_FRAMEWORK = {
     ),
 }
 
+# Serving of the document files by the download API
+DOCUMENT_DOWNLOAD = {
+    # stream | x-accel-redirect (nginx) | x-sendfile (apache)
+    "MODE": config("DOCUMENT_DOWNLOAD_MODE", default="stream"),
+    # Internal location of MEDIA_ROOT in the nginx configuration
+    "X_ACCEL_REDIRECT_PREFIX": config(
+        "DOCUMENT_DOWNLOAD_X_ACCEL_REDIRECT_PREFIX", default="/protected/"
+    ),
+    # Bytes read per chunk, when streamed
+    "CHUNK_SIZE": 64 * 1024,
+}
+
+# Locks of the document files, around their appends and truncates
+LOCKS = {
+    # file: fcntl locks, single host | database: leases, multiple hosts
+    "BACKEND": config("LOCKS_BACKEND", default="file"),
+    "DIRECTORY": config(
+        "LOCKS_DIRECTORY", default=str(Path(tempfile.gettempdir()) / "doclib")
+    ),
+    # Seconds to wait for a lock before giving up
+    "TIMEOUT": config("LOCKS_TIMEOUT", default=10.0, cast=float),
+    # Seconds after which the lease of a crashed holder is taken over
+    "LEASE_TIMEOUT": config("LOCKS_LEASE_TIMEOUT", default=30.0, cast=float),
+    # Alias in DATABASES of the leases, on the primary
+    "DATABASE": "locks",
+}
+
+# Background tasks, eg: the file operations of the documents
+TASKS = {
+    # sync: at once | thread: threads of the process | database: durable,
+    # run by `python manage.py run_tasks`
+    "BACKEND": config("TASKS_BACKEND", default="thread"),
+    # Threads of the thread backend
+    "WORKERS": config("TASKS_WORKERS", default=4, cast=int),
+    "MAX_ATTEMPTS": config("TASKS_MAX_ATTEMPTS", default=3, cast=int),
+    # Seconds before the first retry, doubled on each failure
+    "RETRY_DELAY": config("TASKS_RETRY_DELAY", default=1.0, cast=float),
+    # Seconds after which the task of a crashed worker is run again
+    "LEASE": config("TASKS_LEASE", default=300.0, cast=float),
+    # Seconds between the polls of an idle worker
+    "POLL_INTERVAL": config("TASKS_POLL_INTERVAL", default=1.0, cast=float),
+}
+
+# History of the document files, kept on the re-uploads and the restores
+DOCUMENT_VERSIONS = {
+    # Bytes per chunk, the unit of the deduplication between the versions
+    "CHUNK_SIZE": config(
+        "DOCUMENT_VERSIONS_CHUNK_SIZE", default=64 * 1024, cast=int
+    ),
+    # Every Nth version is also kept whole, read in one go. 0: never
+    "SNAPSHOT_INTERVAL": config(
+        "DOCUMENT_VERSIONS_SNAPSHOT_INTERVAL", default=10, cast=int
+    ),
+}
+
+# Resumable uploads of the document files, in chunks
+UPLOADS = {
+    # Bytes of a file
+    "MAX_SIZE": config("UPLOADS_MAX_SIZE", default=10 * 1024**3, cast=int),
+    # Bytes of a chunk request
+    "MAX_CHUNK_SIZE": config(
+        "UPLOADS_MAX_CHUNK_SIZE", default=64 * 1024**2, cast=int
+    ),
+    # Seconds an upload can be resumed, then purged
+    "EXPIRY": config("UPLOADS_EXPIRY", default=24 * 3600, cast=int),
+}
+
+# Full-text search of the document files, see apps/store/search.py
+SEARCH = {
+    # sqlite (FTS5), postgresql (tsvector), python (any database), auto: by
+    # the database. Empty: disabled
+    "BACKEND": config("SEARCH_BACKEND", default="auto"),
+    # Characters of a file indexed, the rest is not searchable
+    "MAX_CONTENT_SIZE": config(
+        "SEARCH_MAX_CONTENT_SIZE", default=1024**2, cast=int
+    ),
+}
+
+# Changes feed of the documents, per user
+DOCUMENT_CHANGES = {
+    # Days the changes are kept, see the purge_document_changes command. A
+    # client whose cursor is older syncs again from the list
+    "RETENTION": config("DOCUMENT_CHANGES_RETENTION", default=30, cast=int),
+    # Seconds the new changes are held back: recorded once their operation
+    # committed, an insert could still commit a lower sequence number after
+    # a higher one was read
+    "SETTLE": config("DOCUMENT_CHANGES_SETTLE", default=5.0, cast=float),
+}
+
+# Token -> user resolution cache of the CachedTokenAuthentication
+TOKEN_AUTH_CACHE = {
+    # Entries of the in-process LRU
+    "MAX_SIZE": config("TOKEN_AUTH_CACHE_MAX_SIZE", default=10000, cast=int),
+    # Seconds, in the shared cache
+    "TTL": config("TOKEN_AUTH_CACHE_TTL", default=60, cast=int),
+    # Seconds, in the LRU: the staleness bound across the processes, eg: of
+    # a revoked token
+    "LOCAL_TTL": config("TOKEN_AUTH_CACHE_LOCAL_TTL", default=5, cast=int),
+    # Alias in CACHES shared by the processes, in place of the LRU: expected
+    # in production, see `manage.py check --deploy`
+    "BACKEND": config("TOKEN_AUTH_CACHE_BACKEND", default=None),
+}
+
+# Server side cache of the document representations, by their version
+RESPONSE_CACHE = {
+    # Alias in CACHES. None: disabled
+    "BACKEND": config("RESPONSE_CACHE_BACKEND", default=None),
+    # Seconds, a new updated_at is a new key anyway
+    "TTL": config("RESPONSE_CACHE_TTL", default=3600, cast=int),
+}
+
+# Ids of the documents accessible by each user, for the document APIs
+DOCUMENT_ACCESS_CACHE = {
+    # Alias in CACHES, shared by the processes. None: disabled
+    "BACKEND": config("DOCUMENT_ACCESS_CACHE_BACKEND", default=None),
+    # Seconds, the entries are also invalidated by the changes
+    "TTL": config("DOCUMENT_ACCESS_CACHE_TTL", default=3600, cast=int),
+    # Users having more documents are queried each time
+    "MAX_SIZE": config(
+        "DOCUMENT_ACCESS_CACHE_MAX_SIZE", default=500, cast=int
+    ),
+}
+
+# Sampled profiling of the requests and the tasks, see apps.utils.profiling
+PROFILING = {
+    # Share of the requests and the tasks profiled. 0: disabled, 1: all
+    "SAMPLE_RATE": config("PROFILING_SAMPLE_RATE", default=0.0, cast=float),
+    # Send the phases of the profiled requests in a Server-Timing header
+    "SERVER_TIMING": config(
+        "PROFILING_SERVER_TIMING", default=True, cast=bool
+    ),
+    # Bearer token of the /metrics/ endpoint. None: not served
+    "METRICS_TOKEN": config("PROFILING_METRICS_TOKEN", default=None),
+}
+
+# Default mode of the APIs paginated by SelectablePagination: page | cursor
+PAGINATION_MODE = config("PAGINATION_MODE", default="page")
+
 api_settings.DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+# Buffered writes of the document activity logs
+ACTIVITY_LOG = {
+    # Seconds between the background flushes
+    "FLUSH_INTERVAL": config(
+        "ACTIVITY_LOG_FLUSH_INTERVAL", default=1.0, cast=float
+    ),
+    # Number of queued lines that triggers an early flush
+    "MAX_BATCH_SIZE": config(
+        "ACTIVITY_LOG_MAX_BATCH_SIZE", default=500, cast=int
+    ),
+    # Write in the calling thread, no buffering. Eg: for tests. The lines are
+    # still added to the search index in batches, by the flushes
+    "SYNCHRONOUS": config(
+        "ACTIVITY_LOG_SYNCHRONOUS", default=False, cast=bool
+    ),
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.0/topics/i18n/
 
@@ -152,6 +371,11 @@ STATIC_URL = "static/"
 
 MEDIA_ROOT = "media/"
 
+# Storage of the document files, a ContentAddressedStorage (sub)class
+DOCUMENT_STORAGE = config(
+    "DOCUMENT_STORAGE", default="apps.utils.storage.ContentAddressedStorage"
+)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
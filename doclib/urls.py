@@ -13,15 +13,17 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+
 from django.contrib import admin
 from django.urls import include, path
 
 from drf_yasg import openapi
 from drf_yasg.views import get_schema_view
 from rest_framework import permissions
-from rest_framework.authentication import TokenAuthentication
 
 from apps.apis import urls
+from apps.utils.authentication import CachedTokenAuthentication
+from apps.utils.views import metrics
 
 schema_view = get_schema_view(
     openapi.Info(
@@ -30,13 +32,14 @@ schema_view = get_schema_view(
     ),
     public=True,
     permission_classes=(permissions.AllowAny,),
-    authentication_classes=(TokenAuthentication,),
+    authentication_classes=(CachedTokenAuthentication,),
 )
 
 
 urlpatterns = [
     path("api/", include(urls)),
     path("admin/", admin.site.urls),
+    path("metrics/", metrics, name="metrics"),
     path(
         r"swagger/",
         schema_view.with_ui("swagger", cache_timeout=0),